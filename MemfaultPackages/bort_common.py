@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*
+# Code shared by bort_src_gen.py and bort_cli.py.
+# This file needs to be Python 3.4 compatible (i.e. type annotations must remain in comments).
+import contextlib
+import os
+import re
+import sys
+import time
+
+MYPY = False
+if MYPY:
+    from typing import (
+        IO,
+        Any,
+        ContextManager,
+        Dict,
+        Iterable,
+        Iterator,
+        List,
+        Optional,
+        Sequence,
+        Tuple,
+    )
+
+CHUNK_SIZE = 64 * 1024
+
+# Path of a Chrome trace file for bort_src_gen.py and bort_cli.py to append spans of subprocesses
+# and file I/O to (see Tracer). Every invocation appends to the same trace, which e.g. shows the
+# total cost of bort_src_gen.py in a build:
+TRACE_FILE_ENV = "BORT_TRACE_FILE"
+
+# Characters that the .properties format treats as whitespace (notably, not vertical tabs etc.):
+PROPERTIES_WHITESPACE = " \t\f"
+
+
+def iter_chunks(file, chunk_size=CHUNK_SIZE):  # type: (IO[str], int) -> Iterator[str]
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class PlaceholderReplacer:
+    """
+    Replaces placeholders with their values in a single pass over the content, no matter how many
+    placeholders there are. Replacement values are not searched for placeholders themselves.
+    """
+
+    def __init__(self, mapping):  # type: (Dict[str, str]) -> None
+        self._mapping = dict(mapping)
+        # Longest first, so that a placeholder that starts with another one is not cut short:
+        placeholders = sorted(self._mapping, key=len, reverse=True)
+        self._pattern = re.compile("|".join(re.escape(placeholder) for placeholder in placeholders))
+        self._max_len = max((len(placeholder) for placeholder in placeholders), default=0)
+
+    def _value(self, match):  # type: (...) -> str
+        return self._mapping[match.group(0)]
+
+    def replace(self, content):  # type: (str) -> str
+        if not self._mapping:
+            return content
+        return self._pattern.sub(self._value, content)
+
+    def iter_replace(self, chunks):  # type: (Iterable[str]) -> Iterator[str]
+        """
+        Replaces placeholders in content that arrives in chunks, which may split placeholders.
+        """
+        if not self._mapping:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        pending = ""
+        for chunk in chunks:
+            pending += chunk
+            # Whether a match that starts closer than this to the end of the pending content is
+            # the longest one can only be known once more content arrived:
+            limit = len(pending) - self._max_len + 1
+            parts = []
+            pos = 0
+            for match in self._pattern.finditer(pending, 0, len(pending)):
+                if match.start() >= limit:
+                    break
+                parts.append(pending[pos : match.start()])
+                parts.append(self._mapping[match.group(0)])
+                pos = match.end()
+            end = max(pos, limit)
+            parts.append(pending[pos:end])
+            pending = pending[end:]
+            yield "".join(parts)
+        yield self.replace(pending)
+
+    def replace_file(self, input_file, output_file, chunk_size=CHUNK_SIZE):
+        # type: (IO[str], IO[str], int) -> None
+        for chunk in self.iter_replace(iter_chunks(input_file, chunk_size)):
+            output_file.write(chunk)
+
+
+_LINE_TERMINATOR_RE = re.compile(r"\r\n|\r|\n")
+# The key ends at the first unescaped separator or whitespace, which may be surrounded by whitespace:
+_PROPERTIES_KEY_RE = re.compile(r"((?:[^\\:= \t\f]|\\.)*)[ \t\f]*[:=]?[ \t\f]*")
+_PROPERTIES_ESCAPE_RE = re.compile(r"\\(u[0-9a-fA-F]{4}|u|.)")
+_PROPERTIES_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "f": "\f"}
+_PROPERTIES_ESCAPED_CHARS = {char: escape for escape, char in _PROPERTIES_ESCAPES.items()}
+
+
+def _iter_logical_lines(lines):  # type: (Iterable[str]) -> Iterator[str]
+    continued = None  # type: Optional[str]
+    for line in lines:
+        natural_lines = _LINE_TERMINATOR_RE.split(line)
+        if len(natural_lines) > 1 and not natural_lines[-1]:
+            natural_lines.pop()
+        for natural_line in natural_lines:
+            natural_line = natural_line.lstrip(PROPERTIES_WHITESPACE)
+            if continued is None and (not natural_line or natural_line[0] in "#!"):
+                continue
+            # An odd number of trailing backslashes continues the line, an even one is escaped:
+            backslashes = len(natural_line) - len(natural_line.rstrip("\\"))
+            if backslashes % 2:
+                continued = (continued or "") + natural_line[:-1]
+                continue
+            yield (continued or "") + natural_line
+            continued = None
+    if continued is not None:
+        yield continued
+
+
+def _unescape(escaped):  # type: (str) -> str
+    def _char(match):  # type: (...) -> str
+        escape = match.group(1)
+        if escape[0] == "u":
+            if len(escape) == 1:
+                raise ValueError("Malformed \\uxxxx encoding in {!r}".format(escaped))
+            return chr(int(escape[1:], 16))
+        return _PROPERTIES_ESCAPES.get(escape, escape)
+
+    if "\\" not in escaped:
+        return escaped
+    value = _PROPERTIES_ESCAPE_RE.sub(_char, escaped)
+    if "\\u" in escaped:
+        # Escapes are UTF-16 code units, so characters outside the BMP are escaped as pairs:
+        try:
+            value = value.encode("utf-16-le", "surrogatepass").decode("utf-16-le")
+        except UnicodeDecodeError:
+            raise ValueError(
+                "Unpaired surrogate \\uxxxx encoding in {!r}".format(escaped)
+            ) from None
+    return value
+
+
+def _escape(text, key=False):  # type: (str, bool) -> str
+    chars = []
+    for index, char in enumerate(text):
+        if char in "\\#!=:" or (char == " " and (key or index == 0)):
+            chars.append("\\" + char)
+        elif char in _PROPERTIES_ESCAPED_CHARS:
+            chars.append("\\" + _PROPERTIES_ESCAPED_CHARS[char])
+        elif " " <= char <= "~":
+            chars.append(char)
+        else:
+            # Escapes are UTF-16 code units, so characters outside the BMP are escaped as pairs:
+            units = char.encode("utf-16-be", "surrogatepass")
+            for i in range(0, len(units), 2):
+                chars.append("\\u{:04x}".format(int.from_bytes(units[i : i + 2], "big")))
+    return "".join(chars)
+
+
+def format_property(key, value):  # type: (str, str) -> str
+    """
+    Formats a line of a .properties file that iter_properties() parses back into the key and value.
+    """
+    return "{}={}\n".format(_escape(key, key=True), _escape(value))
+
+
+def iter_properties(lines):  # type: (Iterable[str]) -> Iterator[Tuple[str, str]]
+    """
+    Parses the keys and values of a .properties file, line by line, as specified here:
+    https://docs.oracle.com/javase/8/docs/api/java/util/Properties.html#load-java.io.Reader-
+    """
+    for line in _iter_logical_lines(lines):
+        match = _PROPERTIES_KEY_RE.match(line)
+        try:
+            key, value = _unescape(match.group(1)), _unescape(line[match.end() :])
+        except ValueError as e:
+            raise ValueError("{} (line {!r})".format(e, line)) from None
+        yield key, value
+
+
+class JavaProperties:
+    """
+    The properties of a .properties file. Later definitions of a key override earlier ones.
+    """
+
+    # Absolute path => ((mtime, size), properties) of the files parsed by load():
+    _loaded = {}  # type: Dict[str, Tuple[Tuple[int, int], JavaProperties]]
+
+    def __init__(self, file):  # type: (Iterable[str]) -> None
+        self._properties = dict(iter_properties(file))
+
+    def get(self, key, fallback=None):  # type: (str, Optional[str]) -> Optional[str]
+        return self._properties.get(key, fallback)
+
+    def __getitem__(self, key):  # type: (str) -> str
+        return self._properties[key]
+
+    @staticmethod
+    def from_string(src):  # type: (str) -> JavaProperties
+        return JavaProperties(src.splitlines(True))
+
+    @staticmethod
+    def load(path):  # type: (str) -> JavaProperties
+        """
+        Parses the file at `path`, unless it was parsed before and did not change since.
+        """
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        abspath = os.path.abspath(path)
+        loaded = JavaProperties._loaded.get(abspath)
+        if loaded is not None and loaded[0] == stamp:
+            return loaded[1]
+        with open(path) as file:
+            properties = JavaProperties(file)
+        JavaProperties._loaded[abspath] = (stamp, properties)
+        return properties
+
+
+def append_trace_events(path, events):  # type: (str, List[Dict[str, Any]]) -> None
+    """
+    Appends to a trace in the JSON Array Format of the Trace Event Format, in which the closing
+    bracket is optional. That lets any number of processes append to the same trace.
+    """
+    import json
+    import tempfile
+
+    directory = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as header:
+        header.write("[\n")
+    try:
+        # Atomically creates the trace with its opening bracket, unless another process did so:
+        os.link(header.name, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(header.name)
+
+    data = "".join(json.dumps(event) + ",\n" for event in events).encode("utf8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        # A single write, so that the events of concurrent processes don't interleave:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+class Tracer:
+    """
+    Records spans of subprocesses, file reads/writes etc. as Chrome trace events, which
+    chrome://tracing and https://ui.perfetto.dev can display. Once enabled, the events are appended
+    to the trace file when the process exits.
+    """
+
+    def __init__(self):  # type: () -> None
+        self._path = None  # type: Optional[str]
+        self._events = []  # type: List[Dict[str, Any]]
+        self._lock = None  # type: Any
+
+    def enable(self, path):  # type: (str) -> None
+        # Imported here, so that processes which don't trace don't pay for it:
+        import atexit
+        import threading
+
+        if self._path is None:
+            self._lock = threading.Lock()
+            atexit.register(self.flush)
+        self._path = os.path.abspath(path)
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):  # type: (str, str, **Any) -> Iterator[Dict[str, Any]]
+        """
+        Yields the arguments of the span, so that e.g. byte counts can be added to it
+        """
+        if self._path is None:
+            yield args
+            return
+
+        import threading
+
+        timestamp = time.time()
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int(timestamp * 1e6),
+                "dur": int((time.perf_counter() - start) * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self._events.append(event)
+
+    def subprocess_span(self, cmd, **args):
+        # type: (Sequence[str], **Any) -> ContextManager[Dict[str, Any]]
+        return self.span(
+            os.path.basename(cmd[0]),
+            "subprocess",
+            command=" ".join(cmd),
+            cwd=args.pop("cwd", None) or os.getcwd(),
+            **args
+        )
+
+    def flush(self):  # type: () -> None
+        if self._path is None:
+            return
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        process_name = {
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": " ".join([os.path.basename(sys.argv[0])] + sys.argv[1:])},
+        }
+        try:
+            append_trace_events(self._path, [process_name] + events)
+        except OSError as error:
+            import logging
+
+            logging.warning("Failed to write trace to %s: %s", self._path, error)
@@ -1,12 +1,27 @@
 MEMFAULT_PACKAGES_DIR := $(realpath $(dir $(abspath $(lastword $(MAKEFILE_LIST)))))
 BORT_PROPERTIES := $(MEMFAULT_PACKAGES_DIR)/bort.properties
 BORT_SRC_GEN_TOOL := $(MEMFAULT_PACKAGES_DIR)/bort_src_gen.py
+BORT_SRC_GEN_TOOL_DEPS := $(BORT_SRC_GEN_TOOL) $(MEMFAULT_PACKAGES_DIR)/bort_common.py
+# Set BORT_TRACE_FILE to collect a Chrome trace of all bort_src_gen.py invocations of the build:
+BORT_SRC_GEN_FLAGS := $(if $(BORT_TRACE_FILE),--trace-file $(abspath $(BORT_TRACE_FILE)))
+
+# Generated sources depend on this stamp of the bort.properties values they use, rather than on all
+# of bort.properties. The tool leaves the stamp (and unchanged outputs) untouched, and restat stops
+# edits of other properties from rebuilding everything downstream. Android.bp generates
+# bort_properties.h from the same stamp (MemfaultBortPropertiesStamp).
+BORT_PROPERTIES_STAMP := $(TARGET_OUT_COMMON_GEN)/MemfaultPackages/bort_properties.stamp
+$(BORT_PROPERTIES_STAMP): PRIVATE_PATH := $(MEMFAULT_PACKAGES_DIR)
+$(BORT_PROPERTIES_STAMP): PRIVATE_CUSTOM_TOOL := $(BORT_SRC_GEN_TOOL) $(BORT_SRC_GEN_FLAGS) properties-stamp $(BORT_PROPERTIES_STAMP) $(BORT_PROPERTIES)
+$(BORT_PROPERTIES_STAMP): $(BORT_SRC_GEN_TOOL_DEPS) $(BORT_PROPERTIES)
+	$(transform-generated-source)
+.KATI_RESTAT: $(BORT_PROPERTIES_STAMP)
 
 define bort_src_gen_template
 $(2): PRIVATE_PATH := $(MEMFAULT_PACKAGES_DIR)
-$(2): PRIVATE_CUSTOM_TOOL := $(BORT_SRC_GEN_TOOL) template $(1) $(2) $(BORT_PROPERTIES)
-$(2): $(1) $(BORT_SRC_GEN_TOOL) $(BORT_PROPERTIES)
+$(2): PRIVATE_CUSTOM_TOOL := $(BORT_SRC_GEN_TOOL) $(BORT_SRC_GEN_FLAGS) template $(1) $(2) $(BORT_PROPERTIES)
+$(2): $(1) $(BORT_SRC_GEN_TOOL_DEPS) $(BORT_PROPERTIES_STAMP)
 	$$(transform-generated-source)
+.KATI_RESTAT: $(2)
 endef
 
 define bort_src_gen
@@ -14,10 +29,14 @@ $(eval $(call bort_src_gen_template,$(1),$(2)))
 endef
 
 
+# Export BORT_SIGNATURE_CACHE_DIR to share check-signature results between builds; entries are keyed
+# by the contents of the APK & certificate, so the cache never needs to be cleared.
+# Set BORT_CHECK_SIGNATURE_FLAGS := --native to read the certificates without starting JVMs, at the
+# cost of not verifying the signatures of the APK (see bort_src_gen.py check-signature --help).
 define bort_check_signature_template
 $(1): PRIVATE_PATH := $(MEMFAULT_PACKAGES_DIR)
-$(1): PRIVATE_CUSTOM_TOOL := $(BORT_SRC_GEN_TOOL) check-signature $(1) $(2) $(3)
-$(1): $(2) $(3) $(BORT_SRC_GEN_TOOL)
+$(1): PRIVATE_CUSTOM_TOOL := $(BORT_SRC_GEN_TOOL) $(BORT_SRC_GEN_FLAGS) check-signature $(BORT_CHECK_SIGNATURE_FLAGS) $(1) $(2) $(3)
+$(1): $(2) $(3) $(BORT_SRC_GEN_TOOL_DEPS)
 	$$(transform-generated-source)
 endef
 
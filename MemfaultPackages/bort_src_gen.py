@@ -1,24 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*
 # This file needs to be Python 3.4 compatible (i.e. type annotations must remain in comments).
+# It runs for every generated file of the build: modules that only some subcommands need are
+# imported where they are used, see test_import_time in test_bort_src_gen.py.
 import argparse
-import configparser
-import io
+import contextlib
 import os
 import re
-import subprocess
 import sys
+import time
 
-try:
-    from typing import Optional
-except ImportError:
-    if sys.version_info >= (3, 5):
-        pass
+from bort_common import (
+    TRACE_FILE_ENV,
+    JavaProperties,
+    PlaceholderReplacer,
+    Tracer,
+    format_property,
+    iter_chunks,
+)
 
-try:
-    import pytest  # noqa: M900 # TODO: split out tests
-except:  # noqa
-    pass
+MYPY = False
+if MYPY:
+    from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 
 INVALID_VALUES = {
@@ -37,27 +40,21 @@ MAPPING = {
 }
 
 
-class JavaProperties:
-    # The .properties file format is described here:
-    # https://docs.oracle.com/javase/7/docs/api/java/util/Properties.html#load(java.io.Reader)
-    # Use python's ConfigParser to parse it, it will get us most of the way there.
+_tracer = Tracer()
 
-    def __init__(self, file):
-        def _reader():
-            yield "[main]"
-            # yield from is only supported since python 3.3
-            for line in file:
-                yield line
 
-        self.cp = configparser.ConfigParser(comment_prefixes=("#", "!"))
-        self.cp.read_file(_reader())
+def _read_file(path):
+    with _tracer.span("read", "file", path=path) as span_args:
+        with open(path) as file:
+            content = file.read()
+        span_args["bytes"] = len(content.encode("utf8"))
+    return content
 
-    def get(self, key, **kwargs):
-        return self.cp.get("main", key.lower(), **kwargs)
 
-    @staticmethod
-    def from_string(src):
-        return JavaProperties(io.StringIO(src))
+def _write_file(path, content):
+    with _tracer.span("write", "file", path=path, bytes=len(content.encode("utf8"))):
+        with open(path, "w") as file:
+            file.write(content)
 
 
 class Replacement:
@@ -73,26 +70,107 @@ class Replacement:
         )
 
 
+def _placeholder_replacer(replacements):
+    return PlaceholderReplacer(
+        {placeholder: replacement.value for placeholder, replacement in replacements.items()}
+    )
+
+
 def _replace_placeholders(content, replacements):
-    for placeholder, replacement in replacements.items():
-        content = content.replace(placeholder, replacement.value)
+    return _placeholder_replacer(replacements).replace(content)
 
-    return content
+
+# Size of the content from which outputs get a sidecar. Below it (i.e. for all the XML and header
+# files generated by the build), reading and comparing the output is as fast as hashing the content
+# and checking the sidecar: the sidecar only paid off from about 768 KiB on, on an ext4 SSD.
+SIDECAR_MIN_SIZE = 1024 * 1024
+
+
+def _sidecar_path(output_file_abspath):
+    directory, name = os.path.split(output_file_abspath)
+    return os.path.join(directory, ".{}.sha256".format(name))
+
+
+def _sidecar_matches(content_sha256, output_file_abspath):
+    # type: (str, str) -> bool
+    """
+    Whether the sidecar of an output records that it has content with the given hash, and the
+    output's size and mtime are still the recorded ones.
+    """
+    try:
+        output_stat = os.stat(output_file_abspath)
+        sidecar_stat = os.stat(_sidecar_path(output_file_abspath))
+        record = _read_file(_sidecar_path(output_file_abspath)).split()
+    except OSError:
+        return False
+
+    return (
+        record == [content_sha256, str(output_stat.st_size), str(output_stat.st_mtime_ns)]
+        # Like git's "racily clean" check: an output modified within the mtime granularity of the
+        # file system after the sidecar was written would still have the recorded mtime.
+        and output_stat.st_mtime_ns < sidecar_stat.st_mtime_ns
+    )
+
+
+def _write_sidecar(content_sha256, output_file_abspath):
+    try:
+        output_stat = os.stat(output_file_abspath)
+        record = "{} {} {}\n".format(content_sha256, output_stat.st_size, output_stat.st_mtime_ns)
+        _write_file(_sidecar_path(output_file_abspath), record)
+    except OSError:
+        pass  # Only costs reading the output next time
 
 
 def _write_if_changed(content, output_file_abspath):
+    import hashlib
+
+    # For large outputs, a sidecar file records the hash, size and mtime of the output, so that an
+    # unchanged output can be recognized without reading it:
+    content_sha256 = None  # type: Optional[str]
+    if len(content) >= SIDECAR_MIN_SIZE:
+        content_sha256 = hashlib.sha256(content.encode("utf8")).hexdigest()
+        if _sidecar_matches(content_sha256, output_file_abspath):
+            return  # Don't touch it to avoid rebuilds
+
     existing_content = None  # type: Optional[str]
     try:
-        with open(output_file_abspath) as file:
-            existing_content = file.read()
+        existing_content = _read_file(output_file_abspath)
     except OSError:
         pass
 
-    if content == existing_content:
-        return  # Don't touch it to avoid rebuilds
-
-    with open(output_file_abspath, "w") as file:
-        file.write(content)
+    if content != existing_content:
+        _write_file(output_file_abspath, content)
+    # Outputs that don't exist yet are most likely written to a fresh directory, such as the
+    # sandbox of a Soong genrule, in which a sidecar would be an undeclared output:
+    if content_sha256 and existing_content is not None:
+        _write_sidecar(content_sha256, output_file_abspath)
+
+
+def _write_chunks_if_changed(generate_chunks, output_file_abspath):
+    # type: (Callable[[], Iterable[str]], str) -> bool
+    """
+    Like _write_if_changed, for content that is generated in chunks: compares the chunks to the
+    output as they are generated, and only generates them again to write the output if they differ.
+    Returns whether the output existed.
+    """
+    try:
+        existing_file = open(output_file_abspath)
+    except OSError:
+        existing_file = None
+    if existing_file is not None:
+        with existing_file, _tracer.span("read", "file", path=output_file_abspath):
+            for chunk in generate_chunks():
+                if existing_file.read(len(chunk)) != chunk:
+                    break
+            else:
+                if not existing_file.read(1):
+                    return True  # Don't touch it to avoid rebuilds
+
+    with _tracer.span("write", "file", path=output_file_abspath):
+        with open(output_file_abspath, "w") as file:
+            for chunk in generate_chunks():
+                file.write(chunk)
+    return existing_file is not None
 
 
 def _get_replacements(mapping, bort_props):
@@ -135,17 +213,70 @@ def _generate_cpp_header(replacements):
     return content
 
 
-def _cmd_template(*, input_file, output_file, bort_properties_file):
-    with open(bort_properties_file) as f:
-        replacements = _get_replacements(MAPPING, JavaProperties(f))
-    with open(input_file) as file:
-        content = _replace_placeholders(file.read(), replacements)
+def _generate_properties_stamp(mapping, bort_props):
+    """
+    Lists the values of the properties that the mapping uses, so that the generated sources can
+    depend on this instead of on the whole properties file, which has many other properties. The
+    stamp is a properties file itself, from which cpp-header can generate the header.
+    """
+    content = "# DO NOT EDIT -- GENERATED BY bort_src_gen.py\n"
+    for prop in sorted({prop for props in mapping.values() for prop in props}):
+        value = bort_props.get(prop)
+        if value is not None:
+            content += format_property(prop, value)
+    return content
+
+
+def _load_properties(bort_properties_file):
+    with _tracer.span("read", "file", path=bort_properties_file):
+        return JavaProperties.load(bort_properties_file)
+
+
+def _load_replacements(bort_properties_file):
+    return _get_replacements(MAPPING, _load_properties(bort_properties_file))
+
+
+def _template(input_file, output_file, replacements):
+    replacer = _placeholder_replacer(replacements)
+
+    def _generate_chunks():
+        with open(input_file) as file:
+            for chunk in replacer.iter_replace(iter_chunks(file)):
+                yield chunk
+
+    # The size of the template stands in for the one of the output, which is only known once it
+    # has been generated:
+    content_sha256 = None  # type: Optional[str]
+    if os.path.getsize(input_file) >= SIDECAR_MIN_SIZE:
+        import hashlib
+
+        sha256 = hashlib.sha256()
+        for chunk in _generate_chunks():
+            sha256.update(chunk.encode("utf8"))
+        content_sha256 = sha256.hexdigest()
+        if _sidecar_matches(content_sha256, output_file):
+            return  # Don't touch it to avoid rebuilds
+
+    existed = _write_chunks_if_changed(_generate_chunks, output_file)
+    if content_sha256 and existed:
+        _write_sidecar(content_sha256, output_file)
+
+
+def _cpp_header(output_file, replacements):
+    content = _generate_cpp_header(replacements)
     _write_if_changed(content, output_file)
 
 
+def _cmd_template(*, input_file, output_file, bort_properties_file):
+    _template(input_file, output_file, _load_replacements(bort_properties_file))
+
+
 def _cmd_cpp_header(*, output_file, bort_properties_file):
-    with open(bort_properties_file) as f:
-        content = _generate_cpp_header(_get_replacements(MAPPING, JavaProperties(f)))
+    _cpp_header(output_file, _load_replacements(bort_properties_file))
+
+
+def _cmd_properties_stamp(*, output_file, bort_properties_file):
+    content = _generate_properties_stamp(MAPPING, _load_properties(bort_properties_file))
     _write_if_changed(content, output_file)
 
 
@@ -186,9 +317,14 @@ def _get_java_bin_path(prog):
 
 
 def _run_keytool(*args):
+    import subprocess
+
     keytool_path = _get_java_bin_path("keytool")
     cmd = [keytool_path] + list(args)
-    return subprocess.check_output(cmd).decode("utf8", errors="ignore"), cmd
+    with _tracer.subprocess_span(cmd) as span_args:
+        output = subprocess.check_output(cmd)
+        span_args["stdout_bytes"] = len(output)
+    return output.decode("utf8", errors="ignore"), cmd
 
 
 def _get_apksigner_jar_path():
@@ -197,16 +333,332 @@ def _get_apksigner_jar_path():
 
 
 def _run_apksigner(*args):
+    import subprocess
+
     java_path = _get_java_bin_path("java")
-    return subprocess.check_output(
-        [java_path, "-jar", _get_apksigner_jar_path()] + list(args)
-    ).decode("utf8", errors="ignore")
+    cmd = [java_path, "-jar", _get_apksigner_jar_path()] + list(args)
+    with _tracer.subprocess_span(cmd) as span_args:
+        output = subprocess.check_output(cmd)
+        span_args["stdout_bytes"] = len(output)
+    return output.decode("utf8", errors="ignore")
+
+
+# IDs of the blocks of the APK Signature Schemes in the APK Signing Block, in order of preference:
+APK_SIGNATURE_SCHEME_IDS = (
+    0xF05368C0,  # v3
+    0x7109871A,  # v2
+)
+APK_SIGNING_BLOCK_MAGIC = b"APK Sig Block 42"
+ZIP_EOCD_SIGNATURE = b"PK\x05\x06"
+ZIP_EOCD_SIZE = 22
+ZIP_MAX_COMMENT_SIZE = 0xFFFF
+# Directory to share the results of check-signature in, between builds:
+SIGNATURE_CACHE_DIR_ENV = "BORT_SIGNATURE_CACHE_DIR"
+SIGNATURE_CACHE_MAX_BYTES = 1024 * 1024
+# Coarsest modification time granularity of the file systems the cached files may be on:
+SIGNATURE_CACHE_MTIME_GRANULARITY_SECONDS = 2
+# Age after which a temporary file in the cache is assumed to be left behind by a killed build job:
+SIGNATURE_CACHE_STALE_TMP_SECONDS = 60
+# DER encoded value of the id-ce-subjectKeyIdentifier object identifier (2.5.29.14):
+SUBJECT_KEY_IDENTIFIER_OID = b"\x55\x1d\x0e"
+# Signature block files of the v1 (JAR) signature scheme:
+JAR_SIGNATURE_BLOCK_RE = re.compile(r"^META-INF/[^/]+\.(RSA|DSA|EC)$", re.IGNORECASE)
+
+
+def _sha256_fingerprint(der):
+    # type: (bytes) -> str
+    import hashlib
+
+    return _hex_colon_format(hashlib.sha256(der).hexdigest())
+
+
+def _read_length_prefixed(data, offset):
+    # type: (bytes, int) -> Tuple[bytes, int]
+    """
+    Reads an item prefixed with its uint32 length, as the APK Signature Schemes encode them.
+    Returns the item and the offset after it.
+    """
+    import struct
+
+    if offset + 4 > len(data):
+        raise Exception("Truncated APK Signature Scheme block")
+    (size,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    if offset + size > len(data):
+        raise Exception("Truncated APK Signature Scheme block")
+    return data[offset : offset + size], offset + size
+
+
+def _iter_length_prefixed(data):
+    # type: (bytes) -> Iterator[bytes]
+    offset = 0
+    while offset < len(data):
+        item, offset = _read_length_prefixed(data, offset)
+        yield item
+
+
+def _read_apk_signing_block(apk):
+    # type: (...) -> Dict[int, bytes]
+    """
+    Reads the ID-value pairs of the APK Signing Block, which sits right before the ZIP Central
+    Directory, from a memory-mapped APK. Only the End of Central Directory record and the block
+    itself are read.
+    """
+    import struct
+
+    eocd = apk.rfind(ZIP_EOCD_SIGNATURE, max(0, len(apk) - ZIP_EOCD_SIZE - ZIP_MAX_COMMENT_SIZE))
+    if eocd < 0 or eocd + ZIP_EOCD_SIZE > len(apk):
+        raise Exception("Not a ZIP file: End of Central Directory record not found")
+    (cd_offset,) = struct.unpack_from("<I", apk, eocd + 16)
+    if (
+        cd_offset < 32
+        or cd_offset > eocd
+        or apk[cd_offset - 16 : cd_offset] != APK_SIGNING_BLOCK_MAGIC
+    ):
+        return {}
+
+    (size,) = struct.unpack_from("<Q", apk, cd_offset - 24)
+    start = cd_offset - size - 8
+    if start < 0 or struct.unpack_from("<Q", apk, start)[0] != size:
+        raise Exception("Malformed APK Signing Block")
+
+    pairs = apk[start + 8 : cd_offset - 24]
+    blocks = {}
+    offset = 0
+    while offset < len(pairs):
+        if offset + 12 > len(pairs):
+            raise Exception("Malformed APK Signing Block")
+        length, block_id = struct.unpack_from("<QI", pairs, offset)
+        if length < 4 or offset + 8 + length > len(pairs):
+            raise Exception("Malformed APK Signing Block")
+        blocks[block_id] = pairs[offset + 12 : offset + 8 + length]
+        offset += 8 + length
+    return blocks
+
+
+def _get_signature_scheme_certificates(block):
+    # type: (bytes) -> List[bytes]
+    """
+    Returns the certificate of each signer of an APK Signature Scheme v2 or v3 block. The signed
+    data of a signer starts with its digests and certificates in both versions.
+    """
+    signers, _ = _read_length_prefixed(block, 0)
+    certificates = []
+    for signer in _iter_length_prefixed(signers):
+        signed_data, _ = _read_length_prefixed(signer, 0)
+        _, offset = _read_length_prefixed(signed_data, 0)  # digests
+        signer_certificates, _ = _read_length_prefixed(signed_data, offset)
+        for certificate in _iter_length_prefixed(signer_certificates):
+            certificates.append(certificate)
+            break
+        else:
+            raise Exception("No certificate for signer")
+    return certificates
+
+
+def _read_der(data, offset):
+    # type: (bytes, int) -> Tuple[int, int, int]
+    """
+    Reads the DER encoded element at offset. Returns its tag, and where its value starts and ends.
+    """
+    if offset + 2 > len(data):
+        raise Exception("Truncated DER element")
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        num_bytes = length & 0x7F
+        if not 1 <= num_bytes <= 4 or offset + num_bytes > len(data):
+            raise Exception("Unsupported DER length")
+        length = int.from_bytes(data[offset : offset + num_bytes], "big")
+        offset += num_bytes
+    if offset + length > len(data):
+        raise Exception("Truncated DER element")
+    return tag, offset, offset + length
+
+
+def _der_children(data, start, end):
+    # type: (bytes, int, int) -> List[Tuple[int, int, int, int]]
+    """
+    Returns the tag, start, value start and end of the elements in data[start:end].
+    """
+    children = []
+    offset = start
+    while offset < end:
+        tag, value_start, value_end = _read_der(data, offset)
+        children.append((tag, offset, value_start, value_end))
+        offset = value_end
+    return children
+
+
+def _get_subject_key_identifier(data, tbs):
+    # type: (bytes, List[Tuple[int, int, int, int]]) -> Optional[bytes]
+    """
+    Returns the subject key identifier extension of a certificate, given the elements of its
+    TBSCertificate, if it has one.
+    """
+    for tag, _, value_start, value_end in tbs:
+        if tag != 0xA3:  # [3] EXPLICIT Extensions
+            continue
+        _, start, end = _read_der(data, value_start)
+        for _, _, extension_start, extension_end in _der_children(data, start, end):
+            extension = _der_children(data, extension_start, extension_end)
+            oid = extension[0]
+            if data[oid[2] : oid[3]] == SUBJECT_KEY_IDENTIFIER_OID:
+                # The OCTET STRING value wraps the DER encoded KeyIdentifier OCTET STRING:
+                _, start, end = _read_der(data, extension[-1][2])
+                return data[start:end]
+    return None
+
+
+def _get_pkcs7_signer_certificates(pkcs7):
+    # type: (bytes) -> List[bytes]
+    """
+    Returns the certificate of each signer of a PKCS #7 SignedData structure, which is what the
+    signature block files of the v1 (JAR) signature scheme contain. Signers are matched to the
+    certificates by issuer and serial number, or by subject key identifier.
+    """
+    tag, start, end = _read_der(pkcs7, 0)
+    content_info = _der_children(pkcs7, start, end)
+    if tag != 0x30 or len(content_info) < 2 or content_info[1][0] != 0xA0:
+        raise Exception("Not a PKCS #7 ContentInfo")
+    tag, start, end = _read_der(pkcs7, content_info[1][2])
+    signed_data = _der_children(pkcs7, start, end)
+
+    certificates = {}
+    signer_infos = []
+    for tag, _, value_start, value_end in signed_data:
+        if tag == 0xA0:  # [0] IMPLICIT SET OF Certificate
+            for _, cert_start, cert_value_start, cert_end in _der_children(
+                pkcs7, value_start, value_end
+            ):
+                tbs_tag, tbs_start, tbs_end = _read_der(pkcs7, cert_value_start)
+                tbs = _der_children(pkcs7, tbs_start, tbs_end)
+                if tbs and tbs[0][0] == 0xA0:  # [0] EXPLICIT version
+                    tbs = tbs[1:]
+                serial, issuer = tbs[0], tbs[2]
+                key = (pkcs7[issuer[1] : issuer[3]], pkcs7[serial[1] : serial[3]])
+                certificates[key] = pkcs7[cert_start:cert_end]
+                subject_key_identifier = _get_subject_key_identifier(pkcs7, tbs)
+                if subject_key_identifier is not None:
+                    certificates[subject_key_identifier] = pkcs7[cert_start:cert_end]
+        elif tag == 0x31:  # SET OF SignerInfo (the last element)
+            signer_infos = _der_children(pkcs7, value_start, value_end)
+
+    signer_certificates = []
+    for _, _, value_start, value_end in signer_infos:
+        sid_tag, _, sid_start, sid_end = _der_children(pkcs7, value_start, value_end)[1]
+        if sid_tag == 0x30:  # IssuerAndSerialNumber
+            issuer, serial = _der_children(pkcs7, sid_start, sid_end)
+            key = (pkcs7[issuer[1] : issuer[3]], pkcs7[serial[1] : serial[3]])
+        elif sid_tag == 0x80:  # [0] IMPLICIT SubjectKeyIdentifier
+            key = pkcs7[sid_start:sid_end]
+        else:
+            raise Exception("Unsupported signer identifier")
+        if key not in certificates:
+            raise Exception("No certificate for signer")
+        signer_certificates.append(certificates[key])
+    return signer_certificates
+
+
+def _read_apk_signer_certificates(apk_file):
+    # type: (str) -> List[bytes]
+    """
+    Returns the DER encoded certificates of the signers of an APK, like `apksigner verify
+    --print-certs` prints them: those of the v3 or v2 APK Signature Scheme if the APK has an APK
+    Signing Block, otherwise those of the v1 (JAR) signature. Unlike apksigner, this does not
+    verify the signatures.
+    """
+    import mmap
+    import struct
+    import zipfile
+    import zlib
+
+    with _tracer.span("read", "file", path=apk_file):
+        with open(apk_file, "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                raise Exception("Not a ZIP file: {} is empty".format(apk_file))
+            with contextlib.closing(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)) as apk:
+                try:
+                    certificates = _get_apk_signer_certificates(file, apk)
+                except (
+                    struct.error,
+                    IndexError,
+                    ValueError,
+                    EOFError,
+                    OSError,  # E.g. seeking to a corrupt offset
+                    NotImplementedError,
+                    zipfile.BadZipFile,
+                    zlib.error,
+                ) as e:
+                    raise Exception("Malformed APK {}: {}".format(apk_file, e)) from e
+    if not certificates:
+        raise Exception("{} is not signed".format(apk_file))
+    return certificates
+
+
+def _get_apk_signer_certificates(file, apk):
+    # type: (IO[bytes], ...) -> List[bytes]
+    """
+    Returns the signer certificates of an APK, given its file and a memory-mapped view of it
+    """
+    import zipfile
+
+    blocks = _read_apk_signing_block(apk)
+    for scheme_id in APK_SIGNATURE_SCHEME_IDS:
+        if scheme_id in blocks:
+            return _get_signature_scheme_certificates(blocks[scheme_id])
+
+    certificates = []
+    with zipfile.ZipFile(file) as apk_zip:
+        for name in sorted(apk_zip.namelist()):
+            if JAR_SIGNATURE_BLOCK_RE.match(name):
+                certificates.extend(_get_pkcs7_signer_certificates(apk_zip.read(name)))
+    return certificates
+
+
+def _read_certificate(pem_file):
+    # type: (str) -> bytes
+    """
+    Returns the first certificate of a PEM file, or of a DER encoded certificate file, like
+    `keytool -printcert -file` reads them.
+    """
+    import base64
+    import binascii
+
+    with _tracer.span("read", "file", path=pem_file):
+        with open(pem_file, "rb") as file:
+            data = file.read()
+    match = re.search(b"-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----", data, re.DOTALL)
+    if match:
+        try:
+            return base64.b64decode(b"".join(match.group(1).split()), validate=True)
+        except binascii.Error as e:
+            raise Exception("Invalid PEM certificate: {}".format(e))
+    _, _, end = _read_der(data, 0)
+    return data[:end]
 
 
 def fail(msg):
     sys.exit(msg)
 
 
+def positive_int_type(arg):
+    # type: (str) -> int
+    """
+    Argument type for positive integers
+    """
+    try:
+        value = int(arg)
+    except ValueError:
+        value = 0
+
+    if value < 1:
+        raise argparse.ArgumentTypeError("Not a positive integer: {!r}".format(arg))
+
+    return value
+
+
 class SignatureError(Exception):
     pass
 
@@ -222,23 +674,187 @@ def _check_signatures(*, output_file, apk_file, pem_file, apk_cert_sha256s, pem_
                 apk_file, apk_cert_sha256s, pem_file, pem_sha256
             )
         )
-    with open(output_file, "w") as f:
-        f.write("OK: {}".format(pem_sha256))
+    _write_file(output_file, "OK: {}".format(pem_sha256))
 
 
-def _cmd_check_signature(*, output_file, apk_file, pem_file):
-    try:
-        apk_cert_sha256s = _parse_apksigner_cert_sha256(
-            _run_apksigner("verify", "--print-certs", apk_file)
+class SignatureCache:
+    """
+    Cache of the certificate fingerprints read by check-signature, shared between builds (and the
+    variants of a build) through a directory. Entries are keyed by the digests of the contents of
+    the APK and PEM files, so they never go stale. The digest of a file is recorded along with its
+    inode, size and modification time, so an unchanged file is not read again just to look up its
+    entry. The least recently used entries (and leftover temporary files) are evicted once the
+    cache grows beyond `max_bytes`. Entries are replaced atomically and every step tolerates
+    entries vanishing, so parallel build jobs can share the cache without locking.
+    """
+
+    def __init__(self, directory, max_bytes=SIGNATURE_CACHE_MAX_BYTES):
+        # type: (str, int) -> None
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def from_env():
+        # type: () -> Optional[SignatureCache]
+        directory = os.environ.get(SIGNATURE_CACHE_DIR_ENV)
+        return SignatureCache(directory) if directory else None
+
+    def key(self, apk_file, pem_file, method):
+        # type: (str, str, str) -> str
+        import hashlib
+
+        key = hashlib.sha256(method.encode("utf8"))
+        for path in (apk_file, pem_file):
+            key.update(self._file_digest(path).encode("ascii"))
+        return key.hexdigest()
+
+    def _file_digest(self, path):
+        # type: (str) -> str
+        import hashlib
+        import json
+        import mmap
+
+        stat = os.stat(path)
+        file_stat = [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        record_path = self._path(
+            "file-{}".format(hashlib.sha256(os.fsencode(os.path.abspath(path))).hexdigest())
         )
+        try:
+            record = json.loads(_read_file(record_path))
+            if record["stat"] == file_stat:
+                os.utime(record_path)  # Most recently used
+                return str(record["sha256"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        with _tracer.span("read", "file", path=path):
+            with open(path, "rb") as file:
+                if stat.st_size:
+                    with contextlib.closing(
+                        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    ) as content:
+                        digest = hashlib.sha256(content).hexdigest()
+                else:
+                    digest = hashlib.sha256().hexdigest()
+        # A file modified again within the timestamp granularity could keep the same stat, so only
+        # record the digest once that can no longer go unnoticed:
+        if time.time() - stat.st_mtime > SIGNATURE_CACHE_MTIME_GRANULARITY_SECONDS:
+            self._write(record_path, json.dumps({"stat": file_stat, "sha256": digest}))
+        return digest
+
+    def _path(self, key):
+        # type: (str) -> str
+        return os.path.join(self.directory, "{}.json".format(key))
+
+    def load(self, key):
+        # type: (str) -> Optional[Tuple[List[str], str]]
+        import json
+
+        path = self._path(key)
+        try:
+            entry = json.loads(_read_file(path))
+            os.utime(path)  # Most recently used
+            return entry["apk_cert_sha256s"], entry["pem_sha256"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def store(self, key, apk_cert_sha256s, pem_sha256):
+        # type: (str, List[str], str) -> None
+        import json
+
+        self._write(
+            self._path(key),
+            json.dumps({"apk_cert_sha256s": apk_cert_sha256s, "pem_sha256": pem_sha256}),
+        )
+
+    def _write(self, path, content):
+        # type: (str, str) -> None
+        import tempfile
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            file = tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False)
+            try:
+                with file:
+                    file.write(content)
+                os.replace(file.name, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(file.name)
+                raise
+            self._evict()
+        except OSError:
+            pass  # Only costs reading the files again next time
+
+    def _evict(self):
+        # type: () -> None
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                is_tmp = name.endswith(".tmp")
+                if is_tmp and now - stat.st_mtime > SIGNATURE_CACHE_STALE_TMP_SECONDS:
+                    os.remove(path)  # Left behind by a build job that was killed
+                    continue
+            except FileNotFoundError:
+                continue  # Evicted by another build job
+            if is_tmp or name.endswith(".json"):
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if not name.endswith(".tmp"):  # Still being written by another build job
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+
+
+def _read_fingerprints(apk_file, pem_file, native):
+    # type: (str, str, bool) -> Tuple[List[str], str]
+    try:
+        if native:
+            apk_cert_sha256s = [
+                _sha256_fingerprint(certificate)
+                for certificate in _read_apk_signer_certificates(apk_file)
+            ]
+        else:
+            apk_cert_sha256s = _parse_apksigner_cert_sha256(
+                _run_apksigner("verify", "--print-certs", apk_file)
+            )
     except Exception as e:
         raise Exception("Failed to extract certificates from {}".format(apk_file)) from e
 
     try:
-        output, cmd = _run_keytool("-printcert", "-file", pem_file)
-        pem_sha256 = _parse_keytool_printcert_sha256(output, cmd)
+        if native:
+            pem_sha256 = _sha256_fingerprint(_read_certificate(pem_file))
+        else:
+            output, cmd = _run_keytool("-printcert", "-file", pem_file)
+            pem_sha256 = _parse_keytool_printcert_sha256(output, cmd)
     except Exception as e:
         raise Exception("Failed to extract certificate from {}".format(pem_file)) from e
+    return apk_cert_sha256s, pem_sha256
+
+
+def _cmd_check_signature(*, output_file, apk_file, pem_file, native=False):
+    cache = SignatureCache.from_env()
+    fingerprints = None
+    if cache:
+        try:
+            key = cache.key(apk_file, pem_file, "native" if native else "jvm")
+            fingerprints = cache.load(key)
+        except OSError:
+            cache = None  # Reading the files fails again below, with the usual error
+    if fingerprints is None:
+        fingerprints = _read_fingerprints(apk_file, pem_file, native)
+        if cache:
+            cache.store(key, *fingerprints)
+    apk_cert_sha256s, pem_sha256 = fingerprints
 
     try:
         _check_signatures(
@@ -252,8 +868,111 @@ def _cmd_check_signature(*, output_file, apk_file, pem_file):
         fail(str(e))
 
 
+BATCH_JOB_ARGS = {
+    # batch manifest job command => its arguments, as for the subcommand of the same name
+    "template": ("input_file", "output_file", "bort_properties_file"),
+    "cpp-header": ("output_file", "bort_properties_file"),
+    "properties-stamp": ("output_file", "bort_properties_file"),
+    "check-signature": ("output_file", "apk_file", "pem_file"),
+}
+
+
+def _read_batch_manifest(manifest_file):
+    # type: (str) -> List[dict]
+    import json
+
+    try:
+        batch = json.loads(_read_file(manifest_file))
+    except OSError as e:
+        fail("Failed to read batch manifest {}: {}".format(manifest_file, e))
+    except ValueError as e:
+        fail("Invalid batch manifest {}: {}".format(manifest_file, e))
+    if not isinstance(batch, list):
+        fail("Invalid batch manifest {}: expected a list of jobs".format(manifest_file))
+
+    output_files = set()
+    for job in batch:
+        args = BATCH_JOB_ARGS.get(job.get("command")) if isinstance(job, dict) else None
+        if args is None:
+            fail("Invalid job in {}: {}".format(manifest_file, job))
+        if set(job) != set(args) | {"command"}:
+            fail(
+                "Invalid job in {}: {}. A {} job has the arguments {}".format(
+                    manifest_file, job, job["command"], ", ".join(args)
+                )
+            )
+        if job["output_file"] in output_files:
+            fail("Duplicate output file in {}: {}".format(manifest_file, job["output_file"]))
+        output_files.add(job["output_file"])
+    return batch
+
+
+def _cmd_batch(*, manifest_file, jobs):
+    import concurrent.futures
+    import traceback
+
+    batch = _read_batch_manifest(manifest_file)
+
+    # Parse every bort.properties file only once, no matter how many jobs use it:
+    replacements = {}
+    for job in batch:
+        bort_properties_file = job.get("bort_properties_file")
+        if job["command"] not in ("template", "cpp-header") or bort_properties_file in replacements:
+            continue
+        try:
+            replacements[bort_properties_file] = _load_replacements(bort_properties_file)
+        except Exception as e:
+            replacements[bort_properties_file] = e
+
+    def _run_job(job):
+        if job["command"] == "check-signature":
+            _cmd_check_signature(
+                output_file=job["output_file"], apk_file=job["apk_file"], pem_file=job["pem_file"]
+            )
+            return
+        if job["command"] == "properties-stamp":
+            _cmd_properties_stamp(
+                output_file=job["output_file"], bort_properties_file=job["bort_properties_file"]
+            )
+            return
+
+        job_replacements = replacements[job["bort_properties_file"]]
+        if isinstance(job_replacements, Exception):
+            raise Exception(
+                "Failed to load {}".format(job["bort_properties_file"])
+            ) from job_replacements
+        if job["command"] == "template":
+            _template(job["input_file"], job["output_file"], job_replacements)
+        else:
+            _cpp_header(job["output_file"], job_replacements)
+
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_run_job, job) for job in batch]
+        for job, future in zip(batch, futures):
+            try:
+                future.result()
+            except SystemExit as e:
+                failures.append("{}: {}".format(job["output_file"], e))
+            except Exception as e:
+                failures.append(
+                    "{}: {}".format(
+                        job["output_file"],
+                        "".join(traceback.format_exception(type(e), e, e.__traceback__)),
+                    )
+                )
+    if failures:
+        fail("\n".join(failures))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--trace-file",
+        default=os.environ.get(TRACE_FILE_ENV),
+        help="Append a Chrome trace of subprocesses and file reads/writes to this file "
+        "(default: ${})".format(TRACE_FILE_ENV),
+    )
     subparsers = parser.add_subparsers()
 
     template_parser = subparsers.add_parser("template")
@@ -267,147 +986,52 @@ if __name__ == "__main__":
     cpp_header_parser.add_argument("bort_properties_file")
     cpp_header_parser.set_defaults(command=_cmd_cpp_header)
 
+    properties_stamp_parser = subparsers.add_parser(
+        "properties-stamp",
+        help="Write the values of the properties that template and cpp-header use, only if they "
+        "changed. Generated sources can depend on this instead of on the whole properties file, "
+        "and generate from it, as it is a properties file too.",
+    )
+    properties_stamp_parser.add_argument("output_file")
+    properties_stamp_parser.add_argument("bort_properties_file")
+    properties_stamp_parser.set_defaults(command=_cmd_properties_stamp)
+
     check_signature_parse = subparsers.add_parser("check-signature")
     check_signature_parse.add_argument("output_file")
     check_signature_parse.add_argument("apk_file")
     check_signature_parse.add_argument("pem_file")
+    check_signature_parse.add_argument(
+        "--native",
+        action="store_true",
+        help="Read the certificates in-process instead of with apksigner and keytool, which saves "
+        "starting two JVMs. Unlike apksigner, this does not verify the signatures (nor digests) of "
+        "the APK, so a modified APK with the same signing block passes.",
+    )
     check_signature_parse.set_defaults(command=_cmd_check_signature)
 
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="Run the jobs of a JSON manifest concurrently, in one process. The manifest is a list "
+        'of objects with a "command" (template, cpp-header, properties-stamp or check-signature) and the arguments '
+        'of that command (e.g. "output_file").',
+    )
+    batch_parser.add_argument("manifest_file")
+    batch_parser.add_argument(
+        "--jobs",
+        type=positive_int_type,
+        default=os.cpu_count() or 1,
+        help="Number of jobs to run concurrently (default: number of CPUs)",
+    )
+    batch_parser.set_defaults(command=_cmd_batch)
+
     args = vars(parser.parse_args())
     command = args.pop("command", None)
+    trace_file = args.pop("trace_file")
 
     if not command:
         parser.print_help()
         sys.exit(1)
 
+    if trace_file:
+        _tracer.enable(trace_file)
     command(**args)
-
-
-def test_replace_placeholders():
-    assert (
-        _replace_placeholders(
-            '<permission name="$PERM"/>', {"$PERM": Replacement("BORT_PERM", "com.myperm")}
-        )
-        == '<permission name="com.myperm"/>'
-    )
-
-
-def test_generate_cpp_header():
-    assert (
-        _generate_cpp_header(
-            {
-                "$PERM": Replacement("BORT_PERM", "com.myperm"),
-                "$APP_ID": Replacement("BORT_ID", "com.app"),
-            }
-        )
-        == """// DO NOT EDIT -- GENERATED BY bort_src_gen.py
-#define APP_ID com.app
-#define PERM com.myperm
-"""
-    )
-
-
-def test_get_replacements():
-    assert _get_replacements(
-        {"REPL": ("VAR1", "VAR2")}, JavaProperties.from_string("VAR2=FOO")
-    ) == {"REPL": Replacement("VAR2", "FOO")}
-
-    with pytest.raises(
-        Exception,
-        match="Missing value for REPL. Please define VAR1 or VAR2 in bort.properties!",
-    ):
-        assert _get_replacements({"REPL": ("VAR1", "VAR2")}, JavaProperties.from_string("VAR3=FOO"))
-
-    with pytest.raises(
-        Exception,
-        match="Invalid value 'vnd.myandroid.bortappid' for 'VAR1'. Please change in bort.properties!",
-    ):
-        assert _get_replacements(
-            {"REPL": ("VAR1", "VAR2")}, JavaProperties.from_string("VAR1=vnd.myandroid.bortappid")
-        )
-
-
-def test_java_properties():
-    props = JavaProperties.from_string(
-        """
-#  comment
-  # comment
-! comment
-FOO=BAR
-BAZ=DUN\
-NO
-"""
-    )
-    assert props.get("FOO") == "BAR"
-    assert props.get("BAZ") == "DUNNO"
-
-
-def test_parse_keytool_printcert_sha256() -> None:
-    import textwrap
-
-    output = textwrap.dedent(
-        """\
-        Owner: CN=Memfault Inc, OU=Memfault, O=Memfault, L=San Francisco, ST=CA, C=US
-        SHA256: foo bar
-        Certificate fingerprints:
-        \t SHA256: 17:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C
-        Version: 3
-        """
-    )
-    assert (
-        _parse_keytool_printcert_sha256(output, [])
-        == "17:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C"
-    )
-
-
-def test_parse_keytool_printcert_sha256_failure() -> None:
-    with pytest.raises(Exception, match="Failed to extract SHA256 fingerprint") as excinfo:
-        _parse_keytool_printcert_sha256("the output", ["keytool", "cmd", "xyz"])
-    assert "keytool cmd xyz" in str(excinfo.value)
-    assert "the output" in str(excinfo.value)
-
-
-def test_parse_apksigner_cert_sha256() -> None:
-    import textwrap
-
-    output = textwrap.dedent(
-        """\
-        Signer #1 certificate DN: CN=Memfault Inc, OU=Memfault, O=Memfault, L=San Francisco, ST=CA, C=US
-        Signer #1 certificate SHA-256 digest: 1747dc4655d9729e5b3aa9338d52538595a356aa8061865c148fbb00dffb4b4c
-        Signer #2 certificate SHA-256 digest: aa47dc4655d9729e5b3aa9338d52538595a356aa8061865c148fbb00dffb4b4c
-        """
-    )
-    assert _parse_apksigner_cert_sha256(output) == [
-        "17:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C",
-        "AA:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C",
-    ]
-
-
-def test_check_signatures_mismatch():
-    with pytest.raises(Exception, match="signature does not match"):
-        _check_signatures(
-            output_file="output.txt",
-            apk_file="app.apk",
-            pem_file="cert.pem",
-            apk_cert_sha256s=["AA:BB", "EE:FF"],
-            pem_sha256="CC:DD",
-        )
-
-
-def test_check_signatures_match():
-    import tempfile
-
-    with tempfile.NamedTemporaryFile(mode="w+") as f:
-        _check_signatures(
-            output_file=f.name,
-            apk_file="app.apk",
-            pem_file="cert.pem",
-            apk_cert_sha256s=["AA:BB", "CC:DD"],
-            pem_sha256="CC:DD",
-        )
-
-        assert f.read() == "OK: CC:DD"
-
-
-def test_apksigner_jar_path_exists():
-    assert os.path.exists(_get_apksigner_jar_path())
@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+from bort_common import (
+    JavaProperties,
+    PlaceholderReplacer,
+    Tracer,
+    format_property,
+    iter_properties,
+)
+
+
+def test_replace():
+    replacer = PlaceholderReplacer({"$A": "$AB", "$AB": "x", "$B": "y"})
+    assert replacer.replace("$A $AB $B $ABC") == "$AB x y xC"
+    assert PlaceholderReplacer({}).replace("$A") == "$A"
+
+
+def test_iter_replace():
+    replacer = PlaceholderReplacer({"$A": "1", "$ABC": "2", "$D": "3"})
+    content = "$A$ABC$D $AB $ABCD" * 3
+    expected = replacer.replace(content)
+    for size in range(1, len(content) + 1):
+        chunks = [content[idx : idx + size] for idx in range(0, len(content), size)]
+        assert "".join(replacer.iter_replace(chunks)) == expected
+
+
+def test_iter_properties():
+    src = (
+        "#  comment\n"
+        "  # comment\n"
+        "! comment \\\n"
+        "FOO=BAR\n"
+        "BAZ=DUN\\\n"
+        "     NO\n"
+        "\n"
+        "colon : value  \r"
+        "white\\ space\tvalue\r\n"
+        "bare\n"
+        "escaped\\:key==\\t\\u00e9\\uD83D\\uDE00\\q\\\\\n"
+        "continued=\\\n"
+        "#not a comment"
+    )
+    assert list(iter_properties(src.splitlines(True))) == [
+        ("FOO", "BAR"),
+        ("BAZ", "DUNNO"),
+        ("colon", "value  "),
+        ("white space", "value"),
+        ("bare", ""),
+        ("escaped:key", "=\té\U0001f600q\\"),
+        ("continued", "#not a comment"),
+    ]
+
+    with pytest.raises(ValueError, match="Malformed"):
+        list(iter_properties(["key=\\u12"]))
+    for line in ("key=\\uD800", "key=\\uDE00\\uD83D", "\\uD83Dkey=value"):
+        with pytest.raises(ValueError, match="Unpaired surrogate") as excinfo:
+            list(iter_properties([line + "\n"]))
+        assert str(excinfo.value).endswith("(line {!r})".format(line))
+
+
+def test_format_property():
+    assert format_property("KEY", "com.app") == "KEY=com.app\n"
+    for key, value in (
+        ("white space:=#!", "  leading space\t\n\r\f"),
+        ("\\", "\\é\U0001f600 # ! = :"),
+        ("", ""),
+    ):
+        line = format_property(key, value)
+        assert line.count("\n") == 1
+        assert list(iter_properties([line])) == [(key, value)]
+
+
+def test_java_properties_load(tmp_path):
+    path = tmp_path / "bort.properties"
+    path.write_text("KEY=1\nkey=2\nKEY=3\n")
+    props = JavaProperties.load(str(path))
+    assert props["KEY"] == "3"
+    assert props.get("key") == "2"
+    assert props.get("KEY2", fallback="4") == "4"
+    assert JavaProperties.load(str(path)) is props
+
+    mtime_ns = os.stat(str(path)).st_mtime_ns
+    path.write_text("KEY=5\n")
+    os.utime(str(path), ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert JavaProperties.load(str(path))["KEY"] == "5"
+
+
+def test_trace_file(tmp_path):
+    trace_file = str(tmp_path / "trace.json")
+    for _ in range(2):
+        tracer = Tracer()
+        tracer.enable(trace_file)
+        with tracer.span("read", "file", path="bort.properties") as span_args:
+            span_args["bytes"] = 3
+        tracer.flush()
+
+    with open(trace_file) as file:
+        content = file.read()
+    # The closing bracket of the JSON Array Format is optional:
+    events = json.loads(content.rstrip().rstrip(",") + "]")
+    assert [event["ph"] for event in events] == ["M", "X", "M", "X"]
+    assert events[1]["args"] == {"path": "bort.properties", "bytes": 3}
@@ -0,0 +1,731 @@
+import base64
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import zipfile
+
+import bort_common
+import bort_src_gen
+import pytest
+from bort_src_gen import (
+    SIGNATURE_CACHE_DIR_ENV,
+    ZIP_EOCD_SIZE,
+    JavaProperties,
+    Replacement,
+    SignatureCache,
+    _check_signatures,
+    _cmd_batch,
+    _cmd_check_signature,
+    _cmd_cpp_header,
+    _cmd_properties_stamp,
+    _generate_cpp_header,
+    _get_apksigner_jar_path,
+    _get_replacements,
+    _parse_apksigner_cert_sha256,
+    _parse_keytool_printcert_sha256,
+    _read_apk_signer_certificates,
+    _read_certificate,
+    _read_file,
+    _replace_placeholders,
+    _sha256_fingerprint,
+    _write_file,
+    _write_if_changed,
+)
+
+
+def test_replace_placeholders():
+    assert (
+        _replace_placeholders(
+            '<permission name="$PERM"/>', {"$PERM": Replacement("BORT_PERM", "com.myperm")}
+        )
+        == '<permission name="com.myperm"/>'
+    )
+
+
+def test_generate_cpp_header():
+    assert (
+        _generate_cpp_header(
+            {
+                "$PERM": Replacement("BORT_PERM", "com.myperm"),
+                "$APP_ID": Replacement("BORT_ID", "com.app"),
+            }
+        )
+        == """// DO NOT EDIT -- GENERATED BY bort_src_gen.py
+#define APP_ID com.app
+#define PERM com.myperm
+"""
+    )
+
+
+def test_get_replacements():
+    assert _get_replacements(
+        {"REPL": ("VAR1", "VAR2")}, JavaProperties.from_string("VAR2=FOO")
+    ) == {"REPL": Replacement("VAR2", "FOO")}
+
+    with pytest.raises(
+        Exception,
+        match="Missing value for REPL. Please define VAR1 or VAR2 in bort.properties!",
+    ):
+        assert _get_replacements({"REPL": ("VAR1", "VAR2")}, JavaProperties.from_string("VAR3=FOO"))
+
+    with pytest.raises(
+        Exception,
+        match="Invalid value 'vnd.myandroid.bortappid' for 'VAR1'. Please change in bort.properties!",
+    ):
+        assert _get_replacements(
+            {"REPL": ("VAR1", "VAR2")}, JavaProperties.from_string("VAR1=vnd.myandroid.bortappid")
+        )
+
+
+def test_cmd_properties_stamp(tmp_path):
+    bort_properties_file = str(tmp_path / "bort.properties")
+    output_file = str(tmp_path / "bort_properties.stamp")
+    _write_file(bort_properties_file, "BORT_APPLICATION_ID=com.app\nSDK_VERSION=1\n")
+    _cmd_properties_stamp(output_file=output_file, bort_properties_file=bort_properties_file)
+    assert "BORT_APPLICATION_ID=com.app\n" in _read_file(output_file)
+    assert "SDK_VERSION" not in _read_file(output_file)
+
+    def _edit(content):
+        mtime_ns = os.stat(output_file).st_mtime_ns - 10**9
+        os.utime(output_file, ns=(mtime_ns, mtime_ns))
+        _write_file(bort_properties_file, content)
+        _cmd_properties_stamp(output_file=output_file, bort_properties_file=bort_properties_file)
+        return os.stat(output_file).st_mtime_ns != mtime_ns
+
+    assert not _edit("BORT_APPLICATION_ID=com.app\nSDK_VERSION=2\n")
+    assert _edit("BORT_APPLICATION_ID=com.app\nBORT_FEATURE_NAME=com.feature\n")
+    assert "BORT_FEATURE_NAME=com.feature\n" in _read_file(output_file)
+
+    # The header generated from the stamp is the one generated from the properties:
+    header_file = str(tmp_path / "bort_properties.h")
+    _write_file(
+        bort_properties_file, "BORT_APPLICATION_ID=com.app\nBORT_OTA_APPLICATION_ID=com.ota\n"
+    )
+    _cmd_properties_stamp(output_file=output_file, bort_properties_file=bort_properties_file)
+    _cmd_cpp_header(output_file=header_file, bort_properties_file=bort_properties_file)
+    header = _read_file(header_file)
+    _cmd_cpp_header(output_file=header_file, bort_properties_file=output_file)
+    assert _read_file(header_file) == header
+
+
+def test_parse_keytool_printcert_sha256() -> None:
+    import textwrap
+
+    output = textwrap.dedent("""\
+        Owner: CN=Memfault Inc, OU=Memfault, O=Memfault, L=San Francisco, ST=CA, C=US
+        SHA256: foo bar
+        Certificate fingerprints:
+        \t SHA256: 17:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C
+        Version: 3
+        """)
+    assert (
+        _parse_keytool_printcert_sha256(output, [])
+        == "17:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C"
+    )
+
+
+def test_parse_keytool_printcert_sha256_failure() -> None:
+    with pytest.raises(Exception, match="Failed to extract SHA256 fingerprint") as excinfo:
+        _parse_keytool_printcert_sha256("the output", ["keytool", "cmd", "xyz"])
+    assert "keytool cmd xyz" in str(excinfo.value)
+    assert "the output" in str(excinfo.value)
+
+
+def test_parse_apksigner_cert_sha256() -> None:
+    import textwrap
+
+    output = textwrap.dedent("""\
+        Signer #1 certificate DN: CN=Memfault Inc, OU=Memfault, O=Memfault, L=San Francisco, ST=CA, C=US
+        Signer #1 certificate SHA-256 digest: 1747dc4655d9729e5b3aa9338d52538595a356aa8061865c148fbb00dffb4b4c
+        Signer #2 certificate SHA-256 digest: aa47dc4655d9729e5b3aa9338d52538595a356aa8061865c148fbb00dffb4b4c
+        """)
+    assert _parse_apksigner_cert_sha256(output) == [
+        "17:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C",
+        "AA:47:DC:46:55:D9:72:9E:5B:3A:A9:33:8D:52:53:85:95:A3:56:AA:80:61:86:5C:14:8F:BB:00:DF:FB:4B:4C",
+    ]
+
+
+def test_check_signatures_mismatch():
+    with pytest.raises(Exception, match="signature does not match"):
+        _check_signatures(
+            output_file="output.txt",
+            apk_file="app.apk",
+            pem_file="cert.pem",
+            apk_cert_sha256s=["AA:BB", "EE:FF"],
+            pem_sha256="CC:DD",
+        )
+
+
+def test_check_signatures_match():
+    import tempfile
+
+    with tempfile.NamedTemporaryFile(mode="w+") as f:
+        _check_signatures(
+            output_file=f.name,
+            apk_file="app.apk",
+            pem_file="cert.pem",
+            apk_cert_sha256s=["AA:BB", "CC:DD"],
+            pem_sha256="CC:DD",
+        )
+
+        assert f.read() == "OK: CC:DD"
+
+
+def test_apksigner_jar_path_exists():
+    assert os.path.exists(_get_apksigner_jar_path())
+
+
+def test_batch(tmp_path, monkeypatch):
+    bort_properties_file = str(tmp_path / "bort.properties")
+    _write_file(
+        bort_properties_file, "BORT_APPLICATION_ID=com.app\nBORT_OTA_APPLICATION_ID=com.app.ota\n"
+    )
+    templates = []
+    for idx in range(3):
+        input_file = str(tmp_path / "template{}.xml.in".format(idx))
+        _write_file(input_file, '<permission name="$BORT_APPLICATION_ID.{}"/>'.format(idx))
+        templates.append(input_file)
+    batch = [
+        {
+            "command": "template",
+            "input_file": input_file,
+            "output_file": input_file[: -len(".in")],
+            "bort_properties_file": bort_properties_file,
+        }
+        for input_file in templates
+    ] + [
+        {
+            "command": "cpp-header",
+            "output_file": str(tmp_path / "bort_properties.h"),
+            "bort_properties_file": bort_properties_file,
+        }
+    ]
+    manifest_file = str(tmp_path / "batch.json")
+    _write_file(manifest_file, json.dumps(batch))
+
+    loaded = []
+    iter_properties = bort_common.iter_properties
+    monkeypatch.setattr(
+        bort_common, "iter_properties", lambda lines: loaded.append(lines) or iter_properties(lines)
+    )
+    _cmd_batch(manifest_file=manifest_file, jobs=4)
+    assert len(loaded) == 1
+    assert _read_file(str(tmp_path / "template2.xml")) == '<permission name="com.app.2"/>'
+    assert "#define BORT_FEATURE_NAME com.app\n" in _read_file(str(tmp_path / "bort_properties.h"))
+
+    # Unchanged outputs are not touched:
+    mtime_ns = os.stat(str(tmp_path / "template0.xml")).st_mtime_ns
+    os.utime(str(tmp_path / "template0.xml"), ns=(mtime_ns - 10**9, mtime_ns - 10**9))
+    _cmd_batch(manifest_file=manifest_file, jobs=4)
+    assert os.stat(str(tmp_path / "template0.xml")).st_mtime_ns == mtime_ns - 10**9
+    assert len(loaded) == 1  # Nor is bort.properties parsed again
+
+    # A failing job doesn't stop the others:
+    os.remove(templates[0])
+    os.remove(str(tmp_path / "template1.xml"))
+    with pytest.raises(SystemExit) as excinfo:
+        _cmd_batch(manifest_file=manifest_file, jobs=4)
+    assert "template0.xml: Traceback" in str(excinfo.value)
+    assert os.path.exists(str(tmp_path / "template1.xml"))
+
+
+def test_batch_invalid_manifest(tmp_path):
+    manifest_file = str(tmp_path / "batch.json")
+    with pytest.raises(SystemExit, match="Failed to read batch manifest"):
+        _cmd_batch(manifest_file=manifest_file, jobs=1)
+
+    _write_file(manifest_file, "[")
+    with pytest.raises(SystemExit, match="Invalid batch manifest"):
+        _cmd_batch(manifest_file=manifest_file, jobs=1)
+
+    with open(manifest_file, "wb") as file:
+        file.write(b"\xff")
+    with pytest.raises(SystemExit, match="Invalid batch manifest"):
+        _cmd_batch(manifest_file=manifest_file, jobs=1)
+
+
+@pytest.mark.parametrize("jobs", ["0", "-1", "many"])
+def test_batch_jobs_must_be_positive(tmp_path, jobs):
+    process = subprocess.run(
+        [
+            sys.executable,
+            bort_src_gen.__file__,
+            "batch",
+            str(tmp_path / "batch.json"),
+            "--jobs",
+            jobs,
+        ],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert process.returncode == 2
+    assert "Not a positive integer: {!r}".format(jobs) in process.stderr
+
+
+def test_write_if_changed_sidecar(tmp_path, monkeypatch):
+    output_file = str(tmp_path / "output.xml")
+    reads = []
+    monkeypatch.setattr(
+        bort_src_gen,
+        "_read_file",
+        lambda path, read_file=_read_file: reads.append(path) or read_file(path),
+    )
+
+    # Small outputs are compared with their content:
+    _write_if_changed("content", output_file)
+    _write_if_changed("content", output_file)
+    assert os.listdir(str(tmp_path)) == ["output.xml"]
+
+    monkeypatch.setattr(bort_src_gen, "SIDECAR_MIN_SIZE", len("content"))
+    # New outputs (e.g. in the sandbox of a genrule) don't get a sidecar either:
+    os.remove(output_file)
+    _write_if_changed("content", output_file)
+    assert os.listdir(str(tmp_path)) == ["output.xml"]
+
+    _write_if_changed("content", output_file)
+    assert os.path.exists(str(tmp_path / ".output.xml.sha256"))
+    # Make sure the output is older than its sidecar, whatever the mtime granularity:
+    os.utime(output_file, (0, 0))
+    _write_if_changed("content", output_file)
+    assert os.stat(output_file).st_mtime == 0
+
+    reads.clear()
+    _write_if_changed("content", output_file)
+    assert os.stat(output_file).st_mtime == 0
+    assert output_file not in reads
+
+    with open(output_file, "w") as file:
+        file.write("modified")
+    _write_if_changed("content", output_file)
+    assert _read_file(output_file) == "content"
+
+
+def test_template(tmp_path, monkeypatch):
+    # A template of several chunks, with a placeholder across the first boundary:
+    input_file = str(tmp_path / "template.xml.in")
+    output_file = str(tmp_path / "template.xml")
+    _write_file(
+        input_file,
+        "x" * (bort_common.CHUNK_SIZE - 5) + "$BORT_APPLICATION_ID" + "y" * bort_common.CHUNK_SIZE,
+    )
+    expected = "x" * (bort_common.CHUNK_SIZE - 5) + "com.app" + "y" * bort_common.CHUNK_SIZE
+    replacements = {"$BORT_APPLICATION_ID": Replacement("BORT_APPLICATION_ID", "com.app")}
+
+    bort_src_gen._template(input_file, output_file, replacements)
+    assert _read_file(output_file) == expected
+
+    # Unchanged outputs are not touched:
+    os.utime(output_file, (0, 0))
+    bort_src_gen._template(input_file, output_file, replacements)
+    assert os.stat(output_file).st_mtime == 0
+
+    # Outputs that differ anywhere are rewritten:
+    for content in (expected[:-1] + "z", expected + "z", expected[:-1], "", expected[:10]):
+        _write_file(output_file, content)
+        bort_src_gen._template(input_file, output_file, replacements)
+        assert _read_file(output_file) == expected
+    assert sorted(os.listdir(str(tmp_path))) == ["template.xml", "template.xml.in"]
+
+    # Large outputs that existed get a sidecar, with which they are not compared again:
+    monkeypatch.setattr(bort_src_gen, "SIDECAR_MIN_SIZE", len(expected))
+    os.utime(output_file, (0, 0))
+    bort_src_gen._template(input_file, output_file, replacements)
+    assert os.path.exists(str(tmp_path / ".template.xml.sha256"))
+    writes = []
+    monkeypatch.setattr(
+        bort_src_gen, "_write_chunks_if_changed", lambda *args: writes.append(args) or True
+    )
+    bort_src_gen._template(input_file, output_file, replacements)
+    assert writes == []
+
+
+# bort_src_gen.py runs for every generated file of the build, so its startup cost adds up. Wall
+# clock times depend on the machine and its load, so they are only checked on request:
+TIMING_TESTS_ENV = "BORT_TIMING_TESTS"
+IMPORT_TIME_BUDGET_US = 100 * 1000
+# Modules that the template and cpp-header subcommands don't need:
+SLOW_IMPORTS = {
+    "concurrent.futures",
+    "json",
+    "pytest",
+    "subprocess",
+    "tempfile",
+    "threading",
+    "traceback",
+    "typing",
+}
+
+
+def _import_times(*args, cwd):
+    """
+    Runs python with -X importtime, returning the cumulative import time (in µs) of every module.
+    """
+    env = dict(os.environ)
+    env.pop(bort_src_gen.TRACE_FILE_ENV, None)
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=cwd,
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    import_times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and not line.endswith("imported package"):
+            _, cumulative_us, name = line[len("import time:") :].split("|")
+            import_times[name.strip()] = int(cumulative_us)
+    return import_times
+
+
+def test_import_time():
+    import_times = _import_times(
+        "-c", "import bort_src_gen", cwd=os.path.dirname(bort_src_gen.__file__)
+    )
+    assert not SLOW_IMPORTS & set(import_times)
+
+
+@pytest.mark.skipif(
+    not os.environ.get(TIMING_TESTS_ENV),
+    reason="Set {} to run timing tests".format(TIMING_TESTS_ENV),
+)
+def test_import_time_budget():
+    import_times = _import_times(
+        "-c", "import bort_src_gen", cwd=os.path.dirname(bort_src_gen.__file__)
+    )
+    assert import_times["bort_src_gen"] < IMPORT_TIME_BUDGET_US
+
+
+def test_cpp_header_imports(tmp_path):
+    _write_file(
+        str(tmp_path / "bort.properties"),
+        "BORT_APPLICATION_ID=com.app\nBORT_OTA_APPLICATION_ID=com.app.ota\n",
+    )
+    import_times = _import_times(
+        bort_src_gen.__file__,
+        "cpp-header",
+        str(tmp_path / "bort_properties.h"),
+        str(tmp_path / "bort.properties"),
+        cwd=str(tmp_path),
+    )
+    assert "#define BORT_APPLICATION_ID com.app\n" in _read_file(
+        str(tmp_path / "bort_properties.h")
+    )
+    assert not SLOW_IMPORTS & set(import_times)
+
+
+# Self-signed test certificate, and a PKCS #7 signature (as in JAR signature block files) made with
+# its key by `openssl cms -sign -binary -noattr -outform DER`:
+TEST_CERTIFICATE_PEM = """\
+-----BEGIN CERTIFICATE-----
+MIIBfjCCASWgAwIBAgIUWzVXbm/LJQePZ6m0KIP+0deyRpYwCgYIKoZIzj0EAwIw
+FDESMBAGA1UEAwwJQm9ydCBUZXN0MCAXDTI2MTAxODIwNDc0M1oYDzIxMjYwOTI0
+MjA0NzQzWjAUMRIwEAYDVQQDDAlCb3J0IFRlc3QwWTATBgcqhkjOPQIBBggqhkjO
+PQMBBwNCAARuJySgZxUCefA04hj1LDT9z6Wdh8nPtKIXHJQdOCSXX9kIId4SIG7a
+ZwejsnZ2g8bux+1dvGg3xxHCsmHbsgtao1MwUTAdBgNVHQ4EFgQU0iK4w+kAsnuk
+vdaNFFbqXTdrc1kwHwYDVR0jBBgwFoAU0iK4w+kAsnukvdaNFFbqXTdrc1kwDwYD
+VR0TAQH/BAUwAwEB/zAKBggqhkjOPQQDAgNHADBEAiBcnSiSBmxYmRvtDajFgVho
+ulm4v2i5s0g0/bPrUKjStwIgOoXfpg1TZV4pFoQ6PHGe0qFBzPoe4rGJ/MDBsDxa
+0Q4=
+-----END CERTIFICATE-----
+"""
+TEST_CERTIFICATE_SHA256 = "C2:B9:B0:3F:3A:15:AB:A9:AB:E0:46:B3:D7:2F:DC:71:DF:F4:CD:2D:90:59:53:A4:7E:68:C1:D6:0D:91:8A:12"
+TEST_PKCS7_SIGNATURE = base64.b64decode(
+    "MIICUgYJKoZIhvcNAQcCoIICQzCCAj8CAQExDTALBglghkgBZQMEAgEwCwYJKoZIhvcNAQcBoIIBgjCCAX4wggEloAMC"
+    "AQICFFs1V25vyyUHj2eptCiD/tHXskaWMAoGCCqGSM49BAMCMBQxEjAQBgNVBAMMCUJvcnQgVGVzdDAgFw0yNjEwMTgy"
+    "MDQ3NDNaGA8yMTI2MDkyNDIwNDc0M1owFDESMBAGA1UEAwwJQm9ydCBUZXN0MFkwEwYHKoZIzj0CAQYIKoZIzj0DAQcD"
+    "QgAEbickoGcVAnnwNOIY9Sw0/c+lnYfJz7SiFxyUHTgkl1/ZCCHeEiBu2mcHo7J2doPG7sftXbxoN8cRwrJh27ILWqNT"
+    "MFEwHQYDVR0OBBYEFNIiuMPpALJ7pL3WjRRW6l03a3NZMB8GA1UdIwQYMBaAFNIiuMPpALJ7pL3WjRRW6l03a3NZMA8G"
+    "A1UdEwEB/wQFMAMBAf8wCgYIKoZIzj0EAwIDRwAwRAIgXJ0okgZsWJkb7Q2oxYFYaLpZuL9oubNINP2z61Co0rcCIDqF"
+    "36YNU2VeKRaEOjxxntKhQcz6HuKxifzAwbA8WtEOMYGXMIGUAgEBMCwwFDESMBAGA1UEAwwJQm9ydCBUZXN0AhRbNVdu"
+    "b8slB49nqbQog/7R17JGljALBglghkgBZQMEAgEwCgYIKoZIzj0EAwIESDBGAiEA8sJ4M7vwbLg6MHSnNxHZvwTVfk4n"
+    "jx3UIlIO1fx+KrQCIQDd7E4g7FD0iUBgbXpBe+uublPFGXGxFX0iPDAeHfHQPQ=="
+)
+
+
+def _read_certificate_from_string(pem):
+    return base64.b64decode("".join(pem.splitlines()[1:-1]))
+
+
+def _length_prefixed(data):
+    return struct.pack("<I", len(data)) + data
+
+
+def _write_apk(apk_file, signature_schemes=(), jar_signature=None):
+    """
+    Writes an APK with the given (id, certificate) APK Signature Scheme blocks in its APK Signing
+    Block, and the given v1 (JAR) signature block file.
+    """
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as apk_zip:
+        apk_zip.writestr("AndroidManifest.xml", b"manifest")
+        if jar_signature:
+            apk_zip.writestr("META-INF/CERT.EC", jar_signature)
+    content = content.getvalue()
+
+    if signature_schemes:
+        pairs = b""
+        for scheme_id, certificate in signature_schemes:
+            signed_data = (
+                _length_prefixed(_length_prefixed(b"digest"))
+                + _length_prefixed(_length_prefixed(certificate))
+                + _length_prefixed(b"")
+            )
+            signer = _length_prefixed(signed_data) + _length_prefixed(b"signatures")
+            value = _length_prefixed(_length_prefixed(signer))
+            pairs += struct.pack("<QI", len(value) + 4, scheme_id) + value
+        size = len(pairs) + 24
+        block = struct.pack("<Q", size) + pairs + struct.pack("<Q", size) + b"APK Sig Block 42"
+        eocd = content.rfind(b"PK\x05\x06")
+        (cd_offset,) = struct.unpack_from("<I", content, eocd + 16)
+        content = (
+            content[:cd_offset]
+            + block
+            + content[cd_offset : eocd + 16]
+            + struct.pack("<I", cd_offset + len(block))
+            + content[eocd + 20 :]
+        )
+
+    with open(apk_file, "wb") as file:
+        file.write(content)
+
+
+def test_read_apk_signer_certificates(tmp_path):
+    certificate = _read_certificate_from_string(TEST_CERTIFICATE_PEM)
+    apk_file = str(tmp_path / "MemfaultBort.apk")
+
+    _write_apk(apk_file, signature_schemes=[(0x7109871A, certificate)])
+    assert _read_apk_signer_certificates(apk_file) == [certificate]
+
+    # v3 is preferred over v2:
+    _write_apk(apk_file, signature_schemes=[(0x7109871A, b"v2"), (0xF05368C0, certificate)])
+    assert _read_apk_signer_certificates(apk_file) == [certificate]
+
+    # Without an APK Signing Block, the v1 signature is used:
+    _write_apk(apk_file, jar_signature=TEST_PKCS7_SIGNATURE)
+    assert _read_apk_signer_certificates(apk_file) == [certificate]
+
+    _write_apk(apk_file)
+    with pytest.raises(Exception, match="is not signed"):
+        _read_apk_signer_certificates(apk_file)
+
+    # Signers identified by the subject key identifier of their certificate:
+    _write_apk(
+        apk_file,
+        jar_signature=_pkcs7_with_subject_key_identifier(
+            TEST_PKCS7_SIGNATURE, base64.b64decode("0iK4w+kAsnukvdaNFFbqXTdrc1k=")
+        ),
+    )
+    assert _read_apk_signer_certificates(apk_file) == [certificate]
+
+
+def _der(tag, content):
+    if len(content) < 0x80:
+        return bytes([tag, len(content)]) + content
+    length = len(content).to_bytes((len(content).bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(length)]) + length + content
+
+
+def _pkcs7_with_subject_key_identifier(pkcs7, subject_key_identifier):
+    """
+    Re-encodes a PKCS #7 SignedData with one signer to identify it by subject key identifier
+    instead of by issuer and serial number.
+    """
+    _, start, end = bort_src_gen._read_der(pkcs7, 0)
+    oid, explicit = bort_src_gen._der_children(pkcs7, start, end)
+    _, start, end = bort_src_gen._read_der(pkcs7, explicit[2])
+    signed_data = bort_src_gen._der_children(pkcs7, start, end)
+    (signer_info,) = bort_src_gen._der_children(pkcs7, signed_data[-1][2], signed_data[-1][3])
+    fields = [
+        pkcs7[start:end]
+        for _, start, _, end in bort_src_gen._der_children(pkcs7, signer_info[2], signer_info[3])
+    ]
+    fields[1] = _der(0x80, subject_key_identifier)
+    signed_data = b"".join(pkcs7[start:end] for _, start, _, end in signed_data[:-1]) + _der(
+        0x31, _der(0x30, b"".join(fields))
+    )
+    return _der(0x30, pkcs7[oid[1] : oid[3]] + _der(0xA0, _der(0x30, signed_data)))
+
+
+def test_read_apk_signer_certificates_malformed(tmp_path):
+    certificate = _read_certificate_from_string(TEST_CERTIFICATE_PEM)
+    apk_file = str(tmp_path / "MemfaultBort.apk")
+    _write_apk(apk_file, signature_schemes=[(0x7109871A, certificate)])
+    with open(apk_file, "rb") as file:
+        apk = file.read()
+    _write_apk(apk_file, jar_signature=TEST_PKCS7_SIGNATURE)
+    with open(apk_file, "rb") as file:
+        v1_apk = file.read()
+
+    malformed = [b"", b"PK\x05\x06\x00\x00", apk[:-10], v1_apk[:-10]]
+    # Truncated or corrupted at every offset:
+    for content in (apk, v1_apk):
+        for offset in range(0, len(content), 7):
+            malformed.append(content[:offset] + content[-ZIP_EOCD_SIZE:])
+            malformed.append(content[:offset] + b"\xff" + content[offset + 1 :])
+    for content in malformed:
+        with open(apk_file, "wb") as file:
+            file.write(content)
+        try:
+            _read_apk_signer_certificates(apk_file)
+        except Exception as e:
+            assert type(e) is Exception, content
+
+    with pytest.raises(Exception, match="Failed to extract certificates from") as excinfo:
+        _cmd_check_signature(
+            output_file=str(tmp_path / "check"),
+            apk_file=apk_file,
+            pem_file=apk_file,
+            native=True,
+        )
+    assert type(excinfo.value.__cause__) is Exception
+
+
+def test_read_certificate(tmp_path):
+    pem_file = str(tmp_path / "MemfaultBort.x509.pem")
+    _write_file(pem_file, "Bag Attributes\n" + TEST_CERTIFICATE_PEM)
+    assert _sha256_fingerprint(_read_certificate(pem_file)) == TEST_CERTIFICATE_SHA256
+
+    der_file = str(tmp_path / "MemfaultBort.x509.der")
+    with open(der_file, "wb") as file:
+        file.write(_read_certificate_from_string(TEST_CERTIFICATE_PEM))
+    assert _sha256_fingerprint(_read_certificate(der_file)) == TEST_CERTIFICATE_SHA256
+
+
+def test_cmd_check_signature(tmp_path):
+    apk_file = str(tmp_path / "MemfaultBort.apk")
+    pem_file = str(tmp_path / "MemfaultBort.x509.pem")
+    output_file = str(tmp_path / "check")
+    _write_apk(apk_file, jar_signature=TEST_PKCS7_SIGNATURE)
+    _write_file(pem_file, TEST_CERTIFICATE_PEM)
+
+    _cmd_check_signature(output_file=output_file, apk_file=apk_file, pem_file=pem_file, native=True)
+    assert _read_file(output_file) == "OK: {}".format(TEST_CERTIFICATE_SHA256)
+
+    _write_apk(apk_file, signature_schemes=[(0x7109871A, b"other certificate")])
+    with pytest.raises(SystemExit, match="signature does not match"):
+        _cmd_check_signature(
+            output_file=output_file, apk_file=apk_file, pem_file=pem_file, native=True
+        )
+
+    with pytest.raises(Exception, match="Failed to extract certificates from"):
+        _cmd_check_signature(
+            output_file=output_file, apk_file=pem_file, pem_file=pem_file, native=True
+        )
+
+
+def test_cmd_check_signature_verifies_with_apksigner_by_default(tmp_path, monkeypatch):
+    output_file = str(tmp_path / "check")
+    calls = []
+
+    def _run_apksigner(*args):
+        calls.append(args)
+        return "Signer #1 certificate SHA-256 digest: {}\n".format(
+            TEST_CERTIFICATE_SHA256.replace(":", "").lower()
+        )
+
+    def _run_keytool(*args):
+        calls.append(args)
+        output = "Certificate fingerprints:\n\tSHA256: {}\n".format(TEST_CERTIFICATE_SHA256)
+        return output, ["keytool"]
+
+    monkeypatch.setattr(bort_src_gen, "_run_apksigner", _run_apksigner)
+    monkeypatch.setattr(bort_src_gen, "_run_keytool", _run_keytool)
+    _cmd_check_signature(output_file=output_file, apk_file="app.apk", pem_file="cert.pem")
+    assert calls == [("verify", "--print-certs", "app.apk"), ("-printcert", "-file", "cert.pem")]
+    assert _read_file(output_file) == "OK: {}".format(TEST_CERTIFICATE_SHA256)
+
+
+def test_cmd_check_signature_cache(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv(SIGNATURE_CACHE_DIR_ENV, str(cache_dir))
+    apk_file = str(tmp_path / "MemfaultBort.apk")
+    pem_file = str(tmp_path / "MemfaultBort.x509.pem")
+    output_file = str(tmp_path / "check")
+    _write_apk(apk_file, jar_signature=TEST_PKCS7_SIGNATURE)
+    _write_file(pem_file, TEST_CERTIFICATE_PEM)
+
+    _cmd_check_signature(output_file=output_file, apk_file=apk_file, pem_file=pem_file, native=True)
+    assert len(os.listdir(str(cache_dir))) == 1
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("certificates read despite cache hit")
+
+    # Same contents, different paths & timestamps: served from the cache
+    monkeypatch.setattr(bort_src_gen, "_read_apk_signer_certificates", _fail)
+    copy_file = str(tmp_path / "copy.apk")
+    with open(apk_file, "rb") as src, open(copy_file, "wb") as dst:
+        dst.write(src.read())
+    os.remove(output_file)
+    _cmd_check_signature(
+        output_file=output_file, apk_file=copy_file, pem_file=pem_file, native=True
+    )
+    assert _read_file(output_file) == "OK: {}".format(TEST_CERTIFICATE_SHA256)
+
+    # Different contents: a miss
+    _write_apk(apk_file, signature_schemes=[(0x7109871A, b"other certificate")])
+    with pytest.raises(Exception, match="Failed to extract certificates from"):
+        _cmd_check_signature(
+            output_file=output_file, apk_file=apk_file, pem_file=pem_file, native=True
+        )
+
+
+def test_signature_cache_eviction(tmp_path):
+    cache = SignatureCache(str(tmp_path), max_bytes=200)
+    for i in range(4):
+        cache.store("key{}".format(i), ["AA:{}".format(i)], "BB")
+        os.utime(str(tmp_path / "key{}.json".format(i)), (i, i))
+    assert cache.load("key0") == (["AA:0"], "BB")  # Now the most recently used
+    cache.store("key4", ["AA:4"], "BB")
+
+    assert sorted(os.listdir(str(tmp_path))) == ["key0.json", "key2.json", "key3.json", "key4.json"]
+    assert cache.load("key1") is None
+
+
+def test_signature_cache_stale_tmp_files(tmp_path, monkeypatch):
+    cache = SignatureCache(str(tmp_path), max_bytes=200)
+    stale_file = tmp_path / "stale.tmp"
+    stale_file.write_text("x" * 1000)
+    os.utime(str(stale_file), (0, 0))
+
+    def _fail(src, dst):
+        raise PermissionError(dst)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", _fail)
+        cache.store("key0", ["AA:0"], "BB")
+    assert os.listdir(str(tmp_path)) == ["stale.tmp"]
+
+    cache.store("key1", ["AA:1"], "BB")
+    assert os.listdir(str(tmp_path)) == ["key1.json"]
+
+
+def test_signature_cache_file_digests(tmp_path, monkeypatch):
+    cache = SignatureCache(str(tmp_path / "cache"))
+    apk_file = tmp_path / "MemfaultBort.apk"
+    pem_file = tmp_path / "MemfaultBort.x509.pem"
+    apk_file.write_bytes(b"apk")
+    pem_file.write_bytes(b"")
+    key = cache.key(str(apk_file), str(pem_file), "native")
+    assert not (tmp_path / "cache").exists()  # Just modified: not recorded
+
+    for path in (apk_file, pem_file):
+        os.utime(str(path), (1000, 1000))
+    assert cache.key(str(apk_file), str(pem_file), "native") == key
+    assert len(os.listdir(str(tmp_path / "cache"))) == 2
+
+    # Unchanged files are not read again
+    def _open(path, *args, **kwargs):
+        assert path not in (str(apk_file), str(pem_file)), "read despite its recorded digest"
+        return open(path, *args, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(bort_src_gen, "open", _open, raising=False)
+        assert cache.key(str(apk_file), str(pem_file), "native") == key
+
+    apk_file.write_bytes(b"new apk")
+    os.utime(str(apk_file), (1000, 1000))
+    assert cache.key(str(apk_file), str(pem_file), "native") != key
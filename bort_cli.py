@@ -2,19 +2,53 @@
 # -*- coding: utf-8 -*
 import abc
 import argparse  # requires Python 3.2+
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import datetime
+import filecmp
+import functools
 import glob
+import hashlib
+import json
 import logging
 import logging.handlers
 import os
+import pathlib
 import platform
 import re
 import shlex
 import shutil
+import socket
+import sqlite3
 import subprocess
 import sys
 import tempfile
-from typing import Any, Iterable, List, Optional, Tuple
+import threading
+import time
+import uuid
+import xml.etree.ElementTree
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    IO,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "MemfaultPackages"))
+from bort_common import TRACE_FILE_ENV, JavaProperties, PlaceholderReplacer, Tracer  # noqa: E402
 
 LOG_FILE = "validate-sdk-integration.log"
 
@@ -26,6 +60,21 @@ PLACEHOLDER_BORT_APP_ID = "vnd.myandroid.bortappid"
 PLACEHOLDER_BORT_OTA_APP_ID = "vnd.myandroid.bort.otaappid"
 PLACEHOLDER_FEATURE_NAME = "vnd.myandroid.bortfeaturename"
 RELEASES = range(8, 12 + 1)
+ANDROID_RELEASE_AUTO = "auto"
+# Files of the MemfaultPackages folder that patch-bort replaces placeholders in:
+PATCH_BORT_FILES = ["bort.properties"]
+# Build outputs of the gradle projects that the variants of MemfaultPackages created by patch-bort
+# must not share:
+PATCH_BORT_VARIANT_SKIP_DIRS = {".gradle", "build"}
+GRADLE_PROJECT_FILES = {
+    "build.gradle",
+    "build.gradle.kts",
+    "settings.gradle",
+    "settings.gradle.kts",
+}
+# Files that are written in place in each variant (e.g. the SDK location that Android Studio and
+# gradle write), which must not be hard links to the original ones:
+PATCH_BORT_VARIANT_COPY_FILES = ["local.properties"]
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 GRADLE_PROPERTIES = os.path.join(SCRIPT_DIR, "MemfaultPackages", "gradle.properties")
 PYTHON_MIN_VERSION = (3, 6, 0)
@@ -40,9 +89,46 @@ MEMFAULT_DUMPSTER_RC_PATH = "/etc/init/memfault_dumpster.rc"
 MEMFAULT_STRUCTURED_RC_PATH = "/etc/init/memfault_structured_logd.rc"
 MEMFAULT_STRUCTURED_DATA_PATH = "/data/system/MemfaultStructuredLogd/"
 MEMFAULT_STRUCTURED_EXEC_PATH = "/system/bin/MemfaultStructuredLogd"
+MEMFAULT_STRUCTURED_DB_PATH = MEMFAULT_STRUCTURED_DATA_PATH + "log.db"
+# Where export-structured-logs snapshots the database on the device, to pull it:
+STRUCTURED_LOGS_SNAPSHOT_PATH = "/data/local/tmp/memfault_structured_logs.db"
 BORT_APK_PATH = r"package:/system/priv-app/MemfaultBort/MemfaultBort.apk"
 VENDOR_CIL_PATH = "/vendor/etc/selinux/vendor_sepolicy.cil"
 LOG_ENTRY_SEPARATOR = "============================================================"
+REPORT_FILE_EXTENSIONS = {
+    "json": ".json",
+    "junit": ".xml",
+}
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "memfault-bort",
+)
+DEVICE_FACT_CACHE_DIR = os.path.join(CACHE_DIR, "device-facts")
+# Outcome of every check of the last validation of a device build, for --rerun-failed:
+DEVICE_RESULT_STATE_DIR = os.path.join(CACHE_DIR, "device-results")
+DEVICE_FACT_CACHE_TTL = 7 * 24 * 60 * 60
+DEVICE_FACT_CACHE_MAX_BYTES = 4 * 1024 * 1024
+# Fingerprints of the device build that key the device fact cache. Partitions can be flashed on
+# their own (e.g. vendor.img during sepolicy bring-up), which only changes their own fingerprint:
+BUILD_FINGERPRINT_PROPS = (
+    "ro.build.fingerprint",
+    "ro.vendor.build.fingerprint",
+    "ro.product.build.fingerprint",
+)
+# adb shell commands whose output cannot change without reflashing the device:
+STATIC_SHELL_CMDS = (
+    ("getprop", "ro.build.version.sdk"),
+    ("getprop", "ro.build.type"),
+    ("pm", "list", "features"),
+)
+# Bounds of the polling interval of validate-sdk-integration --watch, in seconds:
+WATCH_INTERVAL = 10
+WATCH_MAX_INTERVAL = 300
+# Rows that export-structured-logs fetches from the database at a time:
+STRUCTURED_LOGS_CHUNK_ROWS = 1000
+STRUCTURED_LOGS_FORMATS = ("ndjson", "csv")
+# Lines of output kept to report a failed check whose output was matched while it was produced:
+STREAMED_OUTPUT_TAIL_LINES = 50
 
 
 def shlex_join(cmd):
@@ -62,6 +148,18 @@ def readable_dir_type(path):
     raise argparse.ArgumentTypeError("Couldn't find/access directory %r" % path)
 
 
+def android_release_type(arg):
+    """
+    Argument type for Android releases, or "auto" to detect the release
+    """
+    if arg == ANDROID_RELEASE_AUTO:
+        return arg
+    try:
+        return int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Not an Android release: %r" % arg)
+
+
 def shell_command_type(arg):
     """
     Argument type for shell commands
@@ -78,6 +176,21 @@ def shell_command_type(arg):
     return parts
 
 
+def positive_int_type(arg):
+    """
+    Argument type for positive integers
+    """
+    try:
+        value = int(arg)
+    except ValueError:
+        value = 0
+
+    if value < 1:
+        raise argparse.ArgumentTypeError("Not a positive integer: %r" % arg)
+
+    return value
+
+
 def android_application_id_type(arg):
     """
     Argument type for Android Application ID
@@ -88,20 +201,25 @@ def android_application_id_type(arg):
     return arg
 
 
-def _replace_placeholders(content, mapping):
-    for placeholder, value in mapping.items():
-        content = content.replace(placeholder, value)
+_tracer = Tracer()
+
 
+def _read_file(path: str) -> str:
+    with _tracer.span("read", "file", path=path) as span_args:
+        with open(path) as file:
+            content = file.read()
+        span_args["bytes"] = len(content.encode(DEFAULT_ENCODING))
     return content
 
 
+def _write_file(path: str, content: str) -> None:
+    with _tracer.span("write", "file", path=path, bytes=len(content.encode(DEFAULT_ENCODING))):
+        with open(path, "w") as file:
+            file.write(content)
+
+
 def _get_bort_version():
-    properties = {}
-    with open(GRADLE_PROPERTIES) as properties_file:
-        for line in properties_file:
-            matches = re.match(r"^([A-Z_]+)=(.*)\s+$", line)
-            if matches:
-                properties[matches.group(1)] = matches.group(2)
+    properties = JavaProperties.load(GRADLE_PROPERTIES)
     return "%s.%s.%s" % (
         properties["UPSTREAM_MAJOR_VERSION"],
         properties["UPSTREAM_MINOR_VERSION"],
@@ -123,16 +241,522 @@ class Command(abc.ABC):
         pass
 
 
+# Record of the patches applied by patch-aosp, kept at the root of the AOSP tree:
+PATCH_STATE_FILE = ".bort-patch-aosp-state.json"
+# Files modified less than this many seconds ago are read instead of trusting their mtime:
+PATCH_STATE_MTIME_GRANULARITY = 2
+# Like GNU patch, allow up to this many lines of context at either end of a hunk to not match:
+PATCH_MAX_FUZZ = 2
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class _PatchError(Exception):
+    pass
+
+
+def _split_lines(text: str) -> List[str]:
+    """
+    Splits text into lines, keeping their line endings. Unlike str.splitlines, only splits at "\n".
+    """
+    lines = [line + "\n" for line in text.split("\n")]
+    last = lines.pop()[:-1]
+    if last:
+        lines.append(last)
+    return lines
+
+
+class _Hunk:
+    def __init__(self, old_start: int, new_start: int) -> None:
+        self.old_start = old_start
+        self.new_start = new_start
+        self.old: List[str] = []
+        self.new: List[str] = []
+        self.leading_context = 0
+        self.trailing_context = 0
+
+    @property
+    def old_index(self) -> int:
+        # Hunks without old lines insert after line old_start:
+        return self.old_start - 1 if self.old else self.old_start
+
+    def reversed(self) -> "_Hunk":
+        hunk = _Hunk(self.new_start, self.old_start)
+        hunk.old, hunk.new = self.new, self.old
+        hunk.leading_context, hunk.trailing_context = self.leading_context, self.trailing_context
+        return hunk
+
+
+class _FilePatch:
+    def __init__(self, old_path: Optional[str], new_path: Optional[str]) -> None:
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks: List[_Hunk] = []
+
+    @property
+    def path(self) -> str:
+        return self.new_path or self.old_path
+
+
+def _strip_patch_path(header: str, strip: int) -> Optional[str]:
+    path = header.rstrip("\r\n").split("\t")[0]
+    if path == "/dev/null":
+        return None
+    return "/".join(path.split("/")[strip:])
+
+
+def _parse_hunk(lines: List[str], idx: int, header: Match) -> Tuple[_Hunk, int]:
+    hunk = _Hunk(int(header.group(1)), int(header.group(3)))
+    old_left = int(header.group(2) or 1)
+    new_left = int(header.group(4) or 1)
+    tags = []
+    idx += 1
+    while old_left > 0 or new_left > 0 or (idx < len(lines) and lines[idx].startswith("\\")):
+        if idx >= len(lines):
+            raise _PatchError(f"Truncated hunk at line {idx}")
+        line = lines[idx]
+        idx += 1
+        # Some tools strip the trailing whitespace of empty context lines:
+        tag, text = (" ", line) if line in ("\n", "\r\n") else (line[:1], line[1:])
+        if tag == "\\":
+            # "\ No newline at end of file", which applies to the preceding line:
+            if not tags:
+                raise _PatchError(f"Unexpected line {idx} in hunk: {line!r}")
+            if tags[-1] in " -":
+                hunk.old[-1] = hunk.old[-1].rstrip("\r\n")
+            if tags[-1] in " +":
+                hunk.new[-1] = hunk.new[-1].rstrip("\r\n")
+            continue
+        if tag == " ":
+            hunk.old.append(text)
+            hunk.new.append(text)
+            old_left -= 1
+            new_left -= 1
+        elif tag == "-":
+            hunk.old.append(text)
+            old_left -= 1
+        elif tag == "+":
+            hunk.new.append(text)
+            new_left -= 1
+        else:
+            raise _PatchError(f"Unexpected line {idx} in hunk: {line!r}")
+        if old_left < 0 or new_left < 0:
+            raise _PatchError(f"Hunk at line {idx} is longer than its header says")
+        tags.append(tag)
+
+    hunk.leading_context = next((n for n, tag in enumerate(tags) if tag != " "), len(tags))
+    hunk.trailing_context = next(
+        (n for n, tag in enumerate(reversed(tags)) if tag != " "), len(tags)
+    )
+    return hunk, idx
+
+
+def _parse_unified_diff(content: str, strip: int = 1) -> List[_FilePatch]:
+    """
+    Parses a unified diff, as produced by `git diff`, ignoring any text around the file patches.
+    Paths are stripped of `strip` leading components, like `patch -p<strip>` does.
+    """
+    lines = _split_lines(content)
+    file_patches: List[_FilePatch] = []
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx]
+        if line.startswith("--- ") and idx + 1 < len(lines) and lines[idx + 1].startswith("+++ "):
+            file_patches.append(
+                _FilePatch(
+                    _strip_patch_path(line[4:], strip), _strip_patch_path(lines[idx + 1][4:], strip)
+                )
+            )
+            idx += 2
+            continue
+        header = _HUNK_HEADER.match(line)
+        if header:
+            if not file_patches:
+                raise _PatchError(f"Hunk without a file header at line {idx + 1}")
+            hunk, idx = _parse_hunk(lines, idx, header)
+            file_patches[-1].hunks.append(hunk)
+            continue
+        idx += 1
+
+    if not file_patches:
+        raise _PatchError("No file patches found")
+    return file_patches
+
+
+def _matches_hunk(lines: List[str], old: List[str], pos: int, prefix: int, suffix: int) -> bool:
+    """
+    Whether the old lines of a hunk, but for `prefix` and `suffix` lines of context at either end,
+    are the lines of the file at the position of the hunk's first old line.
+    """
+    if pos + prefix < 0 or pos + len(old) - suffix > len(lines):
+        return False
+    return lines[pos + prefix : pos + len(old) - suffix] == old[prefix : len(old) - suffix]
+
+
+def _locate_hunk(
+    lines: List[str], hunk: _Hunk, fuzz: int, expected: int, frozen: int
+) -> Optional[int]:
+    """
+    Finds the position of the hunk's first old line in `lines`, ignoring `fuzz` lines of context,
+    like locate_hunk of GNU patch. The hunk must lie within the file, and may not start before
+    `frozen`, the number of lines that earlier hunks already consumed. Positions closest to
+    `expected` are tried first.
+    """
+    old = hunk.old
+    if not old:
+        return expected
+    context = max(hunk.leading_context, hunk.trailing_context)
+    prefix = fuzz + hunk.leading_context - context
+    suffix = fuzz + hunk.trailing_context - context
+    lowest = max(frozen, 0)
+    highest = len(lines) - (len(old) - suffix)
+
+    # A hunk with less context at one end than at the other must be at that end of the file:
+    if prefix < 0 and hunk.old_start <= 1:
+        if suffix < 0 and (len(old) != len(lines) or hunk.leading_context < frozen):
+            return None
+        if frozen <= hunk.leading_context and highest >= 0:
+            if _matches_hunk(lines, old, 0, 0, max(suffix, 0)):
+                return 0
+        return None
+    prefix = max(prefix, 0)
+    if suffix < 0:
+        pos = len(lines) - len(old)
+        if pos >= lowest and _matches_hunk(lines, old, pos, prefix, 0):
+            return pos
+        return None
+
+    for distance in range(max(highest - expected, expected - lowest) + 1):
+        for pos in (expected + distance, expected - distance) if distance else (expected,):
+            if lowest <= pos <= highest and _matches_hunk(lines, old, pos, prefix, suffix):
+                return pos
+    return None
+
+
+def _patch_lines(lines: List[str], hunks: List[_Hunk]) -> Tuple[Optional[List[str]], List[str]]:
+    """
+    Applies hunks to the lines of a file, like GNU patch: a hunk may be found away from the lines
+    its header names (offset), and with up to PATCH_MAX_FUZZ lines of context at either end not
+    matching (fuzz). Context lines are kept as they are in the file, and every hunk must come after
+    the lines that the previous one changed. Returns the patched lines, or None if a hunk could not
+    be found, and messages describing how the hunks were applied.
+    """
+    result: List[str] = []
+    messages = []
+    failed = False
+    # Lines of the file that precede the hunks applied so far, how many lines those hunks added,
+    # and how far they were found from where their headers say they are:
+    frozen = 0
+    added = 0
+    offset = 0
+    for number, hunk in enumerate(hunks, 1):
+        context = max(hunk.leading_context, hunk.trailing_context)
+        for fuzz in range(min(PATCH_MAX_FUZZ, context) + 1):
+            pos = _locate_hunk(lines, hunk, fuzz, hunk.old_index + offset, frozen)
+            if pos is not None:
+                break
+        # Hunks without old lines that are beyond the end of the file are appended to it:
+        if pos is None or pos + hunk.leading_context < frozen or (hunk.old and pos > len(lines)):
+            # Like GNU patch, carry on so that every hunk that does not apply gets reported:
+            messages.append(f"Hunk #{number} FAILED at {hunk.old_start + added}.")
+            failed = True
+            continue
+
+        # Like GNU patch, report where the hunk went in the patched file, and how far that is from
+        # where its header says it is in the original file:
+        offset = pos - hunk.old_index
+        if offset or fuzz:
+            message = f"Hunk #{number} succeeded at {pos + added + 1}"
+            if fuzz:
+                message += f" with fuzz {fuzz}"
+            if offset:
+                message += f" (offset {offset} line{'' if offset == 1 else 's'})"
+            messages.append(message + ".")
+        result.extend(lines[frozen : pos + hunk.leading_context])
+        new = hunk.new[hunk.leading_context : len(hunk.new) - hunk.trailing_context]
+        result.extend(new)
+        frozen = pos + len(hunk.old) - hunk.trailing_context
+        added += len(new) - (len(hunk.old) - hunk.leading_context - hunk.trailing_context)
+    result.extend(lines[frozen:])
+    return (None if failed else result), messages
+
+
+class _DiffCheck:
+    """
+    Outcome of checking a unified diff against a source tree. If the diff is applicable, holds the
+    patched content of every file it touches (None for files it deletes).
+    """
+
+    APPLIED = "applied"
+    APPLICABLE = "applicable"
+    CONFLICT = "conflict"
+
+    def __init__(
+        self, state: str, messages: List[str], results: Dict[str, Optional[List[str]]]
+    ) -> None:
+        self.state = state
+        self.messages = messages
+        self.results = results
+
+
+def _read_patch_target(path: str) -> Optional[str]:
+    try:
+        with _tracer.span("read", "file", path=path) as span_args:
+            # Keep the file as it is: its line endings and any bytes which are not valid UTF-8
+            with open(
+                path, encoding=DEFAULT_ENCODING, errors="surrogateescape", newline=""
+            ) as file:
+                content = file.read()
+            span_args["bytes"] = len(content)
+    except FileNotFoundError:
+        return None
+    return content
+
+
+def _check_unified_diff(file_patches: List[_FilePatch], root: str) -> _DiffCheck:
+    """
+    Finds out in a single pass over the target files whether the diff is already applied to the
+    tree at `root`, can be applied to it, or conflicts with it.
+    """
+    messages = []
+    states = set()
+    results: Dict[str, Optional[List[str]]] = {}
+    for file_patch in file_patches:
+        path = file_patch.path
+        messages.append(f"patching file {path}")
+        content = _read_patch_target(os.path.join(root, file_patch.old_path or path))
+        lines = _split_lines(content) if content else []
+        reversed_hunks = [hunk.reversed() for hunk in file_patch.hunks]
+
+        if file_patch.old_path is None:
+            # Created by the patch. Applied if the patch leaves nothing when reversed:
+            if content:
+                forward, forward_messages = None, [f"File {path} already exists"]
+            else:
+                forward, forward_messages = _patch_lines([], file_patch.hunks)
+            reverse = _patch_lines(lines, reversed_hunks)[0] if content else None
+            reverse = reverse if reverse == [] else None
+        elif content is None:
+            forward, forward_messages = None, [f"can't find file to patch: {path}"]
+            reverse = [] if file_patch.new_path is None else None
+        else:
+            forward, forward_messages = _patch_lines(lines, file_patch.hunks)
+            reverse, _ = _patch_lines(lines, reversed_hunks)
+            if file_patch.new_path is None:
+                # Deleted by the patch, which must remove all of its content:
+                forward = forward if forward == [] else None
+                reverse = None
+
+        if reverse is not None:
+            states.add(_DiffCheck.APPLIED)
+            messages.append("Reversed (or previously applied) patch detected!")
+        elif forward is not None:
+            states.add(_DiffCheck.APPLICABLE)
+            messages.extend(forward_messages)
+            results[path] = forward if file_patch.new_path else None
+        else:
+            states.add(_DiffCheck.CONFLICT)
+            messages.extend(forward_messages)
+
+    state = states.pop() if len(states) == 1 else _DiffCheck.CONFLICT
+    return _DiffCheck(state, messages, results)
+
+
+def _apply_diff_check(diff_check: _DiffCheck, root: str) -> None:
+    """
+    Writes the files patched by an applicable diff. Every file is replaced atomically, and only
+    once the new content of all of them was written.
+    """
+    replacements = []
+    try:
+        for path, lines in diff_check.results.items():
+            target = os.path.join(root, path)
+            if lines is None:
+                replacements.append((None, target))
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            content = "".join(lines)
+            with _tracer.span("write", "file", path=target, bytes=len(content)):
+                with tempfile.NamedTemporaryFile(
+                    "w",
+                    dir=os.path.dirname(target),
+                    prefix=".bort-patch-",
+                    encoding=DEFAULT_ENCODING,
+                    errors="surrogateescape",
+                    newline="",
+                    delete=False,
+                ) as file:
+                    replacements.append((file.name, target))
+                    file.write(content)
+                if os.path.exists(target):
+                    shutil.copymode(target, file.name)
+    except BaseException:
+        for temp_path, _ in replacements:
+            if temp_path:
+                os.remove(temp_path)
+        raise
+
+    for temp_path, target in replacements:
+        if temp_path:
+            os.replace(temp_path, target)
+        else:
+            os.remove(target)
+
+
+class _PatchState:
+    """
+    Record of the patches applied to an AOSP tree, kept at its root: for every patch, the digest
+    of its content (after placeholder substitution) and the size, mtime and digest of every file it
+    touched. A patch is known to still be applied as long as neither the patch nor those files
+    changed, which takes a few stat calls to find out instead of checking the patch again.
+    """
+
+    VERSION = 1
+
+    def __init__(self, aosp_root: str) -> None:
+        self._aosp_root = aosp_root
+        self._path = os.path.join(aosp_root, PATCH_STATE_FILE)
+        self._lock = threading.Lock()
+        self._patches: Dict[str, Dict[str, Any]] = {}
+        self._changed = False
+
+    @staticmethod
+    def digest(content: str) -> str:
+        return hashlib.sha256(content.encode(DEFAULT_ENCODING, "surrogateescape")).hexdigest()
+
+    def load(self) -> None:
+        try:
+            state = json.loads(_read_file(self._path))
+        except (OSError, ValueError):
+            return
+        if isinstance(state, dict) and state.get("version") == self.VERSION:
+            self._patches = state.get("patches", {})
+
+    def store(self) -> None:
+        if not self._changed:
+            return
+        content = json.dumps({"version": self.VERSION, "patches": self._patches}, indent=2)
+        try:
+            with _tracer.span("write", "file", path=self._path, bytes=len(content)):
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=self._aosp_root, prefix=PATCH_STATE_FILE, suffix=".tmp", delete=False
+                ) as file:
+                    file.write(content)
+                os.replace(file.name, self._path)
+            self._changed = False
+        except OSError as error:
+            logging.info("Failed to write %r: %s", self._path, error)
+
+    def is_applied(self, patch_relpath: str, digest: str) -> bool:
+        """
+        Whether the patch was applied by an earlier run, and neither it nor the files it touched
+        changed since.
+        """
+        with self._lock:
+            entry = self._patches.get(patch_relpath)
+        if entry is None or entry.get("digest") != digest:
+            return False
+
+        files = entry.get("files", {})
+        for path, recorded in files.items():
+            current = self._file_state(path, recorded)
+            if (current and current["sha256"]) != (recorded and recorded["sha256"]):
+                return False
+            if current is not recorded:
+                # Same content, but touched since: refresh its size and mtime.
+                with self._lock:
+                    files[path] = current
+                    self._changed = True
+        return True
+
+    def record(self, patch_relpath: str, digest: str, paths: Iterable[str]) -> None:
+        """
+        Records that the patch is applied, with the current state of the files it touched (relative
+        to the AOSP root).
+        """
+        files = {path: self._file_state(path) for path in paths}
+        with self._lock:
+            self._patches[patch_relpath] = {"digest": digest, "files": files}
+            self._changed = True
+
+    def forget(self, patch_relpath: str) -> None:
+        with self._lock:
+            if self._patches.pop(patch_relpath, None) is not None:
+                self._changed = True
+
+    def _file_state(
+        self, path: str, recorded: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        The size, mtime and content digest of a file, or None if it does not exist. Only reads the
+        file if its size or mtime differ from the recorded ones.
+        """
+        abspath = os.path.join(self._aosp_root, path)
+        try:
+            stat = os.stat(abspath)
+        except FileNotFoundError:
+            return None
+        # A file modified within the mtime granularity of when its state is taken could be modified
+        # again without its mtime changing, so its mtime is not recorded and it gets read again:
+        recent = time.time() - stat.st_mtime < PATCH_STATE_MTIME_GRANULARITY
+        mtime_ns = None if recent else stat.st_mtime_ns
+        if (
+            recorded is not None
+            and mtime_ns is not None
+            and recorded.get("size") == stat.st_size
+            and recorded.get("mtime_ns") == mtime_ns
+        ):
+            return recorded
+
+        with _tracer.span("read", "file", path=abspath, bytes=stat.st_size):
+            with open(abspath, "rb") as file:
+                sha256 = hashlib.sha256(file.read()).hexdigest()
+        return {"size": stat.st_size, "mtime_ns": mtime_ns, "sha256": sha256}
+
+
+def _format_release_matrix(matrix: Dict[int, Dict[str, str]]) -> List[str]:
+    """
+    Formats the outcome of dry-running the patches of each release as a table, with a row per
+    release and a column per AOSP project. Projects the release has no patches for, or that were
+    not checked because the release was ruled out before, are marked with "-".
+    """
+    repo_subdirs = sorted({repo_subdir for projects in matrix.values() for repo_subdir in projects})
+    rows = [["release", *repo_subdirs]]
+    for android_release, projects in sorted(matrix.items()):
+        rows.append(
+            [
+                str(android_release),
+                *(projects.get(repo_subdir, "-") for repo_subdir in repo_subdirs),
+            ]
+        )
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    return [
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows
+    ]
+
+
 class PatchAOSPCommand(Command):
     def __init__(
-        self, aosp_root, check_patch_command, apply_patch_command, force, android_release, exclude
+        self,
+        aosp_root,
+        check_patch_command,
+        apply_patch_command,
+        force,
+        android_release,
+        exclude,
+        jobs=1,
     ):
         self._aosp_root = aosp_root
-        self._check_patch_command = check_patch_command or self._default_check_patch_command()
-        self._apply_patch_command = apply_patch_command or self._default_apply_patch_command()
+        # Without commands, patches are checked and applied in-process:
+        self._check_patch_command = check_patch_command
+        self._apply_patch_command = apply_patch_command
         self._force = force
-        self._patches_dir = os.path.join(SCRIPT_DIR, "patches", f"android-{android_release}")
+        self._android_release = android_release
+        self._patches_dir = None
+        if android_release != ANDROID_RELEASE_AUTO:
+            self._patches_dir = self._release_patches_dir(android_release)
         self._exclude_dirs = exclude or []
+        self._jobs = jobs
+        self._state = _PatchState(aosp_root)
         self._errors = []
         self._warnings = []
 
@@ -144,48 +768,48 @@ class PatchAOSPCommand(Command):
         )
         parser.add_argument(
             "--android-release",
-            type=int,
-            choices=RELEASES,
+            type=android_release_type,
+            choices=(*RELEASES, ANDROID_RELEASE_AUTO),
             required=True,
-            help="Android platform version",
+            help="Android platform version, or 'auto' to pick the release whose patches apply to the "
+            "AOSP tree (or are already applied)",
         )
         parser.add_argument(
             "--check-patch-command",
             type=shell_command_type,
             default=None,
-            help="Command to check whether patch is applied. Expected to exit with status 0 if patch is applied.",
+            help="Command to check whether patch is applied. Expected to exit with status 0 if patch is applied. "
+            "By default, patches are checked in-process, like `patch -R -p1 --dry-run` would.",
         )
         parser.add_argument(
             "--apply-patch-command",
             type=shell_command_type,
             default=None,
-            help="Command to apply patch. The patch is provided through stdin.",
+            help="Command to apply patch. The patch is provided through stdin. "
+            "By default, patches are applied in-process, like `patch -f -p1` would.",
         )
         parser.add_argument(
             "--force",
             action="store_true",
             default=False,
-            help="Apply patch, even when already applied.",
+            help=f"Apply patch, even when already applied. Also ignores the record of applied patches "
+            f"that is kept in {PATCH_STATE_FILE} at the AOSP root.",
         )
         parser.add_argument(
             "--exclude", action="append", help="Directories to exclude from patching"
         )
-
-    @staticmethod
-    def _default_apply_patch_command():
-        try:
-            return shell_command_type("patch -f -p1")
-        except argparse.ArgumentTypeError as error:
-            sys.exit(str(error))
-
-    @staticmethod
-    def _default_check_patch_command():
-        try:
-            return shell_command_type("patch -R -p1 --dry-run")
-        except argparse.ArgumentTypeError as error:
-            sys.exit(str(error))
+        parser.add_argument(
+            "--jobs",
+            type=positive_int_type,
+            default=1,
+            help="Number of AOSP projects to patch concurrently (default: 1)",
+        )
 
     def run(self):
+        if self._android_release == ANDROID_RELEASE_AUTO:
+            self._android_release = self._detect_android_release()
+            self._patches_dir = self._release_patches_dir(self._android_release)
+
         self._apply_all_patches()
 
         if self._errors:
@@ -196,92 +820,456 @@ class PatchAOSPCommand(Command):
 
         logging.info("All patches applied successfully.")
 
+    @staticmethod
+    def _release_patches_dir(android_release: int) -> str:
+        return os.path.join(SCRIPT_DIR, "patches", f"android-{android_release}")
+
+    @staticmethod
+    def _find_patches(patches_dir: str) -> Dict[str, List[str]]:
+        """
+        Finds the patches in a directory, grouped by the AOSP project they apply to, in the order in
+        which the file system lists them (which is the order they have always been applied in).
+        """
+        glob_pattern = os.path.join(patches_dir, "**", "git.diff")
+        projects: Dict[str, List[str]] = {}
+        for patch_abspath in glob.iglob(glob_pattern, recursive=True):
+            repo_subdir = os.path.dirname(os.path.relpath(patch_abspath, patches_dir))
+            projects.setdefault(repo_subdir, []).append(patch_abspath)
+        return projects
+
     def _apply_all_patches(self):
-        glob_pattern = os.path.join(self._patches_dir, "**", "git.diff")
+        replacer = PlaceholderReplacer(
+            {
+                PLACEHOLDER_BORT_AOSP_PATCH_VERSION: _get_bort_version(),
+            }
+        )
 
-        mapping = {
-            PLACEHOLDER_BORT_AOSP_PATCH_VERSION: _get_bort_version(),
-        }
+        projects = self._find_patches(self._patches_dir)
 
-        for patch_abspath in glob.iglob(glob_pattern, recursive=True):
+        # Patches for different projects can't conflict, but those for the same project are applied
+        # one after the other:
+        self._state.load()
+        try:
+            failed = _run_checks(
+                [
+                    functools.partial(self._patch_project, repo_subdir, patch_abspaths, replacer)
+                    for repo_subdir, patch_abspaths in projects.items()
+                ],
+                jobs=self._jobs,
+            )
+        finally:
+            self._state.store()
+        for patch_relpath in failed:
+            if self._is_optional(os.path.dirname(patch_relpath)):
+                self._warnings.append(patch_relpath)
+            else:
+                self._errors.append(patch_relpath)
+
+    @staticmethod
+    def _is_optional(repo_subdir: str) -> bool:
+        return repo_subdir == "device/google/cuttlefish"
+
+    def _detect_android_release(self) -> int:
+        """
+        Dry-runs the patches of every release against the AOSP tree, concurrently, and picks the
+        release whose patches all apply or are already applied. A release is ruled out, and its
+        remaining patches are not checked, as soon as one of its required patches conflicts.
+        """
+        replacer = PlaceholderReplacer(
+            {
+                PLACEHOLDER_BORT_AOSP_PATCH_VERSION: _get_bort_version(),
+            }
+        )
+        self._state.load()
+        matrix: Dict[int, Dict[str, str]] = {}
+        _run_checks(
+            [
+                functools.partial(self._dry_run_release, android_release, replacer, matrix)
+                for android_release in RELEASES
+            ],
+            jobs=len(RELEASES),
+        )
+
+        logging.info("Android release compatibility of %r:", self._aosp_root)
+        for line in _format_release_matrix(matrix):
+            logging.info("\t%s", line)
+
+        compatible = [
+            android_release
+            for android_release, projects in matrix.items()
+            if all(
+                state != _DiffCheck.CONFLICT or self._is_optional(repo_subdir)
+                for repo_subdir, state in projects.items()
+            )
+        ]
+        if len(compatible) > 1:
+            # Prefer a release that was patched before:
+            compatible = [
+                android_release
+                for android_release in compatible
+                if all(
+                    state == _DiffCheck.APPLIED or self._is_optional(repo_subdir)
+                    for repo_subdir, state in matrix[android_release].items()
+                )
+            ] or compatible
+        if not compatible:
+            sys.exit("Couldn't detect the Android release: the patches of no release apply.")
+        if len(compatible) > 1:
+            sys.exit(
+                "Couldn't detect the Android release: the patches of %s all apply. "
+                "Please specify --android-release." % ", ".join(map(str, compatible))
+            )
+
+        logging.info("Detected Android release: %d", compatible[0])
+        return compatible[0]
+
+    def _dry_run_release(
+        self,
+        android_release: int,
+        replacer: PlaceholderReplacer,
+        matrix: Dict[int, Dict[str, str]],
+    ) -> List[str]:
+        patches_dir = self._release_patches_dir(android_release)
+        projects = matrix[android_release] = {}
+        # Sorted, so that the same patch rules a release out on every file system:
+        for repo_subdir, patch_abspaths in sorted(self._find_patches(patches_dir).items()):
+            if repo_subdir in self._exclude_dirs:
+                continue
+            states = [
+                self._dry_run_patch(repo_subdir, patch_abspath, patches_dir, replacer)
+                for patch_abspath in patch_abspaths
+            ]
+            if _DiffCheck.CONFLICT in states:
+                projects[repo_subdir] = _DiffCheck.CONFLICT
+                if not self._is_optional(repo_subdir):
+                    break  # Ruled out!
+            elif _DiffCheck.APPLICABLE in states:
+                projects[repo_subdir] = _DiffCheck.APPLICABLE
+            else:
+                projects[repo_subdir] = _DiffCheck.APPLIED
+        return []
+
+    def _dry_run_patch(
+        self,
+        repo_subdir: str,
+        patch_abspath: str,
+        patches_dir: str,
+        replacer: PlaceholderReplacer,
+    ) -> str:
+        content = replacer.replace(_read_file(patch_abspath))
+        if self._state.is_applied(
+            os.path.relpath(patch_abspath, patches_dir), _PatchState.digest(content)
+        ):
+            return _DiffCheck.APPLIED
+
+        root = os.path.join(self._aosp_root, repo_subdir)
+        if not os.path.isdir(root):
+            return _DiffCheck.CONFLICT
+        try:
+            file_patches = _parse_unified_diff(content)
+        except _PatchError:
+            return _DiffCheck.CONFLICT
+        return _check_unified_diff(file_patches, root).state
+
+    def _patch_project(
+        self, repo_subdir: str, patch_abspaths: List[str], replacer: PlaceholderReplacer
+    ) -> List[str]:
+        """
+        Checks and applies the patches for one project. Returns the patches that failed to apply.
+        """
+        failed = []
+        for patch_abspath in patch_abspaths:
             patch_relpath = os.path.relpath(patch_abspath, self._patches_dir)
-            repo_subdir = os.path.dirname(patch_relpath)
 
             if repo_subdir in self._exclude_dirs:
                 logging.info("Skipping patch: %r: excluded!", patch_relpath)
                 continue
 
-            with open(patch_abspath) as patch_file:
-                content = _replace_placeholders(patch_file.read(), mapping)
+            content = replacer.replace(_read_file(patch_abspath))
+            digest = _PatchState.digest(content)
+            if not self._force and self._state.is_applied(patch_relpath, digest):
+                logging.info("Skipping patch %r: already applied!", patch_relpath)
+                continue
+
+            diff_check = None
+            if self._check_patch_command is None or self._apply_patch_command is None:
+                diff_check = self._check_diff(repo_subdir, patch_relpath, content)
 
-            if not self._force and self._check_patch(repo_subdir, patch_relpath, content):
+            if not self._force and self._check_patch(
+                repo_subdir, patch_relpath, content, diff_check
+            ):
+                self._record_applied(repo_subdir, patch_relpath, content, digest)
                 continue  # Already applied!
 
-            self._apply_patch(repo_subdir, patch_relpath, content)
+            if not self._apply_patch(repo_subdir, patch_relpath, content, diff_check):
+                self._state.forget(patch_relpath)
+                failed.append(patch_relpath)
+                continue
+            self._record_applied(repo_subdir, patch_relpath, content, digest)
+        return failed
+
+    def _record_applied(self, repo_subdir, patch_relpath, content, digest) -> None:
+        try:
+            file_patches = _parse_unified_diff(content)
+        except _PatchError:
+            # Can't tell which files to watch, so check the patch every time:
+            self._state.forget(patch_relpath)
+            return
+        paths = [os.path.join(repo_subdir, file_patch.path) for file_patch in file_patches]
+        self._state.record(patch_relpath, digest, paths)
+
+    def _check_diff(self, repo_subdir, patch_relpath, content) -> Optional[_DiffCheck]:
+        try:
+            file_patches = _parse_unified_diff(content)
+        except _PatchError as error:
+            logging.error("Failed to parse %r: %s", patch_relpath, error)
+            return None
+        return _check_unified_diff(file_patches, os.path.join(self._aosp_root, repo_subdir))
+
+    def _check_patch(self, repo_subdir, patch_relpath, content, diff_check) -> bool:
+        if self._check_patch_command is None:
+            if diff_check is None or diff_check.state != _DiffCheck.APPLIED:
+                return False
+            logging.info("Skipping patch %r: already applied!", patch_relpath)
+            return True
 
-    def _check_patch(self, repo_subdir, patch_relpath, content) -> bool:
         check_cmd = self._check_patch_command
+        cwd = os.path.join(self._aosp_root, repo_subdir)
+        stdin = content.encode(DEFAULT_ENCODING)
         try:
-            subprocess.check_output(
-                check_cmd,
-                cwd=os.path.join(self._aosp_root, repo_subdir),
-                input=content.encode(DEFAULT_ENCODING),
-            )
+            with _tracer.subprocess_span(check_cmd, cwd=cwd, stdin_bytes=len(stdin)):
+                subprocess.check_output(check_cmd, cwd=cwd, input=stdin)
             logging.info("Skipping patch %r: already applied!", patch_relpath)
             return True
 
         except (subprocess.CalledProcessError, FileNotFoundError):
             return False
 
-    def _apply_patch(self, repo_subdir, patch_relpath, content):
+    def _apply_patch(self, repo_subdir, patch_relpath, content, diff_check) -> bool:
+        if self._apply_patch_command is None:
+            return self._apply_diff(repo_subdir, patch_relpath, diff_check)
+
         apply_cmd = self._apply_patch_command
         logging.info("Running %r (in %r)", shlex_join(apply_cmd), repo_subdir)
 
+        cwd = os.path.join(self._aosp_root, repo_subdir)
+        stdin = content.encode(DEFAULT_ENCODING)
         try:
-            output = subprocess.check_output(
-                apply_cmd,
-                cwd=os.path.join(self._aosp_root, repo_subdir),
-                input=content.encode(DEFAULT_ENCODING),
-                stderr=sys.stderr,
-            )
+            with _tracer.subprocess_span(apply_cmd, cwd=cwd, stdin_bytes=len(stdin)) as span_args:
+                output = subprocess.check_output(apply_cmd, cwd=cwd, input=stdin, stderr=sys.stderr)
+                span_args["stdout_bytes"] = len(output)
             logging.info(output.decode(DEFAULT_ENCODING))
+            return True
 
         except (subprocess.CalledProcessError, FileNotFoundError):
-            if repo_subdir == "device/google/cuttlefish":
+            if self._is_optional(repo_subdir):
                 logging.exception(
                     "Failed to apply %r (only needed for Cuttlefish/AVD)", patch_relpath
                 )
-                self._warnings.append(patch_relpath)
             else:
                 logging.exception("Failed to apply %r", patch_relpath)
-                self._errors.append(patch_relpath)
+            return False
 
+    def _apply_diff(self, repo_subdir, patch_relpath, diff_check) -> bool:
+        logging.info("Applying %r (in %r)", patch_relpath, repo_subdir)
+        if diff_check is not None and diff_check.state == _DiffCheck.APPLICABLE:
+            try:
+                _apply_diff_check(diff_check, os.path.join(self._aosp_root, repo_subdir))
+                logging.info("\n".join(diff_check.messages))
+                return True
+            except OSError:
+                logging.exception("Failed to write the files patched by %r", patch_relpath)
+        elif diff_check is not None:
+            logging.info("\n".join(diff_check.messages))
+
+        if self._is_optional(repo_subdir):
+            logging.error("Failed to apply %r (only needed for Cuttlefish/AVD)", patch_relpath)
+        else:
+            logging.error("Failed to apply %r", patch_relpath)
+        return False
+
+
+def _replace_placeholders_in_file(file_abspath, mapping, output_abspath=None):
+    output_abspath = output_abspath or file_abspath
+    logging.info("Patching %r with %r", output_abspath, mapping)
+
+    # Streams the file through the replacer into a temporary file that then replaces the output,
+    # unless it has that content already (so that builds don't consider it changed):
+    replacer = PlaceholderReplacer(mapping)
+    temp_path = None
+    try:
+        with _tracer.span("write", "file", path=output_abspath):
+            with open(file_abspath) as input_file, tempfile.NamedTemporaryFile(
+                "w", dir=os.path.dirname(output_abspath), prefix=".bort-patch-", delete=False
+            ) as output_file:
+                temp_path = output_file.name
+                replacer.replace_file(input_file, output_file)
+            if os.path.exists(output_abspath) and filecmp.cmp(
+                temp_path, output_abspath, shallow=False
+            ):
+                os.remove(temp_path)
+                return
+            shutil.copymode(file_abspath, temp_path)
+            os.replace(temp_path, output_abspath)
+    except BaseException:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _link_file(src: str, dst: str) -> None:
+    """
+    Makes dst a hard link to src, or a copy of it where hard links are not possible (e.g. across
+    file systems).
+    """
+    try:
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _copy_file(src: str, dst: str) -> None:
+    """
+    Makes dst a copy of src, unless it already is a file of its own (which may have been written
+    since).
+    """
+    if os.path.lexists(dst):
+        if not os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    shutil.copy2(src, dst)
 
-def _replace_placeholders_in_file(file_abspath, mapping):
-    logging.info("Patching %r with %r", file_abspath, mapping)
 
-    with open(file_abspath) as file:
-        content = _replace_placeholders(file.read(), mapping)
+def _prune_build_dirs(dirnames: List[str], filenames: List[str]) -> None:
+    """
+    Removes the build outputs from the subdirectories of a directory that os.walk() visits, if it is
+    the root of a gradle project.
+    """
+    if GRADLE_PROJECT_FILES.intersection(filenames):
+        dirnames[:] = [name for name in dirnames if name not in PATCH_BORT_VARIANT_SKIP_DIRS]
+
+
+def _link_tree(
+    src_dir: str, dst_dir: str, exclude: Iterable[str], copy: Iterable[str] = ()
+) -> None:
+    """
+    Mirrors a directory tree with hard links to its files, apart from the `exclude` files (relative
+    paths) and the build outputs of gradle projects. Files and directories that are gone from the
+    source are removed from the mirror.
 
-    with open(file_abspath, "w") as file:
-        file.write(content)
+    The hard links alias the source files: writing to one in place changes the source and every
+    other mirror of it. The `copy` files (relative paths) are copied instead, and are left alone
+    once the mirror has its own copy of them.
+    """
+    exclude = set(exclude)
+    copy = set(copy)
+    kept = set()
+    kept_dirs = set()
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        _prune_build_dirs(dirnames, filenames)
+        rel_dir = os.path.relpath(dirpath, src_dir)
+        kept_dirs.add(os.path.normpath(rel_dir))
+        os.makedirs(os.path.join(dst_dir, rel_dir), exist_ok=True)
+        for name in list(dirnames):
+            if os.path.islink(os.path.join(dirpath, name)):
+                # Not followed by os.walk():
+                dirnames.remove(name)
+                filenames.append(name)
+        for name in filenames:
+            relpath = os.path.normpath(os.path.join(rel_dir, name))
+            kept.add(relpath)
+            if relpath in exclude:
+                continue
+            src, dst = os.path.join(src_dir, relpath), os.path.join(dst_dir, relpath)
+            if os.path.islink(src):
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(os.readlink(src), dst)
+            elif relpath in copy:
+                _copy_file(src, dst)
+            else:
+                _link_file(src, dst)
+
+    for dirpath, dirnames, filenames in os.walk(dst_dir):
+        _prune_build_dirs(dirnames, filenames)
+        rel_dir = os.path.relpath(dirpath, dst_dir)
+        for name in list(dirnames):
+            relpath = os.path.normpath(os.path.join(rel_dir, name))
+            if os.path.islink(os.path.join(dirpath, name)):
+                dirnames.remove(name)
+                filenames.append(name)
+            elif relpath not in kept_dirs:
+                dirnames.remove(name)
+                shutil.rmtree(os.path.join(dirpath, name))
+        for name in filenames:
+            if os.path.normpath(os.path.join(rel_dir, name)) not in kept:
+                os.remove(os.path.join(dirpath, name))
+
+
+def _bort_replacements(bort_app_id, bort_ota_app_id=None, vendor_feature_name=None):
+    replacements = {
+        PLACEHOLDER_BORT_APP_ID: bort_app_id,
+        PLACEHOLDER_FEATURE_NAME: vendor_feature_name or bort_app_id,
+    }
+
+    if bort_ota_app_id:
+        replacements[PLACEHOLDER_BORT_OTA_APP_ID] = bort_ota_app_id
+    return replacements
 
 
 class PatchBortCommand(Command):
-    def __init__(self, path, bort_app_id, bort_ota_app_id=None, vendor_feature_name=None):
+    def __init__(
+        self,
+        path,
+        bort_app_id=None,
+        bort_ota_app_id=None,
+        vendor_feature_name=None,
+        manifest=None,
+        output_dir=None,
+        jobs=1,
+    ):
         self._path = path
         self._bort_app_id = bort_app_id
         self._bort_ota_app_id = bort_ota_app_id
         self._vendor_feature_name = vendor_feature_name or bort_app_id
+        self._manifest = manifest
+        self._output_dir = output_dir
+        self._jobs = jobs
 
     @classmethod
     def register(cls, create_parser):
         parser = create_parser(cls, "patch-bort")
-        parser.add_argument("--bort-app-id", type=android_application_id_type, required=True)
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument("--bort-app-id", type=android_application_id_type)
+        target.add_argument(
+            "--manifest",
+            type=str,
+            help="JSON file that maps product names to objects with the bort_app_id, and optionally "
+            "the bort_ota_app_id and vendor_feature_name, of each product. Instead of patching the "
+            "MemfaultPackages folder, creates a variant of it for every product in --output-dir, "
+            "in which only the patched files and local.properties are not hard links to the "
+            "original ones: writing to any other file of a variant in place also changes it in "
+            "the MemfaultPackages folder and in the other variants.",
+        )
         parser.add_argument("--bort-ota-app-id", type=android_application_id_type, required=False)
         parser.add_argument(
             "--vendor-feature-name", type=str, help="Defaults to the provided Application ID"
         )
+        parser.add_argument(
+            "--output-dir", type=str, help="Directory to create the variants of --manifest in"
+        )
+        parser.add_argument(
+            "--jobs",
+            type=positive_int_type,
+            default=1,
+            help="Number of variants of --manifest to create concurrently (default: 1)",
+        )
         parser.add_argument(
             "path",
             type=readable_dir_type,
@@ -289,102 +1277,838 @@ class PatchBortCommand(Command):
         )
 
     def run(self):
-        for file_relpath in [
-            "bort.properties",
-        ]:
-            replacements = {
-                PLACEHOLDER_BORT_APP_ID: self._bort_app_id,
-                PLACEHOLDER_FEATURE_NAME: self._vendor_feature_name,
-            }
-
-            if self._bort_ota_app_id:
-                replacements[PLACEHOLDER_BORT_OTA_APP_ID] = self._bort_ota_app_id
-
-            file_abspath = os.path.join(self._path, file_relpath)
-            _replace_placeholders_in_file(
-                file_abspath,
-                mapping=replacements,
+        if self._manifest is None:
+            replacements = _bort_replacements(
+                self._bort_app_id, self._bort_ota_app_id, self._vendor_feature_name
             )
+            for file_relpath in PATCH_BORT_FILES:
+                file_abspath = os.path.join(self._path, file_relpath)
+                _replace_placeholders_in_file(
+                    file_abspath,
+                    mapping=replacements,
+                )
+            return
+
+        if not self._output_dir:
+            sys.exit("--output-dir is required with --manifest")
+        if self._bort_ota_app_id or self._vendor_feature_name:
+            sys.exit("The IDs of the products are taken from --manifest")
+        products = self._load_manifest()
+        # Variants inside the source would be mirrored into each other, and mirroring the source
+        # into a variant that contains it would remove its files:
+        path = os.path.realpath(self._path)
+        for name in products:
+            variant_dir = os.path.realpath(os.path.join(self._output_dir, name))
+            if os.path.commonpath([path, variant_dir]) in (path, variant_dir):
+                sys.exit(f"Variant {variant_dir!r} would overlap with {self._path!r}")
+        errors = _run_checks(
+            [
+                functools.partial(self._create_variant, name, replacements)
+                for name, replacements in products.items()
+            ],
+            jobs=self._jobs,
+        )
+        for error in errors:
+            logging.error(error)
+        if errors:
+            sys.exit("Some variants couldn't be created.")
 
+        logging.info("Created %d variants in %r.", len(products), self._output_dir)
 
-def _get_shell_cmd_output_and_errors(
-    *, description: str, cmd: Tuple
-) -> Tuple[Optional[str], List[str]]:
-    logging.info("\n%s", description)
-    shell_cmd = shlex_join(cmd)
-    logging.info("\t%s", shell_cmd)
+    def _load_manifest(self) -> Dict[str, Dict[str, str]]:
+        """
+        Reads the manifest, returning the placeholder replacements of every product.
+        """
+        try:
+            manifest = json.loads(_read_file(self._manifest))
+        except (OSError, ValueError) as error:
+            sys.exit(f"Couldn't read manifest {self._manifest!r}: {error}")
+        if not isinstance(manifest, dict):
+            sys.exit(f"Invalid manifest {self._manifest!r}: expected an object of products")
+
+        products = {}
+        for name, product in manifest.items():
+            if not re.match(r"^[\w.-]+$", name) or name in (".", ".."):
+                sys.exit(f"Invalid product name in manifest: {name!r}")
+            if not isinstance(product, dict) or not product.get("bort_app_id"):
+                sys.exit(f"Missing bort_app_id for product {name!r} in manifest")
+            unknown = set(product) - {"bort_app_id", "bort_ota_app_id", "vendor_feature_name"}
+            if unknown:
+                sys.exit(f"Unknown keys for product {name!r} in manifest: {sorted(unknown)}")
+            try:
+                products[name] = _bort_replacements(
+                    android_application_id_type(product["bort_app_id"]),
+                    product.get("bort_ota_app_id")
+                    and android_application_id_type(product["bort_ota_app_id"]),
+                    product.get("vendor_feature_name"),
+                )
+            except argparse.ArgumentTypeError as error:
+                sys.exit(f"Invalid product {name!r} in manifest: {error}")
+        return products
 
-    def _shell_command():
+    def _create_variant(self, name: str, replacements: Dict[str, str]) -> List[str]:
+        variant_dir = os.path.join(self._output_dir, name)
+        logging.info("Creating variant %r in %r", name, variant_dir)
         try:
-            return shell_command_type(shell_cmd)
-        except argparse.ArgumentTypeError as arg_error:
-            sys.exit(str(arg_error))
+            _link_tree(
+                self._path,
+                variant_dir,
+                exclude=PATCH_BORT_FILES,
+                copy=PATCH_BORT_VARIANT_COPY_FILES,
+            )
+            for file_relpath in PATCH_BORT_FILES:
+                _replace_placeholders_in_file(
+                    os.path.join(self._path, file_relpath),
+                    mapping=replacements,
+                    output_abspath=os.path.join(variant_dir, file_relpath),
+                )
+        except OSError as error:
+            return [f"Failed to create variant {name!r}: {error}"]
+        return []
+
 
+def _shell_command(cmd: Tuple) -> List[str]:
     try:
-        # In case the host system is Windows, adb will used \r\n as line endings, and this breaks our regexes, so
-        # configure universal newlines.
+        return shell_command_type(shlex_join(cmd))
+    except argparse.ArgumentTypeError as arg_error:
+        sys.exit(str(arg_error))
+
+
+def _check_process_output(cmd: Tuple) -> str:
+    # In case the host system is Windows, adb will used \r\n as line endings, and this breaks our regexes, so
+    # configure universal newlines.
+    with _tracer.subprocess_span(cmd) as span_args:
         output = subprocess.check_output(
-            _shell_command(), stderr=sys.stderr, encoding="utf-8", universal_newlines=True
+            _shell_command(cmd), stderr=sys.stderr, encoding="utf-8", universal_newlines=True
         )
-        result: str = output[:-1]  # Trim trailing newline
-        return result, []
-    except subprocess.CalledProcessError as error:
-        return None, [str(error)]
-
+        span_args["stdout_bytes"] = len(output.encode(DEFAULT_ENCODING))
+    return output
+
+
+def _iter_process_output_lines(cmd: Tuple) -> Iterator[str]:
+    with _tracer.subprocess_span(cmd, stdout_bytes=0) as span_args, subprocess.Popen(
+        _shell_command(cmd),
+        stdout=subprocess.PIPE,
+        stderr=sys.stderr,
+        encoding="utf-8",
+        universal_newlines=True,
+    ) as process:
+        try:
+            for line in process.stdout:
+                span_args["stdout_bytes"] += len(line.encode(DEFAULT_ENCODING))
+                yield line
+        except GeneratorExit:
+            # The consumer has seen enough, stop the command instead of draining its output:
+            process.terminate()
+            raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, list(cmd))
+
+
+def _iter_decoded_lines(chunks: Generator[bytes, None, int]) -> Generator[str, None, int]:
+    """
+    Decodes a stream of output chunks into lines with universal newlines, without buffering more
+    than a single line. Returns the return value of `chunks`.
+    """
+    decoder = codecs.getincrementaldecoder(DEFAULT_ENCODING)(errors="replace")
+    pending = ""
+    with contextlib.closing(chunks):
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration as stop:
+                result: int = stop.value
+                break
+            *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+            for line in lines:
+                yield line.rstrip("\r") + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+    return result
 
-def _create_adb_command(cmd: Tuple, device: Optional[str] = None) -> Tuple:
-    return ("adb", *(("-s", device) if device else ()), *cmd)
 
+class _AdbTransport(abc.ABC):
+    """
+    Runs adb commands, given as they would be typed on the command line (e.g. `adb -s SERIAL shell ls`)
+    """
 
-def _get_adb_shell_cmd_output_and_errors(
-    *, description: str, cmd, device: Optional[str] = None
-) -> Tuple[Optional[str], List[str]]:
-    return _get_shell_cmd_output_and_errors(
-        description=description, cmd=_create_adb_command(("shell", *cmd), device=device)
-    )
+    NAME: str
 
+    @abc.abstractmethod
+    def check_output(self, cmd: Tuple) -> str:
+        """
+        Returns the stdout of the command, with universal newlines.
+        Raises subprocess.CalledProcessError if the command failed.
+        """
 
-class _Matcher(abc.ABC):
     @abc.abstractmethod
-    def __call__(self, adb_output: str) -> Tuple[bool, str]:
-        pass
+    def iter_lines(self, cmd: Tuple) -> Iterator[str]:
+        """
+        Yields the stdout of the command line by line, as it is produced.
+        Closing the iterator early stops the command.
+        Raises subprocess.CalledProcessError if the command failed.
+        """
 
 
-class _RegexMatcher(_Matcher):
-    def __init__(self, pattern: str) -> None:
-        self._re = re.compile(pattern, flags=re.RegexFlag.MULTILINE)
+class _AdbProcessTransport(_AdbTransport):
+    """
+    Spawns an adb client process for every command
+    """
 
-    def __call__(self, adb_output: str) -> Tuple[bool, str]:
-        return bool(self._re.search(adb_output)), f"Expected pattern: {self._re.pattern}"
+    NAME = "client"
 
+    def check_output(self, cmd: Tuple) -> str:
+        return _check_process_output(cmd)
 
-class _IdleWhitelistMatcher(_Matcher):
-    def __init__(self, bort_app_id: str) -> None:
-        self._bort_app_id = bort_app_id
+    def iter_lines(self, cmd: Tuple) -> Iterator[str]:
+        return _iter_process_output_lines(cmd)
 
-    def __call__(self, output: str) -> Tuple[bool, str]:
-        lines = output.splitlines()
-        for idx, line in enumerate(lines):
-            if "Whitelist system apps:" in line:
-                whitelist_start = idx
-                break
-        else:
-            return False, "Failed to find 'Whitelist system apps' in output"
-        for line in lines[whitelist_start:]:
-            if self._bort_app_id in line:
-                return True, f"Found '{self._bort_app_id}'"
-        return False, f"Failed to find '{self._bort_app_id}' in 'Whitelist system apps' list"
 
+class _AdbServerError(Exception):
+    pass
 
-class _ConnectedDeviceMatcher(_Matcher):
-    def __init__(self, device: Optional[str]) -> None:
-        self._device = device
 
-    def __call__(self, output: str) -> Tuple[bool, str]:
-        lines = output.splitlines()
-        if len(lines) < 2:
-            return False, "Too few output lines from 'adb devices'"
-        if "List of devices attached" not in lines[0]:
+class _AdbServerTransport(_AdbTransport):
+    """
+    Talks the adb host protocol to the local adb server directly, instead of spawning an adb client
+    process for every command. The protocol is described in AOSP's packages/modules/adb/OVERVIEW.TXT
+    and SERVICES.TXT. The server closes the connection once a device service completes, so every
+    command uses a fresh (local, cheap) connection.
+    Commands that are not supported here are delegated to the adb client.
+    """
+
+    NAME = "server"
+
+    SHELL_V2_STDOUT = 1
+    SHELL_V2_STDERR = 2
+    SHELL_V2_EXIT = 3
+
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None) -> None:
+        self._host = host or os.environ.get("ANDROID_ADB_SERVER_ADDRESS", "127.0.0.1")
+        self._port = port or int(os.environ.get("ANDROID_ADB_SERVER_PORT", "5037"))
+        self._fallback = _AdbProcessTransport()
+        self._features: Dict[Optional[str], Tuple[str, ...]] = {}
+
+    def _connect(self) -> socket.socket:
+        return socket.create_connection((self._host, self._port))
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise _AdbServerError("Connection closed by adb server")
+            data += chunk
+        return data
+
+    @staticmethod
+    def _iter_until_closed(sock: socket.socket) -> Iterator[bytes]:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            yield chunk
+
+    @classmethod
+    def _recv_until_closed(cls, sock: socket.socket) -> bytes:
+        return b"".join(cls._iter_until_closed(sock))
+
+    @classmethod
+    def _recv_length_prefixed(cls, sock: socket.socket) -> str:
+        length = int(cls._recv_exactly(sock, 4), 16)
+        return cls._recv_exactly(sock, length).decode(DEFAULT_ENCODING, errors="replace")
+
+    @classmethod
+    def _expect_okay(cls, sock: socket.socket) -> None:
+        status = cls._recv_exactly(sock, 4)
+        if status == b"FAIL":
+            raise _AdbServerError(cls._recv_length_prefixed(sock))
+        if status != b"OKAY":
+            raise _AdbServerError(f"Unexpected response from adb server: {status!r}")
+
+    @classmethod
+    def _request(cls, sock: socket.socket, request: str) -> None:
+        data = request.encode(DEFAULT_ENCODING)
+        sock.sendall(b"%04x" % len(data) + data)
+        cls._expect_okay(sock)
+
+    def _host_query(self, request: str) -> str:
+        with self._connect() as sock:
+            self._request(sock, request)
+            return self._recv_length_prefixed(sock)
+
+    def _open_service(self, device: Optional[str], service: str) -> socket.socket:
+        sock = self._connect()
+        try:
+            self._request(sock, f"host:transport:{device}" if device else "host:transport-any")
+            self._request(sock, service)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def _wait_for(self, device: Optional[str], state: str) -> None:
+        """
+        Like `adb wait-for-<state>`: the server acknowledges the request, and answers once more
+        when the device reached the state.
+        """
+        with self._connect() as sock:
+            self._request(
+                sock,
+                (
+                    f"host-serial:{device}:wait-for-any-{state}"
+                    if device
+                    else f"host:wait-for-any-{state}"
+                ),
+            )
+            self._expect_okay(sock)
+
+    def _root(self, device: Optional[str]) -> bytes:
+        output = self._exec(device, "root:")
+        # Like `adb root`: adbd restarts unless it already runs as root (or cannot), so wait for the
+        # device to go away and come back before running anything else on it:
+        if output.startswith(b"restarting"):
+            self._wait_for(device, "disconnect")
+            self._wait_for(device, "device")
+        return output
+
+    def _pull(self, device: Optional[str], remote_path: str, local_path: str) -> None:
+        """
+        Copies a file from the device with the sync protocol, which, unlike `exec:cat`, reports
+        failures. The file is streamed to a temporary file, which replaces `local_path` once the
+        copy is complete.
+        """
+        remote = remote_path.encode(DEFAULT_ENCODING)
+        with self._open_service(device, "sync:") as sock, _tracer.span(
+            "write", "file", path=local_path, bytes=0
+        ) as span_args, tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(local_path)), suffix=".tmp", delete=False
+        ) as file:
+            try:
+                sock.sendall(b"RECV" + len(remote).to_bytes(4, "little") + remote)
+                while True:
+                    header = self._recv_exactly(sock, 8)
+                    packet_id, length = header[:4], int.from_bytes(header[4:], "little")
+                    if packet_id == b"DONE":
+                        break
+                    if packet_id == b"FAIL":
+                        message = self._recv_exactly(sock, length).decode(
+                            DEFAULT_ENCODING, errors="replace"
+                        )
+                        raise _AdbServerError(f"failed to copy '{remote_path}': {message}")
+                    if packet_id != b"DATA":
+                        raise _AdbServerError(f"Unexpected sync response: {packet_id!r}")
+                    file.write(self._recv_exactly(sock, length))
+                    span_args["bytes"] += length
+                sock.sendall(b"QUIT" + bytes(4))
+            except BaseException:
+                file.close()
+                os.remove(file.name)
+                raise
+        os.replace(file.name, local_path)
+
+    def _device_features(self, device: Optional[str]) -> Tuple[str, ...]:
+        if device not in self._features:
+            request = f"host-serial:{device}:features" if device else "host:features"
+            self._features[device] = tuple(self._host_query(request).split(","))
+        return self._features[device]
+
+    def _iter_shell(self, device: Optional[str], command: str) -> Generator[bytes, None, int]:
+        """
+        Yields the stdout of the command as it arrives and returns its exit status.
+        Closing the generator closes the connection, which makes adbd stop the command.
+        """
+        if "shell_v2" not in self._device_features(device):
+            # Without the shell v2 protocol, the exit status of the command is not available:
+            with self._open_service(device, f"shell:{command}") as sock:
+                yield from self._iter_until_closed(sock)
+            return 0
+
+        exit_status = 0
+        with self._open_service(device, f"shell,v2,raw:{command}") as sock:
+            while True:
+                try:
+                    header = self._recv_exactly(sock, 5)
+                except _AdbServerError:
+                    break
+                packet_id, length = header[0], int.from_bytes(header[1:], "little")
+                data = self._recv_exactly(sock, length)
+                if packet_id == self.SHELL_V2_STDOUT:
+                    yield data
+                elif packet_id == self.SHELL_V2_STDERR:
+                    sys.stderr.write(data.decode(DEFAULT_ENCODING, errors="replace"))
+                elif packet_id == self.SHELL_V2_EXIT:
+                    exit_status = data[0]
+                    break
+        return exit_status
+
+    def _shell(self, device: Optional[str], command: str) -> Tuple[int, bytes]:
+        stdout = []
+        chunks = self._iter_shell(device, command)
+        while True:
+            try:
+                stdout.append(next(chunks))
+            except StopIteration as stop:
+                return stop.value, b"".join(stdout)
+
+    def _iter_exec(self, device: Optional[str], service: str) -> Generator[bytes, None, int]:
+        # The exec service does not report the exit status of the command:
+        with self._open_service(device, service) as sock:
+            yield from self._iter_until_closed(sock)
+        return 0
+
+    def _exec(self, device: Optional[str], service: str) -> bytes:
+        return b"".join(self._iter_exec(device, service))
+
+    def _run(self, device: Optional[str], args: Tuple[str, ...]) -> Optional[Tuple[int, bytes]]:
+        if args == ("devices",):
+            devices = self._host_query("host:devices")
+            return 0, f"List of devices attached\n{devices}\n".encode(DEFAULT_ENCODING)
+        if args[:1] == ("shell",) and len(args) > 1:
+            return self._shell(device, " ".join(args[1:]))
+        if args[:1] == ("exec-out",) and len(args) > 1:
+            return 0, self._exec(device, "exec:" + " ".join(args[1:]))
+        if args == ("root",):
+            return 0, self._root(device)
+        if args[:1] == ("pull",) and len(args) == 3:
+            self._pull(device, args[1], args[2])
+            return 0, b""
+        return None
+
+    @staticmethod
+    def _split_cmd(cmd: Tuple) -> Tuple[Optional[str], Tuple[str, ...]]:
+        if cmd[1:2] == ("-s",):
+            return cmd[2], tuple(cmd[3:])
+        return None, tuple(cmd[1:])
+
+    def check_output(self, cmd: Tuple) -> str:
+        device, args = self._split_cmd(cmd)
+        try:
+            with _tracer.span(
+                f"adb {args[0]}" if args else "adb", "adb-server", command=shlex_join(cmd)
+            ) as span_args:
+                result = self._run(device, args)
+                span_args["stdout_bytes"] = len(result[1]) if result else None
+        except ConnectionRefusedError:
+            logging.info("\tadb server is not running, falling back to the adb client")
+            result = None
+        except _AdbServerError as error:
+            sys.stderr.write(f"adb: error: {error}\n")
+            raise subprocess.CalledProcessError(1, list(cmd))
+
+        if result is None:
+            return self._fallback.check_output(cmd)
+
+        exit_status, stdout = result
+        output = stdout.decode(DEFAULT_ENCODING, errors="replace")
+        output = output.replace("\r\n", "\n").replace("\r", "\n")
+        if exit_status:
+            raise subprocess.CalledProcessError(exit_status, list(cmd), output=output)
+        return output
+
+    def iter_lines(self, cmd: Tuple) -> Iterator[str]:
+        device, args = self._split_cmd(cmd)
+        if args[:1] == ("shell",) and len(args) > 1:
+            chunks = self._iter_shell(device, " ".join(args[1:]))
+        elif args[:1] == ("exec-out",) and len(args) > 1:
+            chunks = self._iter_exec(device, "exec:" + " ".join(args[1:]))
+        else:
+            yield from self._fallback.iter_lines(cmd)
+            return
+
+        try:
+            with _tracer.span(
+                f"adb {args[0]}", "adb-server", command=shlex_join(cmd), stdout_bytes=0
+            ) as span_args, contextlib.closing(_iter_decoded_lines(chunks)) as lines:
+                while True:
+                    try:
+                        line = next(lines)
+                    except StopIteration as stop:
+                        exit_status = stop.value
+                        break
+                    span_args["stdout_bytes"] += len(line.encode(DEFAULT_ENCODING))
+                    yield line
+        except ConnectionRefusedError:
+            logging.info("\tadb server is not running, falling back to the adb client")
+            yield from self._fallback.iter_lines(cmd)
+            return
+        except _AdbServerError as error:
+            sys.stderr.write(f"adb: error: {error}\n")
+            raise subprocess.CalledProcessError(1, list(cmd))
+        if exit_status:
+            raise subprocess.CalledProcessError(exit_status, list(cmd))
+
+
+ADB_TRANSPORTS = {cls.NAME: cls for cls in (_AdbProcessTransport, _AdbServerTransport)}
+_adb_transport: _AdbTransport = _AdbProcessTransport()
+
+
+def _set_adb_transport(name: str) -> None:
+    global _adb_transport
+    _adb_transport = ADB_TRANSPORTS[name]()
+
+
+def _check_output(cmd: Tuple) -> str:
+    if cmd[:1] == ("adb",):
+        return _adb_transport.check_output(cmd)
+    return _check_process_output(cmd)
+
+
+def _iter_output_lines(cmd: Tuple) -> Iterator[str]:
+    if cmd[:1] == ("adb",):
+        return _adb_transport.iter_lines(cmd)
+    return _iter_process_output_lines(cmd)
+
+
+class _ValidationReport:
+    """
+    Collects a record of every query and expectation made while validating a device, for the
+    machine-readable reports of validate-sdk-integration. Records are keyed by their description.
+    Records made by threads running a check concurrently are held back, like their log output.
+    """
+
+    def __init__(self) -> None:
+        self.records: List[Dict[str, Any]] = []
+        self._local = threading.local()
+
+    def record(self, description: str, **fields: Any) -> None:
+        description = description.strip()
+        records = getattr(self._local, "records", None)
+        if records is None:
+            records = self.records
+        for record in reversed(records):
+            if record["description"] == description:
+                record.update(fields)
+                return
+        records.append({"description": description, **fields})
+
+    def capture(self, fn: Callable[[], Any]) -> Tuple[Any, List[Dict[str, Any]]]:
+        records: List[Dict[str, Any]] = []
+        self._local.records = records
+        try:
+            return fn(), records
+        finally:
+            self._local.records = None
+
+    def to_json(self, **fields: Any) -> str:
+        checks = [{"passed": True, **record} for record in self.records]
+        return json.dumps({**fields, "checks": checks}, indent=2)
+
+    def to_junit(self, name: str) -> str:
+        suite = xml.etree.ElementTree.Element(
+            "testsuite",
+            name=name,
+            tests=str(len(self.records)),
+            failures=str(sum(1 for r in self.records if r.get("passed") is False)),
+            skipped=str(sum(1 for r in self.records if r.get("skipped"))),
+            time="%.3f" % sum(r.get("duration", 0.0) for r in self.records),
+        )
+        for record in self.records:
+            case = xml.etree.ElementTree.SubElement(
+                suite,
+                "testcase",
+                classname=name,
+                name=record["description"],
+                time="%.3f" % record.get("duration", 0.0),
+            )
+            if record.get("skipped"):
+                xml.etree.ElementTree.SubElement(case, "skipped", message=record.get("reason", ""))
+            elif record.get("passed") is False:
+                xml.etree.ElementTree.SubElement(case, "failure", message=record.get("reason", ""))
+            if "command" in record:
+                system_out = xml.etree.ElementTree.SubElement(case, "system-out")
+                system_out.text = "%s\n%d bytes of output" % (
+                    record["command"],
+                    record.get("output_bytes", 0),
+                )
+        return xml.etree.ElementTree.tostring(suite, encoding="unicode")
+
+
+_validation_report = _ValidationReport()
+
+
+def _get_shell_cmd_output_and_errors(
+    *, description: str, cmd: Tuple
+) -> Tuple[Optional[str], List[str]]:
+    logging.info("\n%s", description)
+    shell_cmd = shlex_join(cmd)
+    logging.info("\t%s", shell_cmd)
+
+    start = time.monotonic()
+    try:
+        output = _check_output(cmd)
+        _validation_report.record(
+            description,
+            command=shell_cmd,
+            duration=time.monotonic() - start,
+            output_bytes=len(output.encode(DEFAULT_ENCODING)),
+        )
+        result: str = output[:-1]  # Trim trailing newline
+        return result, []
+    except subprocess.CalledProcessError as error:
+        _validation_report.record(
+            description,
+            command=shell_cmd,
+            duration=time.monotonic() - start,
+            passed=False,
+            reason=str(error),
+        )
+        return None, [str(error)]
+
+
+def _create_adb_command(cmd: Tuple, device: Optional[str] = None) -> Tuple:
+    return ("adb", *(("-s", device) if device else ()), *cmd)
+
+
+# Outputs of adb shell commands gathered ahead of time or by an earlier query, keyed by the command:
+_ShellOutputs = Dict[Tuple[str, ...], Tuple[Optional[str], List[str]]]
+
+
+def _get_adb_shell_cmd_output_and_errors(
+    *,
+    description: str,
+    cmd,
+    device: Optional[str] = None,
+    known_outputs: Optional[_ShellOutputs] = None,
+) -> Tuple[Optional[str], List[str]]:
+    adb_cmd = _create_adb_command(("shell", *cmd), device=device)
+    if known_outputs and tuple(cmd) in known_outputs:
+        logging.info("\n%s", description)
+        logging.info("\t%s (already queried)", shlex_join(adb_cmd))
+        output, errors = known_outputs[tuple(cmd)]
+        _validation_report.record(
+            description,
+            command=shlex_join(adb_cmd),
+            duration=0.0,
+            output_bytes=len(output.encode(DEFAULT_ENCODING)) if output else 0,
+            reused=True,
+            **({"passed": False, "reason": errors[0]} if errors else {}),
+        )
+        return output, errors
+
+    output_and_errors = _get_shell_cmd_output_and_errors(description=description, cmd=adb_cmd)
+    if known_outputs is not None:
+        known_outputs[tuple(cmd)] = output_and_errors
+    return output_and_errors
+
+
+# Arguments that survive being joined into a single `adb shell` command line without quoting:
+_PROBE_SAFE_ARG = re.compile(r"^[\w.,:/@%+=-]+$")
+
+
+def _probe_shell_outputs(
+    *, cmds: Iterable[Tuple[str, ...]], device: Optional[str] = None
+) -> _ShellOutputs:
+    """
+    Runs all `cmds` in a single `adb shell` invocation. The output of each command is delimited by
+    markers, so it can be matched as if the command had been run on its own.
+    Commands which are missing from the result must be run individually.
+    """
+    cmds = [cmd for cmd in dict.fromkeys(cmds) if all(map(_PROBE_SAFE_ARG.match, cmd))]
+    if not cmds:
+        return {}
+
+    marker = f"BORT_PROBE_{uuid.uuid4().hex}"
+    script = " ".join(
+        f"echo {marker}:begin:{idx}; {shlex_join(cmd)}; status=$?; echo; echo {marker}:end:{idx}:$status;"
+        for idx, cmd in enumerate(cmds)
+    )
+    output, errors = _get_shell_cmd_output_and_errors(
+        description=f"Probing device ({len(cmds)} commands)",
+        cmd=_create_adb_command(("shell", script), device=device),
+    )
+    if errors or output is None:
+        _log_errors(errors)
+        return {}
+
+    begin_re = re.compile(rf"^{marker}:begin:(\d+)\n?$")
+    end_re = re.compile(rf"^{marker}:end:(\d+):(\d+)\n?$")
+    outputs: _ShellOutputs = {}
+    current_idx: Optional[int] = None
+    current_lines: List[str] = []
+    for line in output.splitlines(keepends=True):
+        begin = begin_re.match(line) if current_idx is None else None
+        end = end_re.match(line) if current_idx is not None else None
+        if begin and int(begin.group(1)) < len(cmds):
+            current_idx, current_lines = int(begin.group(1)), []
+        elif end and int(end.group(1)) == current_idx:
+            cmd = cmds[current_idx]
+            status = int(end.group(2))
+            if status == 0:
+                # Trim the newline added by the probe, and the last character of the output (its
+                # trailing newline) like _get_shell_cmd_output_and_errors does:
+                outputs[cmd] = "".join(current_lines)[:-2], []
+            else:
+                error = subprocess.CalledProcessError(
+                    status, list(_create_adb_command(("shell", *cmd), device=device))
+                )
+                outputs[cmd] = None, [str(error)]
+            current_idx = None
+        else:
+            # Including lines of the output of a command that look like markers:
+            current_lines.append(line)
+
+    logging.info("\tProbed %d of %d commands", len(outputs), len(cmds))
+    return outputs
+
+
+class _DeviceFactCache:
+    """
+    On-disk cache of device facts that cannot change without reflashing the device, keyed by the
+    device serial and build fingerprints (see BUILD_FINGERPRINT_PROPS). Entries expire after `ttl`
+    seconds, and the least recently written entries are evicted once the cache grows beyond
+    `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        ttl: float = DEVICE_FACT_CACHE_TTL,
+        max_bytes: int = DEVICE_FACT_CACHE_MAX_BYTES,
+    ) -> None:
+        self._directory = directory
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+
+    def _path(self, serial: str, fingerprint: str) -> str:
+        key = hashlib.sha256(f"{serial}\0{fingerprint}".encode(DEFAULT_ENCODING)).hexdigest()
+        return os.path.join(self._directory, f"{key}.json")
+
+    def load(self, serial: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        path = self._path(serial, fingerprint)
+        try:
+            if time.time() - os.path.getmtime(path) > self._ttl:
+                os.remove(path)
+                return None
+            entry = json.loads(_read_file(path))
+        except (OSError, ValueError):
+            return None
+
+        if entry.get("serial") != serial or entry.get("fingerprint") != fingerprint:
+            return None
+        return entry.get("facts")
+
+    def store(self, serial: str, fingerprint: str, facts: Dict[str, Any]) -> None:
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            path = self._path(serial, fingerprint)
+            content = json.dumps({"serial": serial, "fingerprint": fingerprint, "facts": facts})
+            with _tracer.span("write", "file", path=path, bytes=len(content)):
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=self._directory, suffix=".tmp", delete=False
+                ) as file:
+                    file.write(content)
+                os.replace(file.name, path)
+            self._evict()
+        except OSError as error:
+            logging.info("\tFailed to write device fact cache: %s", error)
+
+    def _evict(self) -> None:
+        entries = []
+        now = time.time()
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if not name.endswith(".json"):
+                continue
+            stat = os.stat(path)
+            if now - stat.st_mtime > self._ttl:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self._max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+
+
+class _Matcher(abc.ABC):
+    @abc.abstractmethod
+    def __call__(self, adb_output: str) -> Tuple[bool, str]:
+        pass
+
+
+class _StreamingMatcher(_Matcher):
+    """
+    Matcher that can decide on the output line by line, as it is produced, so that the command can
+    be stopped as soon as the outcome is known.
+    """
+
+    def reset(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def feed(self, line: str) -> Optional[Tuple[bool, str]]:
+        """
+        Consumes the next line of output (without line ending). Returns the outcome as soon as it is
+        known, or None if more output is needed.
+        """
+
+    @abc.abstractmethod
+    def finish(self) -> Tuple[bool, str]:
+        """
+        Returns the outcome once all output has been consumed without reaching a decision.
+        """
+
+    def __call__(self, adb_output: str) -> Tuple[bool, str]:
+        self.reset()
+        for line in adb_output.splitlines():
+            result = self.feed(line)
+            if result is not None:
+                return result
+        return self.finish()
+
+
+class _RegexMatcher(_StreamingMatcher):
+    def __init__(self, pattern: str) -> None:
+        self._re = re.compile(pattern, flags=re.RegexFlag.MULTILINE)
+
+    def feed(self, line: str) -> Optional[Tuple[bool, str]]:
+        if self._re.search(line):
+            return True, f"Expected pattern: {self._re.pattern}"
+        return None
+
+    def finish(self) -> Tuple[bool, str]:
+        return False, f"Expected pattern: {self._re.pattern}"
+
+    def __call__(self, adb_output: str) -> Tuple[bool, str]:
+        return bool(self._re.search(adb_output)), f"Expected pattern: {self._re.pattern}"
+
+
+class _IdleWhitelistMatcher(_StreamingMatcher):
+    def __init__(self, bort_app_id: str) -> None:
+        self._bort_app_id = bort_app_id
+        self._in_whitelist = False
+
+    def reset(self) -> None:
+        self._in_whitelist = False
+
+    def feed(self, line: str) -> Optional[Tuple[bool, str]]:
+        if "Whitelist system apps:" in line:
+            self._in_whitelist = True
+        if self._in_whitelist and self._bort_app_id in line:
+            return True, f"Found '{self._bort_app_id}'"
+        return None
+
+    def finish(self) -> Tuple[bool, str]:
+        if not self._in_whitelist:
+            return False, "Failed to find 'Whitelist system apps' in output"
+        return False, f"Failed to find '{self._bort_app_id}' in 'Whitelist system apps' list"
+
+
+class _ConnectedDeviceMatcher(_Matcher):
+    def __init__(self, device: Optional[str]) -> None:
+        self._device = device
+
+    def __call__(self, output: str) -> Tuple[bool, str]:
+        lines = output.splitlines()
+        if len(lines) < 2:
+            return False, "Too few output lines from 'adb devices'"
+        if "List of devices attached" not in lines[0]:
             return False, "Unexpected output from 'adb devices'"
         # If a device was provided, verify it's connected
         if self._device:
@@ -412,8 +2136,10 @@ def _format_error(description: str, *details: Any) -> str:
 
 def _expect_or_errors(*, output: Optional[str], description: str, matcher: _Matcher) -> List[str]:
     if output is None:
+        _validation_report.record(description, passed=False, reason="No output to match")
         return [_format_error(description, "No output to match")]
     passed, reason = matcher(output)
+    _validation_report.record(description, passed=passed, reason=reason)
     if not passed:
         logging.info("\t Test failed")
         return [_format_error(description, "Output did not match:", output, reason)]
@@ -430,23 +2156,154 @@ def _run_shell_cmd_and_expect(*, description: str, cmd: Tuple, matcher: _Matcher
 
 
 def _run_adb_shell_cmd_and_expect(
-    *, description: str, cmd: Tuple, matcher: _Matcher, device: Optional[str] = None
+    *,
+    description: str,
+    cmd: Tuple,
+    matcher: _Matcher,
+    device: Optional[str] = None,
+    known_outputs: Optional[_ShellOutputs] = None,
 ) -> List[str]:
     output, errors = _get_adb_shell_cmd_output_and_errors(
-        description=description, cmd=cmd, device=device
+        description=description, cmd=cmd, device=device, known_outputs=known_outputs
     )
     if errors:
         return errors
     return _expect_or_errors(output=output, description=description, matcher=matcher)
 
 
+def _stream_shell_cmd_and_match(
+    *, description: str, cmd: Tuple, matcher: _StreamingMatcher
+) -> Tuple[Optional[Tuple[bool, str]], Deque[str], List[str]]:
+    """
+    Feeds the output of the command to the matcher as it is produced and stops the command as soon
+    as the matcher has decided. Returns the outcome, the tail of the output and any errors.
+    Only the tail of the output is kept, to report it if the check fails.
+    """
+    logging.info("\n%s", description)
+    shell_cmd = shlex_join(cmd)
+    logging.info("\t%s", shell_cmd)
+
+    start = time.monotonic()
+    output_bytes = 0
+    tail: Deque[str] = collections.deque(maxlen=STREAMED_OUTPUT_TAIL_LINES)
+    result = None
+    matcher.reset()
+    try:
+        with contextlib.closing(_iter_output_lines(cmd)) as lines:
+            for line in lines:
+                output_bytes += len(line.encode(DEFAULT_ENCODING))
+                tail.append(line)
+                result = matcher.feed(line.rstrip("\n"))
+                if result is not None:
+                    break
+    except subprocess.CalledProcessError as error:
+        _validation_report.record(
+            description,
+            command=shell_cmd,
+            duration=time.monotonic() - start,
+            passed=False,
+            reason=str(error),
+        )
+        return None, tail, [str(error)]
+
+    stopped_early = result is not None
+    _validation_report.record(
+        description,
+        command=shell_cmd,
+        duration=time.monotonic() - start,
+        output_bytes=output_bytes,
+        stopped_early=stopped_early,
+    )
+    return result if stopped_early else matcher.finish(), tail, []
+
+
+def _stream_adb_shell_cmd_and_expect(
+    *,
+    description: str,
+    cmd: Tuple,
+    matcher: _StreamingMatcher,
+    device: Optional[str] = None,
+) -> List[str]:
+    """
+    Like _run_adb_shell_cmd_and_expect, but matches the output while it is produced
+    """
+    result, tail, errors = _stream_shell_cmd_and_match(
+        description=description,
+        cmd=_create_adb_command(("shell", *cmd), device=device),
+        matcher=matcher,
+    )
+    if errors:
+        return errors
+
+    passed, reason = result
+    _validation_report.record(description, passed=passed, reason=reason)
+    if not passed:
+        logging.info("\t Test failed")
+        excerpt = "".join(tail).rstrip("\n")
+        if len(tail) == tail.maxlen:
+            excerpt = f"(last {tail.maxlen} lines)\n{excerpt}"
+        return [_format_error(description, "Output did not match:", excerpt, reason)]
+
+    logging.info("\tTest passed")
+    return []
+
+
+class _ShellCheck:
+    """
+    Check that runs a command in an adb shell and matches its output
+    """
+
+    def __init__(
+        self,
+        *,
+        description: str,
+        cmd: Tuple[str, ...],
+        matcher: _Matcher,
+        device: Optional[str] = None,
+        known_outputs: Optional[_ShellOutputs] = None,
+        stream: bool = False,
+    ) -> None:
+        self.description = description
+        self.cmd = cmd
+        self.matcher = matcher
+        self.device = device
+        self.known_outputs = known_outputs
+        # Whether to match the output while it is produced, rather than after the command completes.
+        # Streamed outputs are not kept in known_outputs.
+        self.stream = stream
+
+    def __call__(self) -> List[str]:
+        known = self.known_outputs is not None and tuple(self.cmd) in self.known_outputs
+        if self.stream and not known and isinstance(self.matcher, _StreamingMatcher):
+            return _stream_adb_shell_cmd_and_expect(
+                description=self.description,
+                cmd=self.cmd,
+                matcher=self.matcher,
+                device=self.device,
+            )
+        return _run_adb_shell_cmd_and_expect(
+            description=self.description,
+            cmd=self.cmd,
+            matcher=self.matcher,
+            device=self.device,
+            known_outputs=self.known_outputs,
+        )
+
+
+def _dumpsys_package_cmd(package_id: str) -> Tuple[str, ...]:
+    return ("dumpsys", "package", package_id)
+
+
 def _run_adb_shell_dumpsys_package(
-    package_id: str, device: Optional[str] = None
+    package_id: str,
+    device: Optional[str] = None,
+    known_outputs: Optional[_ShellOutputs] = None,
 ) -> Tuple[Optional[str], List[str]]:
     output, errors = _get_adb_shell_cmd_output_and_errors(
         description=f"Querying package info for {package_id}",
-        cmd=("dumpsys", "package", package_id),
+        cmd=_dumpsys_package_cmd(package_id),
         device=device,
+        known_outputs=known_outputs,
     )
 
     unable_to_find_str = f"Unable to find package: {package_id}"
@@ -465,12 +2322,14 @@ def _check_file_ownership_and_secontext(
     secontext: str,
     device: Optional[str] = None,
     directory: bool = False,
-) -> List[str]:
-    return _run_adb_shell_cmd_and_expect(
+    known_outputs: Optional[_ShellOutputs] = None,
+) -> _ShellCheck:
+    return _ShellCheck(
         description=f"Verifying {path} is installed correctly",
         cmd=("ls", "-lZd" if directory else "-lZ", path),
         matcher=_RegexMatcher(rf"^{mode}\s[0-9]+\s{owner}\s{group}\s{secontext}.*{path}$"),
         device=device,
+        known_outputs=known_outputs,
     )
 
 
@@ -480,6 +2339,94 @@ def _log_errors(errors: Iterable[str]) -> None:
         logging.info(error)
 
 
+class _DeferredLogFilter(logging.Filter):
+    """
+    Holds back the log records of threads that are capturing their output, so that the output of
+    checks running concurrently can be replayed one check at a time.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+
+    def capture(
+        self, fn: Callable[[], Any], records: Optional[List[logging.LogRecord]] = None
+    ) -> Tuple[Any, List[logging.LogRecord]]:
+        """
+        Calls `fn`, holding back the log records it emits. They are returned, and also collected in
+        `records` if given, so that they are not lost if `fn` raises.
+        """
+        records = [] if records is None else records
+        self._local.records = records
+        try:
+            return fn(), records
+        finally:
+            self._local.records = None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        records = getattr(self._local, "records", None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+_Check = Callable[[], List[str]]
+
+
+def _run_checks(checks: Sequence[_Check], jobs: int = 1) -> List[str]:
+    """
+    Runs independent checks, using up to `jobs` worker threads. Errors are returned and log output
+    is emitted in the order of `checks`, regardless of the order in which the checks complete.
+    If a check raises, the output of all checks is still emitted before the exception is re-raised.
+    Also used for other independent tasks that return a list of failures.
+    """
+    if jobs <= 1:
+        return [error for check in checks for error in check()]
+
+    logger = logging.getLogger()
+    log_filter = _DeferredLogFilter()
+    logger.addFilter(log_filter)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            log_records: List[List[logging.LogRecord]] = [[] for _ in checks]
+            futures = [
+                executor.submit(
+                    log_filter.capture,
+                    functools.partial(_validation_report.capture, check),
+                    check_log_records,
+                )
+                for check, check_log_records in zip(checks, log_records)
+            ]
+            errors = []
+            exception: Optional[Exception] = None
+            for future, check_log_records in zip(futures, log_records):
+                try:
+                    (check_errors, report_records), _ = future.result()
+                except Exception as error:
+                    exception = exception or error
+                    check_errors, report_records = [], []
+                for log_record in check_log_records:
+                    logger.handle(log_record)
+                _validation_report.records.extend(report_records)
+                errors.extend(check_errors)
+            if exception is not None:
+                raise exception
+            return errors
+    finally:
+        logger.removeFilter(log_filter)
+
+
+def _check_name(check: _Check) -> str:
+    """
+    Name that identifies a check across runs
+    """
+    description = getattr(check, "description", None)
+    if description:
+        return description
+    return getattr(check, "func", check).__name__
+
+
 def _verify_device_connected(device: Optional[str] = None) -> List[str]:
     """
     If a target device is specified, verify that specific is connected. Otherwise, verify any device is connected.
@@ -493,6 +2440,56 @@ def _verify_device_connected(device: Optional[str] = None) -> List[str]:
     )
 
 
+def _list_connected_devices() -> List[str]:
+    """
+    Returns the serials of all devices listed by `adb devices` that are ready to be used.
+    """
+    output, errors = _get_shell_cmd_output_and_errors(
+        description="Listing connected devices", cmd=("adb", "devices")
+    )
+    if errors or output is None:
+        _log_errors(errors)
+        return []
+
+    devices = []
+    for line in output.splitlines()[1:]:
+        serial, _, state = line.partition("\t")
+        if not state:
+            continue
+        if state.strip() == "device":
+            devices.append(serial.strip())
+        else:
+            logging.info("\tSkipping %s (state: %s)", serial.strip(), state.strip())
+    return devices
+
+
+# Outcome (passed, reason) of every expectation made by a set of checks, keyed by description:
+_CheckStates = Dict[str, Tuple[bool, str]]
+
+
+def _check_states(report_records: Iterable[Dict[str, Any]]) -> _CheckStates:
+    return {
+        record["description"]: (record.get("passed", True), record["reason"])
+        for record in report_records
+        if "reason" in record and not record.get("skipped")
+    }
+
+
+def _watch_events(previous: _CheckStates, current: _CheckStates) -> List[str]:
+    """
+    Describes how the outcome of the checks changed between two polls
+    """
+    events = [
+        "%s: %s (%s)" % ("PASS" if passed else "FAIL", description, reason)
+        for description, (passed, reason) in current.items()
+        if previous.get(description) != (passed, reason)
+    ]
+    events.extend(
+        f"GONE: {description}" for description in sorted(previous.keys() - current.keys())
+    )
+    return events
+
+
 def _check_bort_app_id(bort_app_id: str) -> None:
     if bort_app_id == PLACEHOLDER_BORT_APP_ID:
         sys.exit(
@@ -585,26 +2582,143 @@ class EnableBort(Command):
 
 
 class ValidateConnectedDevice(Command):
-    def __init__(self, bort_app_id, device=None, vendor_feature_name=None):
+    def __init__(
+        self,
+        bort_app_id,
+        devices=None,
+        vendor_feature_name=None,
+        jobs=1,
+        probe=False,
+        all_devices=False,
+        parallel_devices=4,
+        log_file=LOG_FILE,
+        no_cache=False,
+        report=None,
+        report_file=None,
+        rerun_failed=False,
+        watch=False,
+        watch_interval=WATCH_INTERVAL,
+        watch_max_interval=WATCH_MAX_INTERVAL,
+    ):
         self._bort_app_id = bort_app_id
-        self._device = device
+        self._devices = devices or []
+        self._device = self._devices[0] if len(self._devices) == 1 else None
         self._vendor_feature_name = vendor_feature_name or bort_app_id
+        self._jobs = jobs
+        self._probe = probe
+        self._all_devices = all_devices
+        self._parallel_devices = parallel_devices
+        self._log_file = log_file
+        self._report = report
+        self._report_file = report_file or (
+            os.path.splitext(log_file)[0] + REPORT_FILE_EXTENSIONS[report] if report else None
+        )
+        self._cache = None if no_cache else _DeviceFactCache(DEVICE_FACT_CACHE_DIR)
+        self._rerun_failed = rerun_failed
+        self._result_state = _DeviceFactCache(DEVICE_RESULT_STATE_DIR)
+        self._check_results: Dict[str, bool] = {}
+        self._watch = watch
+        self._watch_interval = watch_interval
+        self._watch_max_interval = max(watch_interval, watch_max_interval)
+        self._shell_outputs: _ShellOutputs = {}
+        self._vendor_cil_rule_found: Optional[bool] = None
         self._errors = []
 
     @classmethod
     def register(cls, create_parser):
         parser = create_parser(cls, "validate-sdk-integration")
         parser.add_argument("--bort-app-id", type=android_application_id_type, required=True)
+        devices_group = parser.add_mutually_exclusive_group()
+        devices_group.add_argument(
+            "--device",
+            type=str,
+            action="append",
+            dest="devices",
+            help="Optional device ID passed to ADB's `-s` flag. Repeat to validate multiple devices.",
+        )
+        devices_group.add_argument(
+            "--all-devices",
+            action="store_true",
+            default=False,
+            help="Validate all devices listed by `adb devices`",
+        )
+        parser.add_argument(
+            "--parallel-devices",
+            type=positive_int_type,
+            default=4,
+            help="Number of devices to validate concurrently, when validating multiple devices (default: 4)",
+        )
         parser.add_argument(
-            "--device", type=str, help="Optional device ID passed to ADB's `-s` flag"
+            "--log-file",
+            type=str,
+            default=LOG_FILE,
+            help=f"Path of the log file (default: {LOG_FILE})",
         )
         parser.add_argument(
             "--vendor-feature-name", type=str, help="Defaults to the provided Application ID"
         )
-
-    def _getprop(self, key: str) -> Optional[str]:
-        output, errors = _get_adb_shell_cmd_output_and_errors(
-            description=f"Querying {key}", cmd=("getprop", key), device=self._device
+        parser.add_argument(
+            "--jobs",
+            type=positive_int_type,
+            default=1,
+            help="Number of independent checks to run concurrently (default: 1)",
+        )
+        parser.add_argument(
+            "--probe",
+            action="store_true",
+            default=False,
+            help="Gather the output of all shell commands in a single adb shell invocation",
+        )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            default=False,
+            help="Query all device facts, even those cached for the device's build fingerprint",
+        )
+        parser.add_argument(
+            "--report",
+            choices=sorted(REPORT_FILE_EXTENSIONS),
+            help="Also write a machine-readable report, with a record and timings for every check",
+        )
+        parser.add_argument(
+            "--report-file",
+            type=str,
+            help="Path of the report file (default: the log file path, with a .json or .xml extension)",
+        )
+        parser.add_argument(
+            "--rerun-failed",
+            action="store_true",
+            default=False,
+            help="Only rerun the checks that did not pass in the previous validation of the device, "
+            "unless its build or the Bort packages changed since",
+        )
+        parser.add_argument(
+            "--watch",
+            action="store_true",
+            default=False,
+            help="Keep polling the checks whose outcome can change at runtime (device idle whitelist, "
+            "package versions and permissions) and log every change, until interrupted",
+        )
+        parser.add_argument(
+            "--watch-interval",
+            type=positive_int_type,
+            default=WATCH_INTERVAL,
+            help=f"Seconds between polls after a change was seen (default: {WATCH_INTERVAL})",
+        )
+        parser.add_argument(
+            "--watch-max-interval",
+            type=positive_int_type,
+            default=WATCH_MAX_INTERVAL,
+            help="The interval doubles with every poll that sees no change, up to this many seconds "
+            f"(default: {WATCH_MAX_INTERVAL})",
+        )
+
+    def _getprop(self, key: str) -> Optional[str]:
+        output, errors = _get_adb_shell_cmd_output_and_errors(
+            description=f"Querying {key}",
+            cmd=("getprop", key),
+            device=self._device,
+            known_outputs=self._shell_outputs,
         )
         if errors:
             self._errors.extend(errors)
@@ -620,36 +2734,152 @@ class ValidateConnectedDevice(Command):
         return self._getprop("ro.build.type")
 
     def _check_vendor_sepolicy_cil(self):
-        with tempfile.NamedTemporaryFile() as vendor_cil:
-            _, errors = _get_shell_cmd_output_and_errors(
-                description="Verifying selinux access rules",
-                cmd=_create_adb_command(
-                    ("pull", VENDOR_CIL_PATH, vendor_cil.name), device=self._device
+        description = "Verifying selinux access rules"
+        if self._vendor_cil_rule_found is not None:
+            logging.info("\n%s", description)
+            logging.info("\t%s (already queried)", VENDOR_CIL_PATH)
+            errors = []
+        else:
+            # The rule is usually found long before the end of the file, so stop reading there.
+            # Unlike exec-out, shell reports the exit status, so failing to read the file is an
+            # error rather than a missing rule (and the outcome is not cached):
+            result, _, errors = _stream_shell_cmd_and_match(
+                description=description,
+                cmd=_create_adb_command(("shell", "cat", VENDOR_CIL_PATH), device=self._device),
+                matcher=_RegexMatcher(
+                    r"allow .*_app_.* memfault_dumpster_service \(service_manager \(find\)\)"
                 ),
             )
             if not errors:
-                with open(vendor_cil.name, "r") as cil:
-                    rules = cil.read()
-                    if not re.search(
-                        r"allow .*_app_.* memfault_dumpster_service \(service_manager \(find\)\)",
-                        rules,
-                    ):
-                        errors.extend(
-                            [
-                                "Expected a selinux rule (allow priv_app memfault_dumpster_service:service_manager find), please recheck integration"
-                            ]
-                        )
+                self._vendor_cil_rule_found = result[0]
+
+        if not errors and not self._vendor_cil_rule_found:
+            errors.extend(
+                [
+                    "Expected a selinux rule (allow priv_app memfault_dumpster_service:service_manager find), please recheck integration"
+                ]
+            )
+            _validation_report.record(description, passed=False, reason=errors[0])
+
+        return errors
 
+    def _package_path_cmds(self) -> List[Tuple[str, ...]]:
+        return [("pm", "path", USAGE_REPORTER_APPLICATION_ID), ("pm", "path", self._bort_app_id)]
+
+    def _query_cache_key(self) -> Optional[Tuple[str, str]]:
+        outputs = _probe_shell_outputs(
+            cmds=[
+                ("getprop", "ro.serialno"),
+                *(("getprop", prop) for prop in BUILD_FINGERPRINT_PROPS),
+                *self._package_path_cmds(),
+            ],
+            device=self._device,
+        )
+        # Needed for the result state, and by the package checks:
+        for cmd in self._package_path_cmds():
+            if cmd in outputs:
+                self._shell_outputs[cmd] = outputs[cmd]
+        serial, _ = outputs.get(("getprop", "ro.serialno"), (None, []))
+        fingerprints = [
+            outputs.get(("getprop", prop), (None, []))[0] for prop in BUILD_FINGERPRINT_PROPS
+        ]
+        if not serial or not fingerprints[0]:
+            return None
+        # Partitions without a fingerprint of their own (older Android versions) are left out:
+        return serial, " ".join(fingerprint for fingerprint in fingerprints if fingerprint)
+
+    def _load_cached_facts(self, cache_key: Tuple[str, str]) -> None:
+        facts = self._cache.load(*cache_key)
+        if not facts:
+            logging.info("\tNo cached device facts for %s", cache_key[1])
+            return
+
+        logging.info("\tUsing cached device facts for %s", cache_key[1])
+        for cmd, output in facts.get("shell_outputs", []):
+            self._shell_outputs[tuple(cmd)] = output, []
+        self._vendor_cil_rule_found = facts.get("vendor_cil_rule_found")
+
+    def _store_cached_facts(self, cache_key: Tuple[str, str]) -> None:
+        shell_outputs = [
+            (cmd, self._shell_outputs[cmd][0])
+            for cmd in STATIC_SHELL_CMDS
+            if cmd in self._shell_outputs and not self._shell_outputs[cmd][1]
+        ]
+        self._cache.store(
+            *cache_key,
+            {"shell_outputs": shell_outputs, "vendor_cil_rule_found": self._vendor_cil_rule_found},
+        )
+
+    def _result_state_fingerprint(self) -> Dict[str, Any]:
+        """
+        Everything besides the device build that the outcome of the checks depends on. Reinstalling
+        a package moves it to a new code path.
+        """
+        return {
+            "bort_app_id": self._bort_app_id,
+            "vendor_feature_name": self._vendor_feature_name,
+            "package_paths": [
+                self._shell_outputs.get(cmd, (None, []))[0] for cmd in self._package_path_cmds()
+            ],
+        }
+
+    def _load_previous_results(self, cache_key: Tuple[str, str]) -> Optional[Dict[str, bool]]:
+        state = self._result_state.load(*cache_key)
+        if not state:
+            logging.info("\tNo previous results for %s, running all checks", cache_key[1])
+            return None
+        if state.get("fingerprint") != self._result_state_fingerprint():
+            logging.info(
+                "\tBort packages or options changed since the previous run, running all checks"
+            )
+            return None
+        return state.get("results", {})
+
+    def _store_results(
+        self, cache_key: Tuple[str, str], previous_results: Optional[Dict[str, bool]]
+    ) -> None:
+        results = {**(previous_results or {}), **self._check_results}
+        self._result_state.store(
+            *cache_key, {"fingerprint": self._result_state_fingerprint(), "results": results}
+        )
+
+    def _failed_checks(
+        self, checks: List[_Check], previous_results: Dict[str, bool]
+    ) -> List[_Check]:
+        failed = []
+        for check in checks:
+            name = _check_name(check)
+            if previous_results.get(name):
+                logging.info("\nSkipping check that passed previously: %s", name)
+                _validation_report.record(name, skipped=True, reason="Passed previously")
+                continue
+            failed.append(check)
+            # Cached facts would only reproduce the previous failure:
+            if isinstance(check, _ShellCheck):
+                self._shell_outputs.pop(tuple(check.cmd), None)
+            elif name == self._check_vendor_sepolicy_cil.__name__:
+                self._vendor_cil_rule_found = None
+        return failed
+
+    def _track_result(self, check: _Check) -> _Check:
+        name = _check_name(check)
+
+        def _run() -> List[str]:
+            errors = check()
+            self._check_results[name] = not errors
             return errors
 
-    def _run_checks_requiring_root(self, sdk_version: int):
+        return _run
+
+    def _restart_adb_as_root(self):
         _run_shell_cmd_and_expect(
             description="Restarting ADB with root permissions",
             cmd=_create_adb_command(("root",), device=self._device),
             matcher=_AlwaysMatcher(),
         )
 
-        self._errors.extend(
+    def _checks_requiring_root(self, sdk_version: int) -> List[_Check]:
+        checks: List[_Check] = [
             _check_file_ownership_and_secontext(
                 path=MEMFAULT_DUMPSTATE_RUNNER_PATH,
                 mode="-rwxr-xr-x",
@@ -657,10 +2887,8 @@ class ValidateConnectedDevice(Command):
                 group="shell",
                 secontext="u:object_r:dumpstate_exec:s0",
                 device=self._device,
-            )
-        )
-
-        self._errors.extend(
+                known_outputs=self._shell_outputs,
+            ),
             _check_file_ownership_and_secontext(
                 path=MEMFAULT_INIT_RC_PATH,
                 mode="-rw-r--r--",
@@ -668,10 +2896,8 @@ class ValidateConnectedDevice(Command):
                 group="root",
                 secontext="u:object_r:system_file:s0",
                 device=self._device,
-            )
-        )
-
-        self._errors.extend(
+                known_outputs=self._shell_outputs,
+            ),
             _check_file_ownership_and_secontext(
                 path=MEMFAULT_DUMPSTER_PATH,
                 mode="-rwxr-xr-x",
@@ -679,10 +2905,8 @@ class ValidateConnectedDevice(Command):
                 group="shell",
                 secontext="u:object_r:dumpstate_exec:s0",
                 device=self._device,
-            )
-        )
-
-        self._errors.extend(
+                known_outputs=self._shell_outputs,
+            ),
             _check_file_ownership_and_secontext(
                 path=MEMFAULT_DUMPSTER_RC_PATH,
                 mode="-rw-r--r--",
@@ -690,10 +2914,8 @@ class ValidateConnectedDevice(Command):
                 group="root",
                 secontext="u:object_r:system_file:s0",
                 device=self._device,
-            )
-        )
-
-        self._errors.extend(
+                known_outputs=self._shell_outputs,
+            ),
             _check_file_ownership_and_secontext(
                 path=f"/data/data/{self._bort_app_id}/",
                 mode="drwx------",
@@ -702,10 +2924,8 @@ class ValidateConnectedDevice(Command):
                 secontext="u:object_r:bort_app_data_file:s0",
                 directory=True,
                 device=self._device,
-            )
-        )
-
-        self._errors.extend(
+                known_outputs=self._shell_outputs,
+            ),
             _check_file_ownership_and_secontext(
                 path=MEMFAULT_STRUCTURED_RC_PATH,
                 mode="-rw-r--r--",
@@ -713,10 +2933,8 @@ class ValidateConnectedDevice(Command):
                 group="root",
                 secontext="u:object_r:system_file:s0",
                 device=self._device,
-            )
-        )
-
-        self._errors.extend(
+                known_outputs=self._shell_outputs,
+            ),
             _check_file_ownership_and_secontext(
                 path=MEMFAULT_STRUCTURED_EXEC_PATH,
                 mode="-rwxr-xr-x",
@@ -725,10 +2943,8 @@ class ValidateConnectedDevice(Command):
                 secontext="u:object_r:memfault_structured_exec:s0",
                 directory=True,
                 device=self._device,
-            )
-        )
-
-        self._errors.extend(
+                known_outputs=self._shell_outputs,
+            ),
             _check_file_ownership_and_secontext(
                 path=MEMFAULT_STRUCTURED_DATA_PATH,
                 mode="drwx------",
@@ -737,13 +2953,18 @@ class ValidateConnectedDevice(Command):
                 secontext="u:object_r:memfault_structured_data_file:s0",
                 directory=True,
                 device=self._device,
-            )
-        )
+                known_outputs=self._shell_outputs,
+            ),
+        ]
 
         if sdk_version >= 28:
-            self._errors.extend(self._check_vendor_sepolicy_cil())
+            checks.append(self._check_vendor_sepolicy_cil)
 
-    def _check_bort_permissions(self, bort_package_info: Optional[str], sdk_version: int):
+        return checks
+
+    @staticmethod
+    def _check_bort_permissions(bort_package_info: Optional[str], sdk_version: int) -> List[str]:
+        errors = []
         for permission, min_sdk_version in (
             ("android.permission.FOREGROUND_SERVICE", 28),
             ("android.permission.RECEIVE_BOOT_COMPLETED", 1),
@@ -752,6 +2973,7 @@ class ValidateConnectedDevice(Command):
             ("android.permission.DUMP", 1),
             ("android.permission.WAKE_LOCK", 1),
         ):
+            description = f"Verifying MemfaultBort app has permission '{permission}'"
             if sdk_version < min_sdk_version:
                 logging.info(
                     "\nSkipping check for '%s' because it is not supported (SDK version %d < %d)",
@@ -759,44 +2981,238 @@ class ValidateConnectedDevice(Command):
                     sdk_version,
                     min_sdk_version,
                 )
+                _validation_report.record(
+                    description,
+                    skipped=True,
+                    reason=f"SDK version {sdk_version} < {min_sdk_version}",
+                )
                 continue
-            description = f"Verifying MemfaultBort app has permission '{permission}'"
             logging.info("\n%s", description)
-            self._errors.extend(
+            errors.extend(
                 _expect_or_errors(
                     output=bort_package_info,
                     description=description,
                     matcher=_RegexMatcher(rf"{permission}: granted=true"),
                 )
             )
+        return errors
 
-    def _check_package_versions(self, *package_infos: Optional[str]):
+    @staticmethod
+    def _check_package_versions(*package_infos: Optional[str]) -> List[str]:
         description = "\nVerifying Bort packages have the same version"
         logging.info(description)
         if not all(package_infos):
             logging.info("\t Test failed")
-            self._errors.append(_format_error(description, "Missing package info"))
-            return
+            _validation_report.record(description, passed=False, reason="Missing package info")
+            return [_format_error(description, "Missing package info")]
+
+        errors = []
 
         def _find_version_names(info: str):
             version_names = re.findall(r"versionName=(\S+)", info, re.RegexFlag.MULTILINE)
             if len(version_names) > 1:
-                self._errors.append(
+                errors.append(
                     _format_error(description, "Multiple versions of same package found:", info)
                 )
             return version_names[0]
 
         versions = set(_find_version_names(info) for info in package_infos if info)
         if len(versions) > 1:
-            self._errors.append(
-                _format_error(description, "Different versions found:", *package_infos)
-            )
+            errors.append(_format_error(description, "Different versions found:", *package_infos))
+        _validation_report.record(
+            description,
+            passed=not errors,
+            reason="Found versions: %s" % ", ".join(sorted(versions)),
+        )
 
         logging.info("\tTest passed")
+        return errors
+
+    def _check_package_infos(self, sdk_version: int) -> List[str]:
+        errors = []
+
+        def _get_package_info(app_id: str) -> Optional[str]:
+            package_info, package_errors = _run_adb_shell_dumpsys_package(
+                app_id, device=self._device, known_outputs=self._shell_outputs
+            )
+            errors.extend(package_errors)
+            return package_info
+
+        bort_package_info, usage_reporter_package_info = map(
+            _get_package_info, (self._bort_app_id, USAGE_REPORTER_APPLICATION_ID)
+        )
+
+        errors.extend(self._check_bort_permissions(bort_package_info, sdk_version))
+        errors.extend(self._check_package_versions(bort_package_info, usage_reporter_package_info))
+        return errors
+
+    def _probe_cmds(self, checks: Iterable[_Check]) -> List[Tuple[str, ...]]:
+        return [check.cmd for check in checks if isinstance(check, _ShellCheck)] + [
+            _dumpsys_package_cmd(app_id)
+            for app_id in (self._bort_app_id, USAGE_REPORTER_APPLICATION_ID)
+        ]
+
+    def _checks(self, sdk_version: int) -> List[_Check]:
+        return [
+            _ShellCheck(
+                description="Verifying MemfaultUsageReporter app is installed",
+                cmd=("pm", "path", USAGE_REPORTER_APPLICATION_ID),
+                matcher=_RegexMatcher(USAGE_REPORTER_APK_PATH),
+                device=self._device,
+                known_outputs=self._shell_outputs,
+            ),
+            _ShellCheck(
+                description="Verifying MemfaultBort app is installed",
+                cmd=("pm", "path", self._bort_app_id),
+                matcher=_RegexMatcher(BORT_APK_PATH),
+                device=self._device,
+                known_outputs=self._shell_outputs,
+            ),
+            _ShellCheck(
+                description=f"Verifying device has feature {self._vendor_feature_name}",
+                cmd=("pm", "list", "features"),
+                matcher=_RegexMatcher(rf"^feature\:{self._vendor_feature_name}$"),
+                device=self._device,
+                known_outputs=self._shell_outputs,
+                # The full output is needed to cache it:
+                stream=self._cache is None,
+            ),
+            functools.partial(self._check_package_infos, sdk_version),
+            self._idle_whitelist_check(),
+        ]
+
+    def _idle_whitelist_check(self) -> _ShellCheck:
+        return _ShellCheck(
+            description="Verifying MemfaultBort is on device idle whitelist",
+            cmd=("dumpsys", "deviceidle"),
+            matcher=_IdleWhitelistMatcher(self._bort_app_id),
+            device=self._device,
+            known_outputs=self._shell_outputs,
+            stream=True,
+        )
+
+    def _poll_volatile_checks(self, sdk_version: int) -> List[Dict[str, Any]]:
+        """
+        Runs the checks whose outcome can change without reflashing the device, with all their
+        shell commands in a single adb shell invocation. Returns their report records.
+        Nothing is reused from earlier polls, and their log output is discarded.
+        """
+        self._shell_outputs = {}
+        checks = [
+            self._idle_whitelist_check(),
+            functools.partial(self._check_package_infos, sdk_version),
+        ]
+
+        def _poll() -> List[str]:
+            self._shell_outputs.update(
+                _probe_shell_outputs(cmds=self._probe_cmds(checks), device=self._device)
+            )
+            return _run_checks(checks)
+
+        logger = logging.getLogger()
+        log_filter = _DeferredLogFilter()
+        logger.addFilter(log_filter)
+        try:
+            (_, report_records), _ = log_filter.capture(
+                functools.partial(_validation_report.capture, _poll)
+            )
+        finally:
+            logger.removeFilter(log_filter)
+        return report_records
+
+    def _device_log_file(self, device: str) -> str:
+        root, ext = os.path.splitext(self._log_file)
+        return "%s-%s%s" % (root, re.sub(r"[^\w.-]", "_", device), ext)
+
+    def _device_report_file(self, device: str) -> str:
+        root, ext = os.path.splitext(self._report_file)
+        return "%s-%s%s" % (root, re.sub(r"[^\w.-]", "_", device), ext)
+
+    def _validate_device_in_subprocess(self, device: str) -> Tuple[bool, float, str]:
+        cmd = [
+            sys.executable,
+            os.path.realpath(__file__),
+            "--adb-transport",
+            _adb_transport.NAME,
+            "validate-sdk-integration",
+            "--bort-app-id",
+            self._bort_app_id,
+            "--vendor-feature-name",
+            self._vendor_feature_name,
+            "--device",
+            device,
+            "--log-file",
+            self._device_log_file(device),
+            "--jobs",
+            str(self._jobs),
+            *(("--probe",) if self._probe else ()),
+            *(("--no-cache",) if self._cache is None else ()),
+            *(("--rerun-failed",) if self._rerun_failed else ()),
+            *(
+                ("--report", self._report, "--report-file", self._device_report_file(device))
+                if self._report
+                else ()
+            ),
+        ]
+        start = time.monotonic()
+        with _tracer.subprocess_span(cmd) as span_args:
+            result = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                encoding=DEFAULT_ENCODING,
+                errors="replace",
+            )
+            span_args["stdout_bytes"] = len(result.stdout.encode(DEFAULT_ENCODING))
+        duration = time.monotonic() - start
+        output_lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+        return result.returncode == 0, duration, output_lines[-1] if output_lines else ""
+
+    def _run_fleet(self, devices: List[str]):
+        logging.info("Validating %d devices (%d at a time)", len(devices), self._parallel_devices)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._parallel_devices) as executor:
+            results = list(executor.map(self._validate_device_in_subprocess, devices))
+
+        device_width = max(len("DEVICE"), *map(len, devices))
+        logging.info("")
+        logging.info("%-*s  %-6s  %8s  %s", device_width, "DEVICE", "RESULT", "TIME", "LOG")
+        for device, (passed, duration, summary) in zip(devices, results):
+            logging.info(
+                "%-*s  %-6s  %7.1fs  %s",
+                device_width,
+                device,
+                "PASS" if passed else "FAIL",
+                duration,
+                self._device_log_file(device),
+            )
+            if not passed:
+                logging.info("%-*s  %s", device_width, "", summary)
+
+        failed = sum(1 for passed, _, _ in results if not passed)
+        if failed:
+            sys.exit(f" Failure: {failed} of {len(devices)} devices failed validation")
+
+        logging.info("")
+        logging.info("SUCCESS: Bort SDK on all %d devices appears to be valid", len(devices))
 
     def run(self):
-        should_rollover = os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0
-        fh = logging.handlers.RotatingFileHandler(LOG_FILE, backupCount=5)
+        if self._watch and (self._all_devices or len(self._devices) > 1):
+            sys.exit("Failure: --watch can only be used with a single device")
+
+        if self._all_devices:
+            devices = _list_connected_devices()
+            if not devices:
+                sys.exit("Failure: no connected devices found. No tests run.")
+            return self._run_fleet(devices)
+
+        if len(self._devices) > 1:
+            return self._run_fleet(list(dict.fromkeys(self._devices)))
+
+        self._validate()
+
+    def _validate(self):
+        should_rollover = os.path.exists(self._log_file) and os.path.getsize(self._log_file) > 0
+        fh = logging.handlers.RotatingFileHandler(self._log_file, backupCount=5)
         if should_rollover:
             fh.doRollover()
         fh.setLevel(logging.DEBUG)
@@ -806,78 +3222,404 @@ class ValidateConnectedDevice(Command):
         _check_feature_name(self._vendor_feature_name)
         logging.info(LOG_ENTRY_SEPARATOR)
         logging.info("validate-sdk-integration %s", datetime.datetime.now())
+
+        start = time.monotonic()
+        passed = False
+        try:
+            if self._watch:
+                self._watch_device()
+            else:
+                self._validate_device()
+            passed = True
+        finally:
+            if self._report:
+                self._write_report(passed=passed, duration=time.monotonic() - start)
+
+    def _write_report(self, *, passed: bool, duration: float) -> None:
+        if self._report == "junit":
+            content = _validation_report.to_junit("validate-sdk-integration")
+        else:
+            content = _validation_report.to_json(
+                device=self._device, passed=passed, duration=duration
+            )
+        _write_file(self._report_file, content)
+        logging.info("Report written to %s", self._report_file)
+
+    def _watch_device(self):
+        errors = _verify_device_connected(self._device)
+        if errors:
+            _log_errors(errors)
+            sys.exit("Failure: device not found. No tests run.")
+
+        sdk_version = self._query_sdk_version()
+        if not sdk_version:
+            sys.exit("Failure: could not get SDK version.")
+
+        logging.info("\nWatching the device, press Ctrl-C to stop")
+        states: _CheckStates = {}
+        report_records: List[Dict[str, Any]] = []
+        interval = self._watch_interval
+        try:
+            while True:
+                report_records = self._poll_volatile_checks(sdk_version)
+                new_states = _check_states(report_records)
+                events = _watch_events(states, new_states)
+                timestamp = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+                for event in events:
+                    logging.info("%s %s", timestamp, event)
+                states = new_states
+
+                # Poll often while the device is changing, back off while it is not:
+                interval = (
+                    self._watch_interval if events else min(2 * interval, self._watch_max_interval)
+                )
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logging.info("\nStopped watching the device")
+
+        # The report describes the latest poll:
+        _validation_report.records.extend(report_records)
+        failed = [description for description, (passed, _) in states.items() if not passed]
+        if failed:
+            sys.exit(f" Failure: {len(failed)} checks failing when stopped. See {self._log_file}")
+
+        logging.info("")
+        logging.info("SUCCESS: Bort SDK on the connected device appears to be valid")
+        logging.info("Results written to %s", self._log_file)
+
+    def _validate_device(self):
         errors = _verify_device_connected(self._device)
         if errors:
             _log_errors(errors)
             sys.exit("Failure: device not found. No tests run.")
 
+        # Without the cache and --rerun-failed, neither the build fingerprint nor the results of
+        # this run are needed, so nothing is queried for them or written under CACHE_DIR:
+        cache_key = self._query_cache_key() if self._cache or self._rerun_failed else None
+        if cache_key and self._cache:
+            self._load_cached_facts(cache_key)
+        previous_results = (
+            self._load_previous_results(cache_key) if cache_key and self._rerun_failed else None
+        )
+
+        if self._probe:
+            self._shell_outputs.update(
+                _probe_shell_outputs(
+                    cmds=[
+                        cmd
+                        for cmd in (
+                            ("getprop", "ro.build.version.sdk"),
+                            ("getprop", "ro.build.type"),
+                        )
+                        if cmd not in self._shell_outputs
+                    ],
+                    device=self._device,
+                )
+            )
+
         sdk_version = self._query_sdk_version()
         if not sdk_version:
             sys.exit("Failure: could not get SDK version.")
 
+        root_checks: List[_Check] = []
         build_type = self._query_build_type()
         if build_type == "user":
             logging.info(
                 "'%s' build detected. Skipping validation checks that require adb root!", build_type
             )
         else:
-            self._run_checks_requiring_root(sdk_version)
+            root_checks = self._checks_requiring_root(sdk_version)
+        other_checks = self._checks(sdk_version)
+        if previous_results is not None:
+            root_checks = self._failed_checks(root_checks, previous_results)
+            other_checks = self._failed_checks(other_checks, previous_results)
+        if root_checks:
+            self._restart_adb_as_root()
+        checks = root_checks + other_checks
+
+        if self._probe:
+            self._shell_outputs.update(
+                _probe_shell_outputs(
+                    cmds=[
+                        cmd for cmd in self._probe_cmds(checks) if cmd not in self._shell_outputs
+                    ],
+                    device=self._device,
+                )
+            )
 
         self._errors.extend(
-            _run_adb_shell_cmd_and_expect(
-                description="Verifying MemfaultUsageReporter app is installed",
-                cmd=("pm", "path", USAGE_REPORTER_APPLICATION_ID),
-                matcher=_RegexMatcher(USAGE_REPORTER_APK_PATH),
-                device=self._device,
-            )
+            _run_checks([self._track_result(check) for check in checks], jobs=self._jobs)
         )
-        self._errors.extend(
-            _run_adb_shell_cmd_and_expect(
-                description="Verifying MemfaultBort app is installed",
-                cmd=("pm", "path", self._bort_app_id),
-                matcher=_RegexMatcher(BORT_APK_PATH),
-                device=self._device,
+
+        if cache_key:
+            if self._cache:
+                self._store_cached_facts(cache_key)
+            self._store_results(cache_key, previous_results)
+
+        if self._errors:
+            for error in self._errors:
+                logging.info(LOG_ENTRY_SEPARATOR)
+                logging.info(error)
+            sys.exit(f" Failure: One or more errors detected. See {self._log_file} for details")
+
+        logging.info("")
+        logging.info("SUCCESS: Bort SDK on the connected device appears to be valid")
+        logging.info("Results written to %s", self._log_file)
+
+
+class _StructuredLogsTable(NamedTuple):
+    order_by: str
+    # Columns that --since/--until, --type and --boot-id filter on, if the table has them:
+    timestamp_column: Optional[str]
+    type_column: Optional[str]
+    boot_column: Optional[str]
+
+
+# Tables of the MemfaultStructuredLogd database (see MemfaultStructuredLogd/src/storage.cpp):
+STRUCTURED_LOGS_TABLES = {
+    "log": _StructuredLogsTable("rowid", "timestamp", "type", "bootRowId"),
+    "boot_ids": _StructuredLogsTable("id", None, None, "id"),
+    "report_metric": _StructuredLogsTable("timestamp", "timestamp", "type", None),
+    "report": _StructuredLogsTable("type", "startTimestamp", "type", None),
+}
+
+
+def _iter_row_chunks(cursor: sqlite3.Cursor) -> Iterator[List[Tuple]]:
+    """
+    Yields the rows of the cursor in chunks, so that no table is ever held in memory as a whole.
+    """
+    while True:
+        rows = cursor.fetchmany(STRUCTURED_LOGS_CHUNK_ROWS)
+        if not rows:
+            return
+        yield rows
+
+
+def _structured_logs_query(
+    table: str,
+    *,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    types: Sequence[str] = (),
+    boot_id: Optional[str] = None,
+) -> Tuple[str, List[Any]]:
+    """
+    Builds the query of export-structured-logs. The conditions are plain comparisons on the
+    indexed columns, so that SQLite can use the indexes of the table to find the rows.
+    """
+    spec = STRUCTURED_LOGS_TABLES[table]
+    conditions: List[str] = []
+    params: List[Any] = []
+    for option, value, column in (
+        ("--since/--until", since is not None or until is not None, spec.timestamp_column),
+        ("--type", types, spec.type_column),
+        ("--boot-id", boot_id, spec.boot_column),
+    ):
+        if value and column is None:
+            raise ValueError(f"{option} does not apply to the {table} table")
+    if since is not None:
+        conditions.append(f"{spec.timestamp_column} >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append(f"{spec.timestamp_column} < ?")
+        params.append(until)
+    if types:
+        conditions.append(f"{spec.type_column} IN ({', '.join('?' for _ in types)})")
+        params.extend(types)
+    if boot_id:
+        conditions.append(f"{spec.boot_column} IN (SELECT id FROM boot_ids WHERE uuid = ?)")
+        params.append(boot_id)
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT * FROM {table}{where} ORDER BY {spec.order_by}", params
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _write_structured_log_rows(
+    output: IO[str], output_format: str, columns: List[str], chunks: Iterable[List[Tuple]]
+) -> int:
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+            count += len(rows)
+    else:
+        for rows in chunks:
+            output.writelines(
+                json.dumps(dict(zip(columns, row)), default=_json_default) + "\n" for row in rows
             )
+            count += len(rows)
+    return count
+
+
+class ExportStructuredLogs(Command):
+    def __init__(
+        self,
+        table="log",
+        output_format="ndjson",
+        output_file=None,
+        db_file=None,
+        since=None,
+        until=None,
+        types=None,
+        boot_id=None,
+        device=None,
+    ):
+        self._table = table
+        self._output_format = output_format
+        self._output_file = output_file
+        self._db_file = db_file
+        self._since = since
+        self._until = until
+        self._types = types or []
+        self._boot_id = boot_id
+        self._device = device
+
+    @classmethod
+    def register(cls, create_parser):
+        parser = create_parser(cls, "export-structured-logs")
+        parser.add_argument(
+            "--table",
+            choices=sorted(STRUCTURED_LOGS_TABLES),
+            default="log",
+            help="Table of the MemfaultStructuredLogd database to export (default: log)",
         )
-        self._errors.extend(
-            _run_adb_shell_cmd_and_expect(
-                description=f"Verifying device has feature {self._vendor_feature_name}",
-                cmd=("pm", "list", "features"),
-                matcher=_RegexMatcher(rf"^feature\:{self._vendor_feature_name}$"),
-                device=self._device,
-            )
+        parser.add_argument(
+            "--format",
+            dest="output_format",
+            choices=STRUCTURED_LOGS_FORMATS,
+            default="ndjson",
+            help="Write one JSON object per row, or CSV with a header row (default: ndjson)",
+        )
+        parser.add_argument(
+            "--output-file", type=str, help="Path of the file to write to (default: stdout)"
+        )
+        parser.add_argument(
+            "--db-file",
+            type=str,
+            help="Export from this copy of the database instead of pulling it from the device",
+        )
+        parser.add_argument(
+            "--since", type=int, help="Only export rows with this timestamp or a later one"
+        )
+        parser.add_argument("--until", type=int, help="Only export rows before this timestamp")
+        parser.add_argument(
+            "--type",
+            action="append",
+            dest="types",
+            help="Only export rows of this type. Repeat to export several types.",
+        )
+        parser.add_argument(
+            "--boot-id", type=str, help="Only export rows logged during the boot with this UUID"
+        )
+        parser.add_argument(
+            "--device",
+            type=str,
+            help="Optional device ID passed to ADB's `-s` flag. Required if multiple devices are connected.",
         )
 
-        def _get_package_info(app_id: str) -> Optional[str]:
-            package_info, errors = _run_adb_shell_dumpsys_package(app_id, device=self._device)
-            self._errors.extend(errors)
-            return package_info
+    def _adb(self, description: str, cmd: Tuple) -> List[str]:
+        _, errors = _get_shell_cmd_output_and_errors(
+            description=description, cmd=_create_adb_command(cmd, device=self._device)
+        )
+        return errors
 
-        bort_package_info, usage_reporter_package_info = map(
-            _get_package_info, (self._bort_app_id, USAGE_REPORTER_APPLICATION_ID)
+    def _adb_shell(self, description: str, cmd: Tuple) -> List[str]:
+        _, errors = _get_adb_shell_cmd_output_and_errors(
+            description=description, cmd=cmd, device=self._device
         )
+        return errors
 
-        self._check_bort_permissions(bort_package_info, sdk_version)
-        self._check_package_versions(bort_package_info, usage_reporter_package_info)
+    def _pull(self, remote_path: str, local_path: str) -> None:
+        errors = self._adb(f"Pulling {remote_path}", ("pull", remote_path, local_path))
+        if errors:
+            _log_errors(errors)
+            sys.exit(f" Failure: unable to pull {remote_path}")
 
-        self._errors.extend(
-            _run_adb_shell_cmd_and_expect(
-                description="Verifying MemfaultBort is on device idle whitelist",
-                cmd=("dumpsys", "deviceidle"),
-                matcher=_IdleWhitelistMatcher(self._bort_app_id),
-                device=self._device,
+    def _pull_db(self, directory: str) -> str:
+        errors = self._adb("Restarting ADB with root permissions", ("root",))
+        if errors:
+            _log_errors(errors)
+            sys.exit(" Failure: unable to restart ADB with root permissions")
+
+        db_file = os.path.join(directory, os.path.basename(MEMFAULT_STRUCTURED_DB_PATH))
+        # MemfaultStructuredLogd keeps writing to the database. If the device has the sqlite3 tool
+        # (eng and userdebug builds do), take a consistent snapshot of it to pull:
+        snapshot = shlex.quote(f".backup {STRUCTURED_LOGS_SNAPSHOT_PATH}")
+        if not self._adb_shell(
+            "Snapshotting the MemfaultStructuredLogd database",
+            ("sqlite3", MEMFAULT_STRUCTURED_DB_PATH, snapshot),
+        ):
+            try:
+                self._pull(STRUCTURED_LOGS_SNAPSHOT_PATH, db_file)
+            finally:
+                self._adb_shell(
+                    "Removing the snapshot", ("rm", "-f", STRUCTURED_LOGS_SNAPSHOT_PATH)
+                )
+            return db_file
+
+        # Otherwise, pull the rollback journal along with the database, if there is one. SQLite
+        # rolls back the changes of a transaction that was in progress when the files were pulled
+        # once the copy is opened:
+        self._pull(MEMFAULT_STRUCTURED_DB_PATH, db_file)
+        journal = MEMFAULT_STRUCTURED_DB_PATH + "-journal"
+        if not self._adb_shell(f"Checking for {journal}", ("test", "-e", journal)):
+            self._pull(journal, db_file + "-journal")
+        try:
+            with contextlib.closing(sqlite3.connect(db_file)) as connection:
+                (result,) = connection.execute("PRAGMA quick_check").fetchone()
+        except sqlite3.DatabaseError as error:
+            result = str(error)
+        if result != "ok":
+            sys.exit(
+                f" Failure: the database changed while it was pulled ({result}). Please try again."
             )
-        )
+        return db_file
 
-        if self._errors:
-            for error in self._errors:
-                logging.info(LOG_ENTRY_SEPARATOR)
-                logging.info(error)
-            sys.exit(f" Failure: One or more errors detected. See {LOG_FILE} for details")
+    def _export(self, db_file: str, output: IO[str]) -> int:
+        try:
+            query, params = _structured_logs_query(
+                self._table,
+                since=self._since,
+                until=self._until,
+                types=self._types,
+                boot_id=self._boot_id,
+            )
+        except ValueError as error:
+            sys.exit(str(error))
 
-        logging.info("")
-        logging.info("SUCCESS: Bort SDK on the connected device appears to be valid")
-        logging.info("Results written to %s", LOG_FILE)
+        # Read-only, so that exporting never changes the database (e.g. by rolling back a journal):
+        try:
+            with contextlib.closing(
+                sqlite3.connect(
+                    f"{pathlib.Path(os.path.abspath(db_file)).as_uri()}?mode=ro", uri=True
+                )
+            ) as connection:
+                cursor = connection.execute(query, params)
+                columns = [column[0] for column in cursor.description]
+                return _write_structured_log_rows(
+                    output, self._output_format, columns, _iter_row_chunks(cursor)
+                )
+        except sqlite3.DatabaseError as error:
+            sys.exit(f" Failure: unable to read {db_file}: {error}")
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_file = self._db_file or self._pull_db(directory)
+            with _tracer.span("export", "structured-logs", path=db_file, table=self._table):
+                if self._output_file:
+                    with open(self._output_file, "w", newline="") as output:
+                        count = self._export(db_file, output)
+                else:
+                    count = self._export(db_file, sys.stdout)
+        logging.info("Exported %d rows of the %s table", count, self._table)
 
 
 class CommandLineInterface:
@@ -885,6 +3627,20 @@ class CommandLineInterface:
         self._root_parser = argparse.ArgumentParser(
             description="Prepares and validates an AOSP device for Memfault Bort."
         )
+        self._root_parser.add_argument(
+            "--adb-transport",
+            choices=sorted(ADB_TRANSPORTS),
+            default="client",
+            help="How to run adb commands: by spawning the adb client for every command (default), "
+            "or by talking to the adb server directly",
+        )
+        self._root_parser.add_argument(
+            "--trace-file",
+            type=str,
+            default=os.environ.get(TRACE_FILE_ENV),
+            help="Append a Chrome trace (for chrome://tracing or ui.perfetto.dev) of every subprocess "
+            f"and file read/write to this file (default: ${TRACE_FILE_ENV})",
+        )
         subparsers = self._root_parser.add_subparsers()
 
         def create_parser(command, *args, **kwargs):
@@ -897,6 +3653,7 @@ class CommandLineInterface:
         ValidateConnectedDevice.register(create_parser)
         RequestBugReport.register(create_parser)
         EnableBort.register(create_parser)
+        ExportStructuredLogs.register(create_parser)
 
     def run(self):
         version = tuple(int(x) for x in platform.python_version_tuple())
@@ -910,6 +3667,12 @@ class CommandLineInterface:
 
         args = vars(self._root_parser.parse_args())
         command = args.pop("command", None)
+        _set_adb_transport(args.pop("adb_transport"))
+        trace_file = args.pop("trace_file")
+        if trace_file:
+            _tracer.enable(trace_file)
+            # Processes spawned to validate several devices add to the same trace:
+            os.environ[TRACE_FILE_ENV] = os.path.abspath(trace_file)
 
         if not command:
             self._root_parser.print_help()
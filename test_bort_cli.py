@@ -0,0 +1,1118 @@
+import contextlib
+import functools
+import glob
+import json
+import logging
+import os
+import shutil
+import socketserver
+import sqlite3
+import subprocess
+import threading
+import time
+
+import pytest
+
+import bort_cli
+
+
+class _FakeAdbServerHandler(socketserver.BaseRequestHandler):
+    def _recv_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _read_request(self):
+        length = self._recv_exactly(4)
+        if length is None:
+            return None
+        return self._recv_exactly(int(length, 16)).decode()
+
+    def _okay(self, payload=None):
+        self.request.sendall(b"OKAY")
+        if payload is not None:
+            self.request.sendall(b"%04x" % len(payload) + payload.encode())
+
+    def _fail(self, message):
+        self.request.sendall(b"FAIL" + b"%04x" % len(message) + message.encode())
+
+    def _sync(self):
+        header = self._recv_exactly(8)
+        path = self._recv_exactly(int.from_bytes(header[4:], "little")).decode()
+        assert header[:4] == b"RECV"
+        try:
+            with open(path, "rb") as file:
+                while True:
+                    data = file.read(4096)
+                    if not data:
+                        break
+                    self.request.sendall(b"DATA" + len(data).to_bytes(4, "little") + data)
+        except OSError as error:
+            message = error.strerror.encode()
+            self.request.sendall(b"FAIL" + len(message).to_bytes(4, "little") + message)
+            return
+        self.request.sendall(b"DONE" + bytes(4))
+        assert self._recv_exactly(8) == b"QUIT" + bytes(4)
+
+    def handle(self):
+        server = self.server
+        while True:
+            request = self._read_request()
+            if request is None:
+                return
+            server.requests.append(request)
+
+            if request == "host:devices":
+                return self._okay(
+                    "".join(
+                        f"{serial}\t{server.device_states.get(serial, 'device')}\n"
+                        for serial in server.devices
+                    )
+                )
+            if request.startswith("host-serial:") and request.endswith(":features"):
+                return self._okay(",".join(server.features))
+            if request.startswith("host:transport:"):
+                serial = request.partition("host:transport:")[2]
+                if serial not in server.devices:
+                    return self._fail(f"device '{serial}' not found")
+                self._okay()
+                continue
+
+            if request.endswith((":wait-for-any-disconnect", ":wait-for-any-device")):
+                self._okay()
+                return self._okay()
+            if request == "root:":
+                self._okay()
+                self.request.sendall(server.root_output)
+                return
+            if request == "sync:":
+                self._okay()
+                return self._sync()
+
+            service, _, command = request.partition(":")
+            if service not in ("shell,v2,raw", "shell", "exec"):
+                return self._fail(f"unknown service {service}")
+
+            # The "device" runs commands in the host's shell:
+            result = subprocess.run(["sh", "-c", command], stdout=subprocess.PIPE)
+            self._okay()
+            if service == "shell,v2,raw":
+                for packet_id, data in ((1, result.stdout), (3, bytes([result.returncode]))):
+                    self.request.sendall(
+                        bytes([packet_id]) + len(data).to_bytes(4, "little") + data
+                    )
+            else:
+                self.request.sendall(result.stdout)
+            return
+
+
+class _FakeAdbServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, devices=("SERIAL1",), features=("shell_v2", "cmd")):
+        super().__init__(("127.0.0.1", 0), _FakeAdbServerHandler)
+        self.devices = devices
+        # serial => state listed by host:devices, if not "device":
+        self.device_states = {}
+        self.features = features
+        self.requests = []
+        self.root_output = b"adbd is already running as root\n"
+
+
+@pytest.fixture
+def fake_adb_server():
+    server = _FakeAdbServer()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def server_transport(fake_adb_server, monkeypatch):
+    transport = bort_cli._AdbServerTransport(port=fake_adb_server.server_address[1])
+    monkeypatch.setattr(bort_cli, "_adb_transport", transport)
+    return transport
+
+
+def test_adb_server_transport_devices(server_transport):
+    assert bort_cli._get_shell_cmd_output_and_errors(
+        description="test", cmd=("adb", "devices")
+    ) == (
+        "List of devices attached\nSERIAL1\tdevice\n",
+        [],
+    )
+
+
+def test_list_connected_devices(fake_adb_server, server_transport, caplog):
+    fake_adb_server.devices = ("SERIAL1", "SERIAL2", "SERIAL3", "emulator-5554")
+    fake_adb_server.device_states = {"SERIAL2": "unauthorized", "SERIAL3": "offline"}
+    caplog.set_level(logging.INFO)
+    assert bort_cli._list_connected_devices() == ["SERIAL1", "emulator-5554"]
+    assert "Skipping SERIAL2 (state: unauthorized)" in caplog.text
+    assert "Skipping SERIAL3 (state: offline)" in caplog.text
+
+
+def test_validate_fleet_summary(tmp_path, monkeypatch, caplog):
+    log_file = str(tmp_path / "validate.log")
+    command = bort_cli.ValidateConnectedDevice(
+        "com.example.bort", devices=["SERIAL1", "SERIAL2", "SERIAL1"], log_file=log_file
+    )
+    results = {
+        "SERIAL1": (True, 1.5, "SUCCESS: Bort SDK on the connected device appears to be valid"),
+        "SERIAL2": (False, 12.25, "Failure: 2 checks failing."),
+    }
+    monkeypatch.setattr(command, "_validate_device_in_subprocess", results.__getitem__)
+    caplog.set_level(logging.INFO)
+
+    with pytest.raises(SystemExit, match="1 of 2 devices failed validation"):
+        command.run()
+    lines = [record.getMessage() for record in caplog.records]
+    table = lines[lines.index("DEVICE   RESULT      TIME  LOG") :]
+    assert table == [
+        "DEVICE   RESULT      TIME  LOG",
+        f"SERIAL1  PASS        1.5s  {tmp_path / 'validate-SERIAL1.log'}",
+        f"SERIAL2  FAIL       12.2s  {tmp_path / 'validate-SERIAL2.log'}",
+        "         Failure: 2 checks failing.",
+    ]
+
+    results["SERIAL2"] = (True, 1.0, "SUCCESS")
+    command.run()
+    assert "SUCCESS: Bort SDK on all 2 devices appears to be valid" in caplog.text
+
+
+def test_validate_fleet_in_subprocesses(tmp_path, fake_adb_server, monkeypatch, caplog):
+    fake_adb_server.devices = ("SERIAL1", "SERIAL:2")
+    monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(fake_adb_server.server_address[1]))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(bort_cli, "_adb_transport", bort_cli._AdbServerTransport())
+    log_file = str(tmp_path / "validate.log")
+    command = bort_cli.ValidateConnectedDevice(
+        "com.example.bort", all_devices=True, log_file=log_file, no_cache=True
+    )
+
+    caplog.set_level(logging.INFO)
+
+    # The "devices" run commands in the host's shell, which has no getprop:
+    with pytest.raises(SystemExit, match="2 of 2 devices failed validation"):
+        command.run()
+    for device, serial in (("SERIAL1", "SERIAL1"), ("SERIAL_2", "SERIAL:2")):
+        device_log = (tmp_path / f"validate-{device}.log").read_text()
+        assert f"adb -s {serial} shell getprop ro.build.version.sdk" in device_log
+    summaries = [
+        record.getMessage().strip()
+        for record in caplog.records
+        if "could not get SDK version" in record.getMessage()
+    ]
+    assert summaries == ["Failure: could not get SDK version."] * 2
+    assert not os.path.exists(log_file)
+    assert "host:transport:SERIAL:2" in fake_adb_server.requests
+
+
+def test_adb_server_transport_shell(fake_adb_server, server_transport):
+    assert bort_cli._get_adb_shell_cmd_output_and_errors(
+        description="test", cmd=("echo", "hello"), device="SERIAL1"
+    ) == ("hello", [])
+    assert fake_adb_server.requests[-2:] == ["host:transport:SERIAL1", "shell,v2,raw:echo hello"]
+
+
+def test_adb_server_transport_shell_exit_status(server_transport):
+    output, errors = bort_cli._get_adb_shell_cmd_output_and_errors(
+        description="test", cmd=("exit", "3"), device="SERIAL1"
+    )
+    assert output is None
+    assert errors == [
+        "Command '['adb', '-s', 'SERIAL1', 'shell', 'exit', '3']' returned non-zero exit status 3."
+    ]
+
+
+def test_adb_server_transport_shell_v1(fake_adb_server, server_transport):
+    fake_adb_server.features = ("cmd",)
+    assert bort_cli._get_adb_shell_cmd_output_and_errors(
+        description="test", cmd=("echo", "hello"), device="SERIAL1"
+    ) == ("hello", [])
+    assert fake_adb_server.requests[-1] == "shell:echo hello"
+
+
+def test_adb_server_transport_root_waits_for_restart(fake_adb_server, server_transport):
+    fake_adb_server.root_output = b"restarting adbd as root\n"
+    bort_cli._check_output(("adb", "-s", "SERIAL1", "root"))
+    assert fake_adb_server.requests[-3:] == [
+        "root:",
+        "host-serial:SERIAL1:wait-for-any-disconnect",
+        "host-serial:SERIAL1:wait-for-any-device",
+    ]
+
+    fake_adb_server.root_output = b"adbd is already running as root\n"
+    bort_cli._check_output(("adb", "-s", "SERIAL1", "root"))
+    assert fake_adb_server.requests[-1] == "root:"
+
+
+def test_adb_server_transport_pull(tmp_path, fake_adb_server, server_transport):
+    remote_file = tmp_path / "remote"
+    remote_file.write_bytes(bytes(range(256)) * 100)
+    local_file = tmp_path / "local"
+    bort_cli._check_output(("adb", "-s", "SERIAL1", "pull", str(remote_file), str(local_file)))
+    assert local_file.read_bytes() == remote_file.read_bytes()
+
+    remote_file.unlink()
+    local_file.write_text("previous")
+    with pytest.raises(subprocess.CalledProcessError):
+        bort_cli._check_output(("adb", "-s", "SERIAL1", "pull", str(remote_file), str(local_file)))
+    assert local_file.read_text() == "previous"
+    assert sorted(os.listdir(str(tmp_path))) == ["local"]
+
+
+def test_adb_server_transport_unknown_device(server_transport):
+    output, errors = bort_cli._get_adb_shell_cmd_output_and_errors(
+        description="test", cmd=("echo", "hello"), device="SERIAL2"
+    )
+    assert output is None
+    assert "returned non-zero exit status 1" in errors[0]
+
+
+def test_probe_shell_outputs(server_transport):
+    outputs = bort_cli._probe_shell_outputs(
+        cmds=[("echo", "hello"), ("seq", "2"), ("ls", "/nonexistent"), ("echo", "'x y'")],
+        device="SERIAL1",
+    )
+    assert outputs == {
+        ("echo", "hello"): ("hello", []),
+        ("seq", "2"): ("1\n2", []),
+        ("ls", "/nonexistent"): (
+            None,
+            [
+                "Command '['adb', '-s', 'SERIAL1', 'shell', 'ls', '/nonexistent']' returned non-zero exit status %d."
+                % subprocess.run(["ls", "/nonexistent"], stderr=subprocess.DEVNULL).returncode
+            ],
+        ),
+    }
+
+
+def test_probe_shell_outputs_like_separate_commands(server_transport, monkeypatch):
+    monkeypatch.setattr(bort_cli.uuid, "uuid4", lambda: bort_cli.uuid.UUID(int=0))
+    marker = f"BORT_PROBE_{bort_cli.uuid.UUID(int=0).hex}"
+    cmds = [
+        ("printf", "no-trailing-newline"),
+        ("printf", "%s", "needs quoting"),
+        ("true",),
+        ("false",),
+        ("cat", "/nonexistent"),
+        # Marker-like output, of another probe and of this one:
+        ("echo", "BORT_PROBE_0:end:0:0"),
+        ("echo", f"{marker}:end:7:0"),
+        ("seq", "3"),
+    ]
+    outputs = bort_cli._probe_shell_outputs(cmds=cmds, device="SERIAL1")
+    # Commands with arguments that would need quoting are left to be run on their own:
+    assert set(outputs) == set(cmds) - {cmds[1]}
+    for cmd, output in outputs.items():
+        assert output == bort_cli._get_adb_shell_cmd_output_and_errors(
+            description="test", cmd=cmd, device="SERIAL1"
+        ), cmd
+
+
+def test_device_fact_cache(tmp_path):
+    cache = bort_cli._DeviceFactCache(str(tmp_path), ttl=60, max_bytes=1024)
+    assert cache.load("SERIAL1", "fingerprint1") is None
+
+    cache.store("SERIAL1", "fingerprint1", {"a": 1})
+    assert cache.load("SERIAL1", "fingerprint1") == {"a": 1}
+    assert cache.load("SERIAL1", "fingerprint2") is None
+    assert cache.load("SERIAL2", "fingerprint1") is None
+
+
+def test_device_fact_cache_eviction(tmp_path):
+    cache = bort_cli._DeviceFactCache(str(tmp_path), ttl=60, max_bytes=1024)
+    cache.store("SERIAL1", "fingerprint1", {"a": "x" * 500})
+    os.utime(cache._path("SERIAL1", "fingerprint1"), (0, time.time() - 10))
+    cache.store("SERIAL2", "fingerprint1", {"a": "x" * 500})
+    cache.store("SERIAL3", "fingerprint1", {"a": "x" * 500})
+
+    # The least recently written entry is evicted to stay under max_bytes:
+    assert cache.load("SERIAL1", "fingerprint1") is None
+    assert cache.load("SERIAL3", "fingerprint1") is not None
+
+    # Expired entries are evicted:
+    os.utime(cache._path("SERIAL3", "fingerprint1"), (0, time.time() - 61))
+    assert cache.load("SERIAL3", "fingerprint1") is None
+
+
+def test_device_fact_cache_key_includes_partition_fingerprints(tmp_path, monkeypatch):
+    props = {
+        "ro.serialno": "SERIAL1",
+        "ro.build.fingerprint": "system/1",
+        "ro.vendor.build.fingerprint": "vendor/1",
+        "ro.product.build.fingerprint": "",
+    }
+    monkeypatch.setattr(
+        bort_cli,
+        "_probe_shell_outputs",
+        lambda cmds, device: {cmd: (props[cmd[1]], []) for cmd in cmds if cmd[0] == "getprop"},
+    )
+
+    def _command():
+        command = bort_cli.ValidateConnectedDevice("com.example.bort", devices=["SERIAL1"])
+        command._cache = bort_cli._DeviceFactCache(str(tmp_path))
+        return command
+
+    command = _command()
+    cache_key = command._query_cache_key()
+    assert cache_key == ("SERIAL1", "system/1 vendor/1")
+    command._vendor_cil_rule_found = False
+    command._store_cached_facts(cache_key)
+
+    command = _command()
+    command._load_cached_facts(command._query_cache_key())
+    assert command._vendor_cil_rule_found is False
+
+    # Only vendor.img was flashed:
+    props["ro.vendor.build.fingerprint"] = "vendor/2"
+    command = _command()
+    command._load_cached_facts(command._query_cache_key())
+    assert command._vendor_cil_rule_found is None
+
+
+def test_run_checks_concurrently_keeps_order(monkeypatch, caplog):
+    report = bort_cli._ValidationReport()
+    monkeypatch.setattr(bort_cli, "_validation_report", report)
+
+    def _check(idx):
+        # Later checks complete first:
+        time.sleep(0.01 * (5 - idx))
+        logging.info("check %d", idx)
+        report.record(f"check {idx}", passed=idx != 3, reason="reason")
+        return [f"error {idx}"] if idx == 3 else []
+
+    with caplog.at_level(logging.INFO):
+        errors = bort_cli._run_checks([functools.partial(_check, idx) for idx in range(5)], jobs=5)
+
+    assert errors == ["error 3"]
+    assert [r.getMessage() for r in caplog.records] == [f"check {idx}" for idx in range(5)]
+    assert [r["description"] for r in report.records] == [f"check {idx}" for idx in range(5)]
+    assert '<failure message="reason" />' in report.to_junit("suite")
+
+
+def test_run_checks_concurrently_with_failing_check(monkeypatch, caplog):
+    report = bort_cli._ValidationReport()
+    monkeypatch.setattr(bort_cli, "_validation_report", report)
+
+    def _check(idx):
+        time.sleep(0.01 * (5 - idx))
+        logging.info("check %d", idx)
+        if idx == 1:
+            raise RuntimeError("check 1 crashed")
+        report.record(f"check {idx}", passed=True, reason="reason")
+        return []
+
+    with caplog.at_level(logging.INFO), pytest.raises(RuntimeError, match="check 1 crashed"):
+        bort_cli._run_checks([functools.partial(_check, idx) for idx in range(4)], jobs=4)
+
+    # Including the output of the failing check up to the exception:
+    assert [r.getMessage() for r in caplog.records] == [f"check {idx}" for idx in range(4)]
+    assert [r["description"] for r in report.records] == ["check 0", "check 2", "check 3"]
+
+
+def test_idle_whitelist_matcher_streaming():
+    matcher = bort_cli._IdleWhitelistMatcher("com.example.bort")
+    output = "Whitelist (except idle) system apps:\n  com.other\nWhitelist system apps:\n  com.example.bort\n"
+    assert matcher(output) == (True, "Found 'com.example.bort'")
+
+    matcher.reset()
+    assert matcher.feed("  com.example.bort") is None
+    assert matcher.finish() == (False, "Failed to find 'Whitelist system apps' in output")
+
+
+def test_iter_process_output_lines_stops_command():
+    lines = bort_cli._iter_process_output_lines(("yes",))
+    assert next(lines) == "y\n"
+    # Would never complete if the command was not stopped:
+    lines.close()
+
+    with pytest.raises(subprocess.CalledProcessError):
+        list(bort_cli._iter_process_output_lines(("false",)))
+
+
+def test_stream_adb_shell_cmd_and_expect(server_transport, monkeypatch):
+    report = bort_cli._ValidationReport()
+    monkeypatch.setattr(bort_cli, "_validation_report", report)
+
+    assert (
+        bort_cli._stream_adb_shell_cmd_and_expect(
+            description="stops early",
+            cmd=("seq", "100000"),
+            matcher=bort_cli._RegexMatcher(r"^5$"),
+            device="SERIAL1",
+        )
+        == []
+    )
+    assert report.records[-1]["stopped_early"] is True
+    assert report.records[-1]["output_bytes"] == len("1\n2\n3\n4\n5\n")
+
+    (error,) = bort_cli._stream_adb_shell_cmd_and_expect(
+        description="fails",
+        cmd=("seq", "100"),
+        matcher=bort_cli._RegexMatcher(r"^x$"),
+        device="SERIAL1",
+    )
+    assert report.records[-1]["passed"] is False
+    assert "(last 50 lines)" in error
+    assert "\n50\n" not in error and "\n51\n" in error
+
+
+def test_check_vendor_sepolicy_cil(tmp_path, server_transport, monkeypatch):
+    cil_file = tmp_path / "vendor_sepolicy.cil"
+    monkeypatch.setattr(bort_cli, "VENDOR_CIL_PATH", str(cil_file))
+    command = bort_cli.ValidateConnectedDevice("com.example.bort", devices=["SERIAL1"])
+
+    # Not an answer to remember for the device:
+    (error,) = command._check_vendor_sepolicy_cil()
+    assert "Expected a selinux rule" not in error
+    assert command._vendor_cil_rule_found is None
+
+    cil_file.write_text(
+        "(allow priv_app_30_0 memfault_dumpster_service (service_manager (find)))\n"
+    )
+    assert command._check_vendor_sepolicy_cil() == []
+    assert command._vendor_cil_rule_found is True
+
+
+def test_adb_server_transport_exec_out_lines(fake_adb_server, server_transport):
+    lines = server_transport.iter_lines(("adb", "-s", "SERIAL1", "exec-out", "seq", "3"))
+    assert list(lines) == ["1\n", "2\n", "3\n"]
+    assert fake_adb_server.requests[-1] == "exec:seq 3"
+
+
+def test_rerun_failed_checks(monkeypatch):
+    report = bort_cli._ValidationReport()
+    monkeypatch.setattr(bort_cli, "_validation_report", report)
+    command = bort_cli.ValidateConnectedDevice("com.example.bort", no_cache=True)
+
+    def _check_package_infos():
+        return ["error"]
+
+    passed = bort_cli._ShellCheck(
+        description="passed", cmd=("true",), matcher=bort_cli._AlwaysMatcher()
+    )
+    failed = bort_cli._ShellCheck(
+        description="failed", cmd=("false",), matcher=bort_cli._AlwaysMatcher()
+    )
+    command._shell_outputs[("false",)] = ("cached", [])
+    checks = [passed, failed, _check_package_infos]
+
+    rerun = command._failed_checks(checks, {"passed": True, "failed": False})
+    assert rerun == [failed, _check_package_infos]
+    assert report.records == [
+        {"description": "passed", "skipped": True, "reason": "Passed previously"}
+    ]
+    # The cached output of a failed check is queried again:
+    assert ("false",) not in command._shell_outputs
+
+    errors = bort_cli._run_checks([command._track_result(check) for check in rerun[1:]])
+    assert errors == ["error"]
+    assert command._check_results == {"_check_package_infos": False}
+
+
+@pytest.mark.parametrize(
+    "no_cache,rerun_failed,queried",
+    [(True, False, False), (True, True, True), (False, False, True)],
+)
+def test_validate_device_cache_key(monkeypatch, no_cache, rerun_failed, queried):
+    command = bort_cli.ValidateConnectedDevice(
+        "com.example.bort", no_cache=no_cache, rerun_failed=rerun_failed
+    )
+    queries = []
+    monkeypatch.setattr(bort_cli, "_verify_device_connected", lambda device: [])
+    monkeypatch.setattr(command, "_query_cache_key", lambda: queries.append(True))
+    monkeypatch.setattr(command, "_query_sdk_version", lambda: None)
+
+    with pytest.raises(SystemExit, match="could not get SDK version"):
+        command._validate_device()
+    assert bool(queries) == queried
+
+
+def test_watch_events():
+    states = bort_cli._check_states(
+        [
+            {"description": "query", "command": "adb shell true"},
+            {"description": "skipped", "skipped": True, "reason": "SDK version"},
+            {"description": "a", "passed": True, "reason": "Found"},
+            {"description": "b", "passed": False, "reason": "Not found"},
+        ]
+    )
+    assert states == {"a": (True, "Found"), "b": (False, "Not found")}
+
+    assert bort_cli._watch_events(states, states) == []
+    assert bort_cli._watch_events(states, {"a": (False, "Not found")}) == [
+        "FAIL: a (Not found)",
+        "GONE: b",
+    ]
+
+
+def test_trace_subprocesses_and_files(tmp_path, monkeypatch):
+    tracer = bort_cli.Tracer()
+    monkeypatch.setattr(bort_cli, "_tracer", tracer)
+    trace_file = tmp_path / "trace.json"
+    tracer.enable(str(trace_file))
+
+    assert bort_cli._check_output(("echo", "hello")) == "hello\n"
+    bort_cli._write_file(str(tmp_path / "file"), "content")
+    tracer.flush()
+    tracer.flush()
+
+    # The closing bracket of the JSON Array Format is optional:
+    events = json.loads(trace_file.read_text().rstrip().rstrip(",") + "]")
+    assert [(event["ph"], event.get("cat")) for event in events] == [
+        ("M", None),
+        ("X", "subprocess"),
+        ("X", "file"),
+    ]
+    assert events[1]["args"] == {"command": "echo hello", "cwd": os.getcwd(), "stdout_bytes": 6}
+    assert events[2]["args"] == {"path": str(tmp_path / "file"), "bytes": 7}
+
+
+def test_patch_aosp_projects_concurrently(tmp_path, caplog):
+    patches_dir = tmp_path / "patches"
+    aosp_root = tmp_path / "aosp"
+    for repo_subdir in ("art", "frameworks/base", "system/core", "device/google/cuttlefish"):
+        (patches_dir / repo_subdir).mkdir(parents=True)
+        (patches_dir / repo_subdir / "git.diff").write_text(f"{repo_subdir} patch\n")
+    # The patches for the projects which don't exist fail to apply:
+    for repo_subdir in ("art", "frameworks/base"):
+        (aosp_root / repo_subdir).mkdir(parents=True)
+
+    command = bort_cli.PatchAOSPCommand(
+        aosp_root=str(aosp_root),
+        check_patch_command=["false"],
+        apply_patch_command=["sh", "-c", "sleep 0.1; cat > applied.diff"],
+        force=False,
+        android_release=12,
+        exclude=None,
+        jobs=4,
+    )
+    command._patches_dir = str(patches_dir)
+    with caplog.at_level(logging.INFO):
+        command._apply_all_patches()
+
+    assert (aosp_root / "art" / "applied.diff").read_text() == "art patch\n"
+    assert command._errors == ["system/core/git.diff"]
+    assert command._warnings == ["device/google/cuttlefish/git.diff"]
+    # The log output of each patch is kept together:
+    messages = [record.getMessage() for record in caplog.records]
+    running = [idx for idx, message in enumerate(messages) if message.startswith("Running")]
+    assert len(running) == 4
+    for idx in running:
+        assert messages[idx + 1] == "" or messages[idx + 1].startswith("Failed to apply")
+
+
+PATCH = """\
+diff --git a/src/main.c b/src/main.c
+--- a/src/main.c
++++ b/src/main.c
+@@ -2,5 +2,6 @@
+ two
+ three
+ four
++four and a half
+ five
+ six
+diff --git a/src/new.c b/src/new.c
+new file mode 100644
+--- /dev/null
++++ b/src/new.c
+@@ -0,0 +1,2 @@
++new
++file
+\\ No newline at end of file
+"""
+
+
+def test_patch_lines_offset_and_fuzz():
+    file_patch, _ = bort_cli._parse_unified_diff(PATCH)
+    lines = ["zero\n", "extra\n", "one\n", "two\n", "THREE\n", "four\n", "five\n", "six\n"]
+    result, messages = bort_cli._patch_lines(lines, file_patch.hunks)
+    assert result == lines[:6] + ["four and a half\n"] + lines[6:]
+    # Same as GNU patch:
+    assert messages == ["Hunk #1 succeeded at 4 with fuzz 2 (offset 2 lines)."]
+
+    result, messages = bort_cli._patch_lines(["two\n", "five\n"], file_patch.hunks)
+    assert result is None
+    assert messages == ["Hunk #1 FAILED at 2."]
+
+
+# Hunks and files on which an earlier version of _patch_lines disagreed with GNU patch:
+PATCH_EDGE_CASES = [
+    # Context that fuzz ignores would be before the start of the file:
+    ("@@ -1,2 +1,3 @@\n l0\n l0\n+l0\n", "l0\n"),
+    ("@@ -1,3 +1,4 @@\n l1\n l0\n l0\n+l0\n", "l1\nl0\n"),
+    ("@@ -4,3 +4,3 @@\n l1\n-l2\n+l4\n l0\n", "l2\nl0\nl3\n"),
+    ("@@ -10,4 +10,5 @@\n l1\n l0\n l0\n+l1\n l2\n", "l0\nl2\nl1\nl0\nl0\nl1\nl0\nl0\nl1\nl2\n"),
+    # Context that fuzz ignores would be after the end of the file:
+    ("@@ -6,3 +6,4 @@\n l1\n l1\n+l1\n l2\n", "l1\nl0\nl1\nl1\nl1\nl2\n"),
+    # The second hunk may not overlap the lines changed by the first one:
+    (
+        "@@ -1,4 +1,4 @@\n l1\n-l2\n+l0\n l0\n l1\n@@ -6,3 +6,4 @@\n l1\n l1\n+l1\n l2\n",
+        "l1\nl0\nl0\nl1\nl1\nl1\nl1\nl1\nl1\nl2\n",
+    ),
+    (
+        "@@ -2,3 +2,2 @@\n l10\n-l12\n l5\n@@ -6,2 +5,4 @@\n l10\n+l3\n+l8\n l5\n",
+        "l11\nl10\nl5\nl17\nl10\nl3\nl8\nl5\nl4\nl13\nl12\n",
+    ),
+    # Hunks without context, beyond the end of the file:
+    ("@@ -3,0 +4,2 @@\n+l4\n+l0\n", "l4\nl4\n"),
+    ("@@ -5 +4,0 @@\n-l3\n@@ -7,0 +7,2 @@\n+l2\n+l2\n@@ -9 +10 @@\n-l4\n+l1\n", "l0\nl2\nl3\n"),
+    # Offset and fuzz at either end:
+    (
+        "@@ -2,5 +2,6 @@\n two\n three\n four\n+four and a half\n five\n six\n",
+        "x\none\ntwo\n3\nfour\nfive\n",
+    ),
+]
+
+
+def _gnu_patch(tmp_path, hunks, content, *args):
+    (tmp_path / "f").write_text(content)
+    process = subprocess.run(
+        ["patch", "-p1", "-f", "-o", "patched", "-r", "-", *args],
+        cwd=str(tmp_path),
+        input=f"--- a/f\n+++ b/f\n{hunks}",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    messages = [line for line in process.stdout.splitlines() if line.startswith("Hunk #")]
+    if process.returncode:
+        return None, messages
+    return (tmp_path / "patched").read_text(), messages
+
+
+def _bort_patch(hunks, content, reverse=False):
+    (file_patch,) = bort_cli._parse_unified_diff(f"--- a/f\n+++ b/f\n{hunks}")
+    patch_hunks = [hunk.reversed() for hunk in file_patch.hunks] if reverse else file_patch.hunks
+    result, messages = bort_cli._patch_lines(bort_cli._split_lines(content), patch_hunks)
+    return (None if result is None else "".join(result)), messages
+
+
+def _random_patch_cases(seed, count):
+    import difflib
+    import random
+
+    rng = random.Random(seed)
+
+    def _lines(size, alphabet):
+        return [f"l{rng.randrange(alphabet)}\n" for _ in range(size)]
+
+    def _edit(lines, alphabet):
+        lines = list(lines)
+        for _ in range(rng.randrange(1, 4)):
+            idx = rng.randrange(len(lines) + 1)
+            if rng.randrange(3) == 0 or idx == len(lines):
+                lines[idx:idx] = _lines(rng.randrange(1, 3), alphabet)
+            elif rng.randrange(2):
+                del lines[idx : idx + rng.randrange(1, 3)]
+            else:
+                lines[idx] = f"l{rng.randrange(alphabet)}\n"
+        return lines
+
+    while count:
+        alphabet = rng.choice([2, 3, 5, 20])
+        old = _lines(rng.randrange(1, 14), alphabet)
+        new = _edit(old, alphabet)
+        if old == new:
+            continue
+        diff = difflib.unified_diff(old, new, "a/f", "b/f", n=rng.randrange(4))
+        hunks = "".join(list(diff)[2:])
+        target = rng.choice([old, new, _edit(old, alphabet), _edit(new, alphabet)])
+        yield hunks, "".join(target)
+        count -= 1
+
+
+@pytest.mark.skipif(not shutil.which("patch"), reason="GNU patch is not installed")
+@pytest.mark.parametrize(
+    "hunks,content", PATCH_EDGE_CASES + list(_random_patch_cases(seed=13, count=150))
+)
+def test_patch_lines_like_gnu_patch(tmp_path, hunks, content):
+    assert _bort_patch(hunks, content) == _gnu_patch(tmp_path, hunks, content)
+    # Which is how patches that are already applied are detected:
+    assert _bort_patch(hunks, content, reverse=True) == _gnu_patch(tmp_path, hunks, content, "-R")
+
+
+def test_check_and_apply_unified_diff(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "main.c").write_text("one\ntwo\nthree\nfour\nfive\nsix\nseven\n")
+    file_patches = bort_cli._parse_unified_diff(PATCH)
+
+    diff_check = bort_cli._check_unified_diff(file_patches, str(tmp_path))
+    assert diff_check.state == bort_cli._DiffCheck.APPLICABLE
+    bort_cli._apply_diff_check(diff_check, str(tmp_path))
+    assert (tmp_path / "src" / "main.c").read_text() == (
+        "one\ntwo\nthree\nfour\nfour and a half\nfive\nsix\nseven\n"
+    )
+    assert (tmp_path / "src" / "new.c").read_text() == "new\nfile"
+    assert sorted(os.listdir(tmp_path / "src")) == ["main.c", "new.c"]
+
+    diff_check = bort_cli._check_unified_diff(file_patches, str(tmp_path))
+    assert diff_check.state == bort_cli._DiffCheck.APPLIED
+
+    # Only one of the files is patched:
+    (tmp_path / "src" / "new.c").unlink()
+    diff_check = bort_cli._check_unified_diff(file_patches, str(tmp_path))
+    assert diff_check.state == bort_cli._DiffCheck.CONFLICT
+
+
+def test_patch_aosp_in_process(tmp_path, caplog):
+    patches_dir = tmp_path / "patches"
+    (patches_dir / "system/core").mkdir(parents=True)
+    (patches_dir / "system/core" / "git.diff").write_text(PATCH)
+    (tmp_path / "aosp/system/core/src").mkdir(parents=True)
+    main_c = tmp_path / "aosp/system/core/src/main.c"
+    main_c.write_text("one\ntwo\nthree\nfour\nfive\nsix\n")
+
+    command = bort_cli.PatchAOSPCommand(
+        aosp_root=str(tmp_path / "aosp"),
+        check_patch_command=None,
+        apply_patch_command=None,
+        force=False,
+        android_release=12,
+        exclude=None,
+    )
+    command._patches_dir = str(patches_dir)
+    with caplog.at_level(logging.INFO):
+        command._apply_all_patches()
+        assert command._errors == []
+        assert "four and a half\n" in main_c.read_text()
+
+        command._apply_all_patches()
+        assert "Skipping patch 'system/core/git.diff': already applied!" in caplog.messages
+
+        main_c.write_text("something else\n")
+        command._apply_all_patches()
+        assert command._errors == ["system/core/git.diff"]
+
+
+def test_patch_aosp_order(tmp_path, monkeypatch):
+    patches_dir = tmp_path / "patches"
+    for repo_subdir in ("system/core", "art", "frameworks/base"):
+        (patches_dir / repo_subdir).mkdir(parents=True)
+        (patches_dir / repo_subdir / "git.diff").write_text(PATCH)
+    # Patches are applied in the order the file system lists them, not sorted:
+    iglob = glob.iglob
+    monkeypatch.setattr(
+        glob, "iglob", lambda *args, **kwargs: reversed(sorted(iglob(*args, **kwargs)))
+    )
+    assert list(bort_cli.PatchAOSPCommand._find_patches(str(patches_dir))) == [
+        "system/core",
+        "frameworks/base",
+        "art",
+    ]
+
+
+def test_patch_aosp_state(tmp_path, monkeypatch, caplog):
+    patches_dir = tmp_path / "patches"
+    (patches_dir / "system/core").mkdir(parents=True)
+    (patches_dir / "system/core" / "git.diff").write_text(PATCH)
+    (tmp_path / "aosp/system/core/src").mkdir(parents=True)
+    main_c = tmp_path / "aosp/system/core/src/main.c"
+    main_c.write_text("one\ntwo\nthree\nfour\nfive\nsix\n")
+
+    def patch_aosp(force=False):
+        command = bort_cli.PatchAOSPCommand(
+            aosp_root=str(tmp_path / "aosp"),
+            check_patch_command=None,
+            apply_patch_command=None,
+            force=force,
+            android_release=12,
+            exclude=None,
+        )
+        command._patches_dir = str(patches_dir)
+        command._apply_all_patches()
+        return command
+
+    patch_aosp()
+    state = json.loads((tmp_path / "aosp" / bort_cli.PATCH_STATE_FILE).read_text())
+    assert sorted(state["patches"]["system/core/git.diff"]["files"]) == [
+        "system/core/src/main.c",
+        "system/core/src/new.c",
+    ]
+
+    checks = []
+    check_unified_diff = bort_cli._check_unified_diff
+    monkeypatch.setattr(
+        bort_cli,
+        "_check_unified_diff",
+        lambda *args: checks.append(args) or check_unified_diff(*args),
+    )
+    # Nothing changed, so the patch is not checked again:
+    with caplog.at_level(logging.INFO):
+        assert patch_aosp()._errors == []
+    assert checks == []
+    assert "Skipping patch 'system/core/git.diff': already applied!" in caplog.messages
+
+    # Touched, but with the same content:
+    os.utime(main_c, (0, 0))
+    assert patch_aosp()._errors == []
+    assert checks == []
+
+    # Changed since:
+    main_c.write_text("something else\n")
+    assert patch_aosp()._errors == ["system/core/git.diff"]
+    assert len(checks) == 1
+    state = json.loads((tmp_path / "aosp" / bort_cli.PATCH_STATE_FILE).read_text())
+    assert state["patches"] == {}
+
+    # --force bypasses the state:
+    main_c.write_text("one\ntwo\nthree\nfour\nfour and a half\nfive\nsix\n")
+    patch_aosp()
+    assert len(checks) == 2
+    patch_aosp(force=True)
+    assert len(checks) == 3
+
+
+def test_patch_aosp_detect_android_release(tmp_path, monkeypatch, caplog):
+    for android_release, patch in ((1, PATCH.replace("three", "THREE")), (2, PATCH)):
+        (tmp_path / f"patches/android-{android_release}/system/core").mkdir(parents=True)
+        (tmp_path / f"patches/android-{android_release}/system/core/git.diff").write_text(patch)
+    (tmp_path / "patches/android-1/art").mkdir(parents=True)
+    (tmp_path / "patches/android-1/art/git.diff").write_text(PATCH)
+    (tmp_path / "aosp/system/core/src").mkdir(parents=True)
+    (tmp_path / "aosp/system/core/src/main.c").write_text("one\ntwo\nthree\nfour\nfive\nsix\n")
+    monkeypatch.setattr(bort_cli, "RELEASES", range(1, 2 + 1))
+    monkeypatch.setattr(
+        bort_cli.PatchAOSPCommand,
+        "_release_patches_dir",
+        staticmethod(lambda android_release: str(tmp_path / f"patches/android-{android_release}")),
+    )
+
+    command = bort_cli.PatchAOSPCommand(
+        aosp_root=str(tmp_path / "aosp"),
+        check_patch_command=None,
+        apply_patch_command=None,
+        force=False,
+        android_release="auto",
+        exclude=None,
+    )
+    with caplog.at_level(logging.INFO):
+        command.run()
+    assert "four and a half\n" in (tmp_path / "aosp/system/core/src/main.c").read_text()
+    # Release 1 is ruled out by its art patch, before its system/core one is checked:
+    assert caplog.messages[1:4] == [
+        "\trelease  art       system/core",
+        "\t1        conflict  -",
+        "\t2        -         applicable",
+    ]
+    assert "Detected Android release: 2" in caplog.messages
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        assert command._detect_android_release() == 2
+    assert "\t2        -         applied" in caplog.messages
+
+
+def test_patch_bort(tmp_path):
+    properties = tmp_path / "bort.properties"
+    template = (
+        f"BORT_APPLICATION_ID={bort_cli.PLACEHOLDER_BORT_APP_ID}\n"
+        f"BORT_OTA_APPLICATION_ID={bort_cli.PLACEHOLDER_BORT_OTA_APP_ID}\n"
+        f"BORT_FEATURE_NAME={bort_cli.PLACEHOLDER_FEATURE_NAME}\n"
+    )
+    # Larger than the chunks the file is streamed in:
+    properties.write_text(template * 2000)
+    properties.chmod(0o640)
+
+    bort_cli.PatchBortCommand(str(tmp_path), "com.example.bort").run()
+    assert (
+        properties.read_text()
+        == (
+            "BORT_APPLICATION_ID=com.example.bort\n"
+            f"BORT_OTA_APPLICATION_ID={bort_cli.PLACEHOLDER_BORT_OTA_APP_ID}\n"
+            "BORT_FEATURE_NAME=com.example.bort\n"
+        )
+        * 2000
+    )
+    assert properties.stat().st_mode & 0o777 == 0o640
+    assert os.listdir(tmp_path) == ["bort.properties"]
+
+
+def test_patch_bort_variants(tmp_path):
+    packages = tmp_path / "MemfaultPackages"
+    (packages / "bort" / "build").mkdir(parents=True)
+    (packages / "bort" / "build" / "output").write_text("output\n")
+    (packages / "bort" / "build.gradle").write_text("apply plugin\n")
+    (packages / "bort" / "src" / "build").mkdir(parents=True)
+    (packages / "bort" / "src" / "build" / "Source.kt").write_text("class Source\n")
+    (packages / "local.properties").write_text("sdk.dir=/sdk\n")
+    (packages / "bort.properties").write_text(
+        f"BORT_APPLICATION_ID={bort_cli.PLACEHOLDER_BORT_APP_ID}\n"
+    )
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "product-a": {"bort_app_id": "com.example.aa"},
+                "product-b": {"bort_app_id": "com.example.bb", "vendor_feature_name": "b.feature"},
+            }
+        )
+    )
+    variants = tmp_path / "variants"
+
+    def patch_bort():
+        bort_cli.PatchBortCommand(
+            str(packages), manifest=str(manifest), output_dir=str(variants), jobs=2
+        ).run()
+
+    patch_bort()
+    for name, app_id in (("product-a", "com.example.aa"), ("product-b", "com.example.bb")):
+        variant = variants / name
+        assert (variant / "bort.properties").read_text() == f"BORT_APPLICATION_ID={app_id}\n"
+        assert os.path.samefile(
+            variant / "bort" / "build.gradle", packages / "bort" / "build.gradle"
+        )
+        assert not (variant / "bort" / "build").exists()
+        # Only the build outputs at the roots of gradle projects are skipped:
+        assert (variant / "bort" / "src" / "build" / "Source.kt").exists()
+        assert not os.path.samefile(variant / "local.properties", packages / "local.properties")
+    assert bort_cli.PLACEHOLDER_BORT_APP_ID in (packages / "bort.properties").read_text()
+
+    # Patched files are only written when their content changes:
+    properties_stat = os.stat(variants / "product-a" / "bort.properties")
+    (variants / "product-a" / "stale.txt").write_text("stale\n")
+    patch_bort()
+    assert os.stat(variants / "product-a" / "bort.properties") == properties_stat
+    assert not (variants / "product-a" / "stale.txt").exists()
+
+    # Files written in place in a variant don't change the other ones:
+    (variants / "product-a" / "local.properties").write_text("sdk.dir=/other-sdk\n")
+    patch_bort()
+    assert (variants / "product-a" / "local.properties").read_text() == "sdk.dir=/other-sdk\n"
+    assert (variants / "product-b" / "local.properties").read_text() == "sdk.dir=/sdk\n"
+    assert (packages / "local.properties").read_text() == "sdk.dir=/sdk\n"
+
+    # Directories that are gone from the source are removed, build outputs are kept:
+    (packages / "removed" / "sub").mkdir(parents=True)
+    (packages / "removed" / "sub" / "file").write_text("file\n")
+    patch_bort()
+    (variants / "product-a" / "bort" / "build").mkdir()
+    shutil.rmtree(packages / "removed")
+    patch_bort()
+    assert not (variants / "product-a" / "removed").exists()
+    assert (variants / "product-a" / "bort" / "build").exists()
+
+    manifest.write_text(json.dumps({"MemfaultPackages": {"bort_app_id": "com.example.aa"}}))
+    for variants in (packages / "variants", packages, tmp_path):
+        with pytest.raises(SystemExit, match="would overlap with"):
+            patch_bort()
+    assert not (packages / "variants").exists()
+    assert (packages / "bort" / "build.gradle").exists()
+
+
+def _create_structured_logs_db(path):
+    # Schema of MemfaultStructuredLogd/src/storage.cpp:
+    with sqlite3.connect(path) as connection:
+        connection.executescript("""
+            CREATE TABLE log(timestamp int, type text, blob text, bootRowId int, internal int);
+            CREATE TABLE boot_ids(id integer primary key autoincrement, uuid text unique);
+            CREATE TABLE report_metric(eventName text, type text, internal int, version int,
+                timestamp int, aggregations int, value, valueType int);
+            CREATE INDEX report_metric_type on report_metric(type);
+            CREATE INDEX report_metric_timestamp on report_metric(timestamp);
+            CREATE INDEX report_metric_type_event on report_metric(type, eventName);
+            CREATE TABLE report(type text PRIMARY KEY, startTimestamp int);
+            INSERT INTO boot_ids (uuid) VALUES ('boot-1'), ('boot-2');
+            """)
+        connection.executemany(
+            "INSERT INTO log VALUES (?, ?, ?, ?, 0)",
+            [(ts, "a" if ts % 2 else "b", f'{{"n": {ts}}}', 1 + ts // 2000) for ts in range(2500)],
+        )
+        connection.executemany(
+            "INSERT INTO report_metric VALUES ('event', ?, 0, 1, ?, 1, ?, 1)",
+            [("Heartbeat", ts, ts * 10) for ts in range(3, 0, -1)],
+        )
+    connection.close()
+
+
+def test_export_structured_logs(tmp_path, monkeypatch):
+    db_file = str(tmp_path / "log.db")
+    output_file = str(tmp_path / "export")
+    _create_structured_logs_db(db_file)
+    monkeypatch.setattr(bort_cli, "STRUCTURED_LOGS_CHUNK_ROWS", 100)
+
+    def _export(**kwargs):
+        bort_cli.ExportStructuredLogs(db_file=db_file, output_file=output_file, **kwargs).run()
+        with open(output_file) as file:
+            return file.read().splitlines()
+
+    rows = [json.loads(line) for line in _export()]
+    assert len(rows) == 2500
+    assert rows[1] == {
+        "timestamp": 1,
+        "type": "a",
+        "blob": '{"n": 1}',
+        "bootRowId": 1,
+        "internal": 0,
+    }
+
+    rows = [json.loads(line) for line in _export(types=["a"], boot_id="boot-2", until=2100)]
+    assert [row["timestamp"] for row in rows] == list(range(2001, 2100, 2))
+
+    assert _export(table="report_metric", output_format="csv", since=2) == [
+        "eventName,type,internal,version,timestamp,aggregations,value,valueType",
+        "event,Heartbeat,0,1,2,1,20,1",
+        "event,Heartbeat,0,1,3,1,30,1",
+    ]
+
+    with pytest.raises(SystemExit, match="--boot-id does not apply to the report_metric table"):
+        _export(table="report_metric", boot_id="boot-1")
+
+
+def test_export_structured_logs_from_device(tmp_path, monkeypatch, server_transport, capsys):
+    device_db_file = str(tmp_path / "device.db")
+    _create_structured_logs_db(device_db_file)
+    monkeypatch.setattr(bort_cli, "MEMFAULT_STRUCTURED_DB_PATH", device_db_file)
+    monkeypatch.setattr(bort_cli, "STRUCTURED_LOGS_SNAPSHOT_PATH", str(tmp_path / "snapshot.db"))
+    pulled = []
+    pull = server_transport._pull
+    monkeypatch.setattr(
+        server_transport,
+        "_pull",
+        lambda device, remote, local: pulled.append(remote) or pull(device, remote, local),
+    )
+
+    if shutil.which("sqlite3"):
+        bort_cli.ExportStructuredLogs(table="boot_ids", boot_id="boot-2", device="SERIAL1").run()
+        assert capsys.readouterr().out == '{"id": 2, "uuid": "boot-2"}\n'
+        assert pulled == [str(tmp_path / "snapshot.db")]
+        assert not os.path.exists(str(tmp_path / "snapshot.db"))
+
+    # Without the sqlite3 tool on the device, a transaction in progress is rolled back:
+    (tmp_path / "bin").mkdir()
+    os.symlink(shutil.which("sh"), str(tmp_path / "bin" / "sh"))
+    monkeypatch.setenv("PATH", str(tmp_path / "bin"))
+    with contextlib.closing(sqlite3.connect(device_db_file, isolation_level=None)) as connection:
+        connection.execute("PRAGMA cache_size = 1")
+        connection.execute("BEGIN")
+        connection.executemany(
+            "INSERT INTO boot_ids (uuid) VALUES (?)", [(f"uncommitted-{n}",) for n in range(2000)]
+        )
+        pulled.clear()
+        bort_cli.ExportStructuredLogs(table="boot_ids", device="SERIAL1").run()
+        connection.execute("ROLLBACK")
+    assert pulled == [device_db_file, device_db_file + "-journal"]
+    assert [json.loads(line)["uuid"] for line in capsys.readouterr().out.splitlines()] == [
+        "boot-1",
+        "boot-2",
+    ]
+
+    os.remove(device_db_file)
+    with pytest.raises(SystemExit, match=f"unable to pull {device_db_file}"):
+        bort_cli.ExportStructuredLogs(device="SERIAL1").run()
+
+
+def test_export_structured_logs_invalid_db(tmp_path):
+    db_file = tmp_path / "log.db"
+    db_file.write_text("cat: log.db: No such file or directory")
+    with pytest.raises(SystemExit, match="unable to read .*: file is not a database"):
+        bort_cli.ExportStructuredLogs(db_file=str(db_file)).run()